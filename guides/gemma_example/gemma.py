@@ -1,14 +1,23 @@
+import torch
 from dotenv import dotenv_values
 from transformers import AutoTokenizer, AutoModelForCausalLM
 
 config = dotenv_values(".env")
 
+device = "cuda" if torch.cuda.is_available() else "cpu"
+# fp16 kernels are GPU only, the CPU runs bfloat16 (or float32 on CPUs without bf16 support)
+dtype = torch.float16 if device == "cuda" else torch.bfloat16
 
 tokenizer = AutoTokenizer.from_pretrained("google/gemma-2b-it", token=config["HF_TOKEN"])
-model = AutoModelForCausalLM.from_pretrained("google/gemma-2b-it", device_map="auto", token=config["HF_TOKEN"])
+model = AutoModelForCausalLM.from_pretrained(
+    "google/gemma-2b-it",
+    device_map="auto" if device == "cuda" else None,
+    torch_dtype=dtype,
+    token=config["HF_TOKEN"]
+)
 
 input_text = "How are you?"
-input_ids = tokenizer(input_text, return_tensors="pt").to("cuda")
+input_ids = tokenizer(input_text, return_tensors="pt").to(model.device)
 
 outputs = model.generate(**input_ids)
-print(tokenizer.decode(outputs[0]))
\ No newline at end of file
+print(tokenizer.decode(outputs[0]))
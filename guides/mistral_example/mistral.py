@@ -1,12 +1,20 @@
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
-device = "cuda"  # the device to load the model onto
+device = "cuda" if torch.cuda.is_available() else "cpu"  # the device to load the model onto
+
+if device == "cuda":
+    model = AutoModelForCausalLM.from_pretrained("mistralai/Mistral-7B-Instruct-v0.2",
+                                                 torch_dtype=torch.float16,
+                                                 load_in_4bit=True,
+                                                 low_cpu_mem_usage=True)
+else:
+    # bitsandbytes 4 bit is CUDA only, on CPU int8 dynamic quantization of the linear layers is the closest
+    model = AutoModelForCausalLM.from_pretrained("mistralai/Mistral-7B-Instruct-v0.2",
+                                                 torch_dtype=torch.float32,
+                                                 low_cpu_mem_usage=True)
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
 
-model = AutoModelForCausalLM.from_pretrained("mistralai/Mistral-7B-Instruct-v0.2",
-                                             torch_dtype=torch.float16,
-                                             load_in_4bit=True,
-                                             low_cpu_mem_usage=True)
 tokenizer = AutoTokenizer.from_pretrained(
     "mistralai/Mistral-7B-Instruct-v0.2",
     torch_dtype=torch.float16,
@@ -19,7 +27,7 @@ messages = [
     {"role": "user", "content": "Do you have mayonnaise recipes?"}
 ]
 
-encodeds = tokenizer.apply_chat_template(messages, return_tensors="pt")
+encodeds = tokenizer.apply_chat_template(messages, return_tensors="pt").to(model.device)
 generated_ids = model.generate(encodeds, max_new_tokens=1000, do_sample=True)
 decoded = tokenizer.batch_decode(generated_ids)
 print(decoded[0])
@@ -0,0 +1,61 @@
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    server TEXT NOT NULL,
+    room TEXT NOT NULL,
+    id BLOB NOT NULL,
+    content BLOB NOT NULL,
+    PRIMARY KEY (server, room, id)
+) WITHOUT ROWID
+"""
+
+
+class HistoryCache:
+    """
+    Messages received from one server, with their server ids, kept in a local SQLite file.
+    Server ids grow with time and their 16 bytes compare like the ids themselves,
+    so the newest cached id of a room is the ``since`` of the next handshake and the server only sends what is newer.
+    Messages are stored as the client displays them, in plain text, next to the client's private key.
+    """
+    __slots__ = ('_connection', '_lock', 'server')
+
+    def __init__(self, path: Path, server: str) -> None:
+        # written by the receiving thread of whichever connection is current
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(_SCHEMA)
+        self._lock = threading.Lock()
+        self.server = server
+
+    def add(self, room: str, messages: list[tuple[uuid.UUID, bytes]]) -> None:
+        """One transaction per received frame, a history batch is a single commit."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO messages (server, room, id, content) VALUES (?, ?, ?, ?)',
+                [(self.server, room, message_id.bytes, content) for message_id, content in messages]
+            )
+
+    def last_id(self, room: str) -> uuid.UUID | None:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT max(id) FROM messages WHERE server = ? AND room = ?',
+                (self.server, room)
+            ).fetchone()
+        return uuid.UUID(bytes=row[0]) if row[0] is not None else None
+
+    def recent(self, room: str, limit: int) -> list[bytes]:
+        """The newest ``limit`` messages of ``room``, oldest first."""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT content FROM messages WHERE server = ? AND room = ? ORDER BY id DESC LIMIT ?',
+                (self.server, room, limit)
+            ).fetchall()
+        return [content for content, in reversed(rows)]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
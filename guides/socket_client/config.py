@@ -22,6 +22,20 @@ class Config(BaseSettings):
     rsa_private_key_name: str = Field(default='private.pem')
     rsa_public_key_name: str = Field(default='public.pem')
     username_file: str = Field(default='username.txt')
+    protocol_version: int = Field(default=2)
+    history_limit: int | None = Field(default=None)
+    room: str | None = Field(default=None)
+    # messages kept for redrawing the screen, and the most redraws per second during a burst
+    history_lines: int = Field(default=5000)
+    render_fps: float = Field(default=30.0)
+    # received messages kept locally, so a reconnect only asks the server for newer ones (protocol 2 only)
+    history_cache: bool = Field(default=True)
+    history_cache_path: Path = Field(default=Path.cwd() / 'history.db')
+    # seconds before the first reconnect, doubled on every failed attempt up to the maximum
+    reconnect_delay: float = Field(default=1.0)
+    reconnect_max_delay: float = Field(default=30.0)
+    # codecs offered to the server in order of preference, comma separated, empty for none
+    compression: str = Field(default='zlib')
 
     def _generate_new_keys(self) -> tuple[PublicKey, PrivateKey]:
         public_key, private_key = rsa.newkeys(self.rsa_key_length)
@@ -1,39 +1,45 @@
+import dataclasses
+import functools
 import logging
 import os
-import platform
+import random
+import re
 import socket
-import time
+import uuid
 
+from collections.abc import Callable, Iterator
 from threading import Thread
 
 from rsa import (
-    PrivateKey,
     PublicKey,
     decrypt,
     encrypt, common
 )
+from socket_protocol import (
+    CODECS,
+    PROTOCOL_VERSION,
+    FrameDecoder,
+    FrameError,
+    FrameType,
+    PayloadCompressor,
+    SessionCipher,
+    decode_batch,
+    decode_message,
+    encode_frame,
+    encode_options,
+    parse_options,
+    unwrap_key
+)
 
+from cache import HistoryCache
 from config import CONFIG
+from renderer import Renderer
 
 logger = logging.getLogger(__name__)
 log_handler = logging.StreamHandler()
 logger.addHandler(log_handler)
 logger.setLevel(logging.INFO)
 
-MESSAGE_HISTORY: str = ''
-
-
-def get_clear_command() -> str:
-    match platform.system():
-        case 'Windows':
-            return 'cls'
-        case _:
-            return 'clear'
-
-
-CLEAR_COMMAND: str = get_clear_command()
-
-
 def get_username() -> str:
     if os.path.exists(CONFIG.username_file):
         with open(CONFIG.username_file, 'r') as f:
@@ -43,83 +49,274 @@ def get_username() -> str:
         f.write(user_name)
     return user_name
 
-def handle_input(
+
+ROOM_NAME_PATTERN = re.compile(r'[a-z0-9_-]{1,32}')
+
+
+@dataclasses.dataclass(slots=True)
+class Connection:
+    """One connected session, replaced by a new one after every reconnect."""
+    socket: socket.socket
+    encrypt: Callable[[bytes], bytes]
+    decrypt: Callable[[bytes], bytes]
+    decoder: FrameDecoder | None
+    # the server prefixes stored messages with their id, see ``decode_message``
+    message_ids: bool
+    # set when the server compresses what it sends
+    compressor: PayloadCompressor | None
+    # the room received messages are cached under, ``None`` once the user moved to another one
+    room: str | None
+
+    def send(self, message: bytes) -> None:
+        encrypted = self.encrypt(message)
+        if self.decoder is not None:
+            encrypted = encode_frame(FrameType.CHAT, encrypted)
+        self.socket.sendall(encrypted)
+
+    def open(self, payload: bytes) -> bytes:
+        decrypted = self.decrypt(payload)
+        return self.compressor.unpack(decrypted) if self.compressor is not None else decrypted
+
+
+@dataclasses.dataclass(slots=True)
+class Session:
+    """Outlives connections: the room to reconnect to and the current connection, ``None`` while reconnecting."""
+    room: str
+    connection: Connection | None = None
+
+
+def normalize_room(name: str) -> str:
+    """As the server normalizes room names, the empty name being the server's default room."""
+    return name.strip().removeprefix('#').lower()
+
+
+def requested_room(message: str) -> str | None:
+    """The room a ``/join <room>`` or ``/leave`` command moves to, ``None`` for anything else."""
+    if not message.startswith('/'):
+        return None
+    command, _, argument = message[1:].strip().partition(' ')
+    match command.lower(), normalize_room(argument):
+        case 'join', room if ROOM_NAME_PATTERN.fullmatch(room):
+            return room
+        case 'leave', _:
+            return ''
+    return None
+
+
+def reconnect_delay(attempt: int) -> float:
+    """Exponential backoff with jitter, so clients dropped together do not all come back at once."""
+    delay = min(CONFIG.reconnect_delay * 2 ** min(attempt, 16), CONFIG.reconnect_max_delay)
+    return random.uniform(delay / 2, delay)
+
+
+def receive_handshake(
         _socket: socket.socket,
-        _private_key: PrivateKey,
-        _message_history: str
-) -> None:
+        _decoder: FrameDecoder | None
+) -> bytes:
+    if _decoder is None:
+        return _socket.recv(CONFIG.buffer_size)
     while True:
-        try:
-            data = _socket.recv(
-                common.byte_size(_private_key.n)
-            )
-            if not data:
-                continue
+        for frame_type, payload in _decoder:
+            if frame_type != FrameType.HANDSHAKE:
+                raise FrameError(f'Expected handshake, got {frame_type.name}')
+            return bytes(payload)
+        if not _decoder.recv_into(_socket):
+            raise ConnectionResetError('Connection closed during handshake')
+
 
-            decrypted_message = decrypt(
-                data,
-                _private_key
+def connect(
+        user_name: str,
+        room: str,
+        since: uuid.UUID | None,
+        message_ids: bool
+) -> Connection:
+    """Opens a connection and runs the handshake, asking only for history newer than ``since``."""
+    client_socket = socket.create_connection((CONFIG.host, CONFIG.port))
+    try:
+        public_key, private_key = CONFIG.client_keys  # switch to _generate_new_keys if needed
+        handshake_request = CONFIG.sign_message_prefix + public_key.save_pkcs1() + f':{user_name}'.encode()
+        decoder = None
+        if CONFIG.protocol_version >= PROTOCOL_VERSION:
+            handshake_options = {'proto': PROTOCOL_VERSION}
+            if CONFIG.history_limit is not None:
+                handshake_options['limit'] = CONFIG.history_limit
+            if room:
+                handshake_options['room'] = room
+            if message_ids:
+                handshake_options['ids'] = 1
+            if since is not None:
+                handshake_options['since'] = since
+            if CONFIG.compression:
+                handshake_options['compress'] = CONFIG.compression
+            handshake_request += b':' + encode_options(**handshake_options)
+            handshake_request = encode_frame(FrameType.HANDSHAKE, handshake_request)
+            decoder = FrameDecoder()
+        client_socket.sendall(handshake_request)
+        handshake_answer = receive_handshake(client_socket, decoder)
+        logger.debug(handshake_answer)
+        _, server_key, *options = handshake_answer.split(b':')
+
+        logger.debug(f"Received server public key: {server_key}")
+        server_public_key = PublicKey.load_pkcs1(server_key.replace(b'\\n', b'\n'))
+        server_options = parse_options(options)
+        if 'key' in server_options:
+            cipher = SessionCipher(
+                unwrap_key(server_options['key'].encode(), private_key),
+                initiator=True
             )
+            _decrypt, _encrypt = cipher.open, cipher.seal
+        else:
+            _decrypt = functools.partial(decrypt, priv_key=private_key)
+            _encrypt = functools.partial(encrypt, pub_key=server_public_key)
+    except BaseException:
+        client_socket.close()
+        raise
+    codec = server_options.get('compress')
+    return Connection(
+        socket=client_socket,
+        encrypt=_encrypt,
+        decrypt=_decrypt,
+        decoder=decoder,
+        message_ids=server_options.get('ids') == '1',
+        compressor=PayloadCompressor(CODECS[codec](None)) if codec else None,
+        room=room
+    )
 
-            os.system(CLEAR_COMMAND)
-            _message_history = f'{_message_history}\n{decrypted_message.decode()}'
-            print(_message_history)
-        except Exception as e:
-            logger.error(msg=str(e), exc_info=True)
-            break
+
+def receive_messages(connection: Connection) -> Iterator[tuple[FrameType, list[tuple[uuid.UUID | None, bytes]]]]:
+    """Yields the messages of every frame with their server ids, ``None`` where the server sent none."""
+    if connection.decoder is None:
+        receive_size = common.byte_size(CONFIG.client_keys[1].n)
+        while data := connection.socket.recv(receive_size):
+            yield FrameType.CHAT, [(None, connection.decrypt(data))]
+        return
+    while True:
+        for frame_type, payload in connection.decoder:
+            decrypted_message = connection.open(payload)
+            if frame_type == FrameType.HISTORY_BATCH:
+                messages = decode_batch(decrypted_message)
+            else:
+                messages = [decrypted_message]
+            if connection.message_ids and frame_type != FrameType.AI_PARTIAL:
+                yield frame_type, [decode_message(message) for message in messages]
+            else:
+                yield frame_type, [(None, message) for message in messages]
+        if not connection.decoder.recv_into(connection.socket):
+            return
+
+
+def handle_input(
+        connection: Connection,
+        _renderer: Renderer,
+        _cache: HistoryCache | None
+) -> None:
+    """
+    Partial Gemma answers are drawn below the history and replaced in place until the final one arrives.
+    Stored messages go to the history cache as they arrive. Returns once the connection is lost.
+    """
+    try:
+        for frame_type, messages in receive_messages(connection):
+            if frame_type == FrameType.AI_PARTIAL:
+                _renderer.set_partial(messages[0][1].decode())
+                continue
+            if frame_type == FrameType.AI_REPLY:
+                _renderer.set_partial('')
+            room = connection.room
+            stored = [(message_id, message) for message_id, message in messages if message_id is not None]
+            if _cache is not None and room is not None and stored:
+                _cache.add(room, stored)
+            for _, message in messages:
+                _renderer.add_message(message.decode())
+    except OSError as e:
+        logger.debug(msg=str(e))
+    except Exception as e:
+        logger.error(msg=str(e), exc_info=True)
 
 
 def handle_output(
-        _socket: socket,
-        _public_key: PublicKey
+        session: Session,
+        _renderer: Renderer
 ) -> None:
+    """Reads the prompt for the whole run, across reconnects. Returns when the input ends."""
     while True:
         try:
-            client_message = input(':')
+            client_message = _renderer.input(':')
             if not client_message:
                 continue
-            encrypted = encrypt(client_message.encode(), _public_key)
-            _socket.send(encrypted)
+            connection = session.connection
+            if connection is None:
+                _renderer.add_message('* not connected, message not sent')
+                continue
+            try:
+                connection.send(client_message.encode())
+            except OSError as e:
+                _renderer.add_message(f'* message not sent: {e}')
+                continue
+            if (room := requested_room(client_message)) is not None:
+                # the new room's messages come without a handshake ``since``, the next connection fetches them
+                connection.room = None
+                session.room = room
+        except EOFError:
+            break
         except Exception as e:
             logger.error(msg=str(e), exc_info=True)
             break
 
 
 def main() -> None:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-        client_socket.connect((CONFIG.host, CONFIG.port))
-        public_key, private_key = CONFIG.client_keys  # switch to _generate_new_keys if needed
-        input_name = get_username()
-        handshake_request = CONFIG.sign_message_prefix + public_key.save_pkcs1() + f':{input_name}'.encode()
-        client_socket.send(handshake_request)
-        handshake_answer = client_socket.recv(CONFIG.buffer_size)
-        if handshake_answer:
-            logger.info(handshake_answer)
-        _, public_key = handshake_answer.split(b':')
-
-        logger.info(f"Received server public key: {public_key}")
-        server_public_key = PublicKey.load_pkcs1(public_key.replace(b'\\n', b'\n'))
-        time.sleep(1)
-        os.system(CLEAR_COMMAND)
-
-        input_thread = Thread(
-            target=handle_input,
-            args=(client_socket, private_key, MESSAGE_HISTORY),
-            daemon=True
-        )
-
-        output_thread = Thread(
-            target=handle_output,
-            args=(client_socket, server_public_key),
-            daemon=True
-        )
-
-        input_thread.start()
-        output_thread.start()
-
-        while input_thread.is_alive() and output_thread.is_alive():
-            time.sleep(0.1)
+    input_name = get_username()
+    renderer = Renderer(max_lines=CONFIG.history_lines, fps=CONFIG.render_fps)
+    session = Session(room=normalize_room(CONFIG.room or ''))
+    cache = None
+    if CONFIG.history_cache and CONFIG.protocol_version >= PROTOCOL_VERSION:
+        cache = HistoryCache(CONFIG.history_cache_path, server=f'{CONFIG.host}:{CONFIG.port}')
+    renderer.start()
+    if cache is not None:
+        for message in cache.recent(session.room, CONFIG.history_lines):
+            renderer.add_message(message.decode())
+
+    output_thread = Thread(
+        target=handle_output,
+        args=(session, renderer),
+        daemon=True
+    )
+    output_thread.start()
 
+    attempt = 0
+    try:
+        while output_thread.is_alive():
+            try:
+                connection = connect(
+                    input_name,
+                    room=session.room,
+                    since=cache.last_id(session.room) if cache is not None else None,
+                    message_ids=cache is not None
+                )
+            except Exception as e:
+                logger.debug(msg=f'Connecting failed: {e}')
+            else:
+                attempt = 0
+                session.connection = connection
+                input_thread = Thread(
+                    target=handle_input,
+                    args=(connection, renderer, cache),
+                    daemon=True
+                )
+                input_thread.start()
+                while input_thread.is_alive() and output_thread.is_alive():
+                    input_thread.join(timeout=0.1)
+                session.connection = None
+                connection.socket.close()
+                if not output_thread.is_alive():
+                    break
+            delay = reconnect_delay(attempt)
+            attempt += 1
+            renderer.add_message(f'* disconnected, reconnecting in {delay:.1f}s')
+            output_thread.join(timeout=delay)
+    finally:
+        renderer.close()
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,161 @@
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+from typing import TextIO
+
+# cursor and screen control, supported by every current terminal including Windows 10+ consoles
+SAVE_CURSOR = '\x1b7'
+RESTORE_CURSOR = '\x1b8'
+CLEAR_SCREEN = '\x1b[2J'
+CLEAR_LINE = '\x1b[2K'
+RESET_SCROLL_REGION = '\x1b[r'
+
+
+def _move_to(row: int) -> str:
+    return f'\x1b[{row};1H'
+
+
+def _enable_ansi_on_windows() -> None:
+    if os.name != 'nt':
+        return
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.GetStdHandle(-11)
+    mode = ctypes.c_uint32()
+    if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+        # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+        kernel32.SetConsoleMode(handle, mode.value | 0x0004)
+
+
+class Renderer:
+    """
+    Draws the chat above a one-line prompt at the bottom of the terminal.
+    The chat area is a scroll region, so a new message costs one write of its own rows
+    instead of clearing the screen and reprinting the history.
+    Messages received between two frames are drawn together, at most ``fps`` times a second,
+    a burst such as the history sync costs one frame per interval however many messages it holds.
+    The last ``max_lines`` messages are kept for redrawing the screen after a resize.
+    The partial Gemma answer stays on the bottom row of the chat area until the final one replaces it.
+    Without a terminal, e.g. when piped, messages are printed as they are and partial answers skipped.
+    """
+    __slots__ = (
+        '_out',
+        '_lines',
+        '_pending',
+        '_partial',
+        '_dirty',
+        '_condition',
+        '_size',
+        '_thread',
+        'interactive',
+        'frame_interval'
+    )
+
+    def __init__(self, max_lines: int, fps: float, out: TextIO = sys.stdout) -> None:
+        self._out = out
+        self._lines: deque[str] = deque(maxlen=max_lines)
+        self._pending: list[str] = []
+        self._partial = ''
+        self._dirty = False
+        self._condition = threading.Condition()
+        self._size: os.terminal_size | None = None
+        self._thread: threading.Thread | None = None
+        self.interactive = out.isatty()
+        self.frame_interval = 1 / fps
+
+    def start(self) -> None:
+        if self.interactive:
+            _enable_ansi_on_windows()
+            self._redraw()
+            self._out.write(_move_to(self._size.lines))
+            self._out.flush()
+        self._thread = threading.Thread(target=self._run, name='renderer', daemon=True)
+        self._thread.start()
+
+    def add_message(self, message: str) -> None:
+        with self._condition:
+            self._pending.extend(message.splitlines() or [''])
+            self._dirty = True
+            self._condition.notify()
+
+    def set_partial(self, text: str) -> None:
+        if not self.interactive:
+            return
+        with self._condition:
+            self._partial = text
+            self._dirty = True
+            self._condition.notify()
+
+    def input(self, prompt: str) -> str:
+        """Reads a line on the prompt row, cleared first, whatever the previous input left on it."""
+        if self.interactive:
+            rows = self._terminal_size().lines
+            with self._condition:
+                self._out.write(_move_to(rows) + CLEAR_LINE)
+                self._out.flush()
+        return input(prompt)
+
+    def close(self) -> None:
+        """Gives the whole screen back to the terminal."""
+        if self.interactive:
+            with self._condition:
+                self._out.write(RESET_SCROLL_REGION + _move_to(self._terminal_size().lines) + '\n')
+                self._out.flush()
+
+    def _terminal_size(self) -> os.terminal_size:
+        return shutil.get_terminal_size()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._dirty)
+                self._dirty = False
+                pending, self._pending = self._pending, []
+                self._lines.extend(pending)
+                self._draw(pending)
+                self._out.flush()
+            time.sleep(self.frame_interval)
+
+    def _draw(self, pending: list[str]) -> None:
+        if not self.interactive:
+            self._out.write(''.join(f'{line}\n' for line in pending))
+            return
+        size = self._terminal_size()
+        # more new rows than fit the chat area only leave the newest ones on screen anyway
+        if size != self._size or len(pending) >= size.lines - 1:
+            self._redraw()
+            return
+        width = size.columns
+        rows = [row for line in pending for row in self._wrap(line, width)]
+        bottom = size.lines - 1
+        self._out.write(
+            SAVE_CURSOR
+            + _move_to(bottom) + '\r' + CLEAR_LINE
+            + ''.join(f'{row}\n' for row in rows)
+            + self._wrap(self._partial, width)[-1]
+            + RESTORE_CURSOR
+        )
+
+    def _redraw(self) -> None:
+        """Clears the screen and draws the newest messages that fit, e.g. after the terminal was resized."""
+        self._size = size = self._terminal_size()
+        width, bottom = size.columns, size.lines - 1
+        rows = deque(maxlen=bottom - 1)
+        for line in self._lines:
+            rows.extend(self._wrap(line, width))
+        self._out.write(
+            SAVE_CURSOR
+            + RESET_SCROLL_REGION + CLEAR_SCREEN
+            + f'\x1b[1;{bottom}r'
+            + _move_to(bottom - len(rows))
+            + ''.join(f'{row}\n' for row in rows)
+            + self._wrap(self._partial, width)[-1]
+            + RESTORE_CURSOR
+        )
+
+    @staticmethod
+    def _wrap(line: str, width: int) -> list[str]:
+        return [line[start:start + width] for start in range(0, len(line), width)] or ['']
@@ -0,0 +1,61 @@
+from socket_protocol.compression import (
+    CODECS,
+    Codec,
+    CompressionError,
+    PayloadCompressor,
+    ZlibCodec,
+    negotiate_codec,
+    register_codec
+)
+from socket_protocol.framing import (
+    MESSAGE_ID_SIZE,
+    FrameDecoder,
+    FrameError,
+    FrameType,
+    decode_batch,
+    decode_message,
+    encode_batch,
+    encode_frame,
+    encode_message,
+    frame_buffers,
+    send_buffers,
+    send_frames
+)
+from socket_protocol.session import (
+    LEGACY_PROTOCOL_VERSION,
+    PROTOCOL_VERSION,
+    SessionCipher,
+    encode_options,
+    parse_options,
+    unwrap_key,
+    wrap_key
+)
+
+__all__ = [
+    'CODECS',
+    'Codec',
+    'CompressionError',
+    'FrameDecoder',
+    'FrameError',
+    'FrameType',
+    'LEGACY_PROTOCOL_VERSION',
+    'MESSAGE_ID_SIZE',
+    'PROTOCOL_VERSION',
+    'PayloadCompressor',
+    'SessionCipher',
+    'ZlibCodec',
+    'decode_batch',
+    'decode_message',
+    'encode_batch',
+    'encode_frame',
+    'encode_message',
+    'encode_options',
+    'frame_buffers',
+    'negotiate_codec',
+    'parse_options',
+    'register_codec',
+    'send_buffers',
+    'send_frames',
+    'unwrap_key',
+    'wrap_key'
+]
@@ -0,0 +1,91 @@
+import zlib
+from collections.abc import Callable, Iterable
+from typing import Protocol
+
+from socket_protocol.framing import MAX_FRAME_SIZE
+
+_RAW = b'\x00'
+_COMPRESSED = b'\x01'
+
+
+class CompressionError(ValueError):
+    pass
+
+
+class Codec(Protocol):
+    name: str
+
+    def compress(self, data: bytes) -> bytes:
+        ...
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        """Raises ``CompressionError`` rather than inflate beyond ``max_size`` bytes."""
+        ...
+
+
+class ZlibCodec:
+    name = 'zlib'
+    __slots__ = ('level',)
+
+    def __init__(self, level: int | None = None) -> None:
+        self.level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        try:
+            inflated = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise CompressionError(str(e)) from e
+        if decompressor.unconsumed_tail:
+            raise CompressionError(f'Payload inflates beyond {max_size} bytes')
+        return inflated
+
+
+# codec name -> factory taking the compression level, ``None`` for the codec's default
+CODECS: dict[str, Callable[[int | None], Codec]] = {ZlibCodec.name: ZlibCodec}
+
+
+def register_codec(name: str, factory: Callable[[int | None], Codec]) -> None:
+    """Makes another codec negotiable, e.g. zstd where both ends have it installed."""
+    CODECS[name] = factory
+
+
+def negotiate_codec(offered: str, accepted: Iterable[str]) -> str | None:
+    """The first codec of the client's comma separated preferences that the server accepts and knows."""
+    accepted = set(accepted)
+    for name in offered.split(','):
+        if name in accepted and name in CODECS:
+            return name
+    return None
+
+
+class PayloadCompressor:
+    """
+    Once compression is negotiated every payload starts with a marker byte, telling whether the rest is compressed.
+    Only payloads of at least ``threshold`` bytes are compressed, and only kept compressed if that made them smaller.
+    Compression happens before encryption, ciphertext does not compress.
+    """
+    __slots__ = ('codec', 'threshold', 'max_size')
+
+    def __init__(self, codec: Codec, threshold: int = 0, max_size: int = MAX_FRAME_SIZE) -> None:
+        self.codec = codec
+        self.threshold = threshold
+        self.max_size = max_size
+
+    def pack(self, payload: bytes) -> bytes:
+        if len(payload) >= self.threshold:
+            compressed = self.codec.compress(payload)
+            if len(compressed) < len(payload):
+                return _COMPRESSED + compressed
+        return _RAW + payload
+
+    def unpack(self, payload: bytes) -> bytes:
+        marker, data = bytes(payload[:1]), payload[1:]
+        if marker == _RAW:
+            return bytes(data)
+        if marker == _COMPRESSED:
+            return self.codec.decompress(bytes(data), self.max_size)
+        raise CompressionError(f'Unknown compression marker {marker!r}')
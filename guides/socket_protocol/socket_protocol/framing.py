@@ -0,0 +1,160 @@
+import socket
+import struct
+import uuid
+from collections.abc import Iterable, Iterator
+from enum import IntEnum
+
+HEADER = struct.Struct('!IB')  # payload length, frame type
+BATCH_ENTRY = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+_INITIAL_BUFFER_SIZE = 64 * 1024
+_SENDMSG_MAX_BUFFERS = 512  # stays below IOV_MAX on every platform we run on
+MESSAGE_ID_SIZE = 16
+_NO_MESSAGE_ID = bytes(MESSAGE_ID_SIZE)
+
+
+class FrameType(IntEnum):
+    HANDSHAKE = 1
+    CHAT = 2
+    HISTORY_BATCH = 3
+    AI_REPLY = 4
+    AI_PARTIAL = 5
+
+
+_FRAME_TYPES = frozenset(FrameType)
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(frame_type: FrameType, payload: bytes) -> bytes:
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def encode_batch(entries: Iterable[bytes]) -> bytes:
+    """Packs several messages into one payload, so a history batch is encrypted and framed once."""
+    return b''.join(BATCH_ENTRY.pack(len(entry)) + entry for entry in entries)
+
+
+def decode_batch(payload: bytes) -> list[bytes]:
+    entries = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        (size,) = BATCH_ENTRY.unpack_from(view, offset)
+        offset += BATCH_ENTRY.size
+        entries.append(bytes(view[offset:offset + size]))
+        offset += size
+    return entries
+
+
+def encode_message(message_id: uuid.UUID | None, message: bytes) -> bytes:
+    """Prefixes a message with its 16 byte server id, zeros for messages that are not stored, e.g. notices."""
+    return (message_id.bytes if message_id is not None else _NO_MESSAGE_ID) + message
+
+
+def decode_message(payload: bytes) -> tuple[uuid.UUID | None, bytes]:
+    message_id = bytes(payload[:MESSAGE_ID_SIZE])
+    return (
+        uuid.UUID(bytes=message_id) if message_id != _NO_MESSAGE_ID else None,
+        bytes(payload[MESSAGE_ID_SIZE:])
+    )
+
+
+def frame_buffers(frames: Iterable[tuple[FrameType, bytes]]) -> list[bytes | memoryview]:
+    buffers = []
+    for frame_type, payload in frames:
+        buffers.append(HEADER.pack(len(payload), frame_type))
+        buffers.append(payload)
+    return buffers
+
+
+def send_buffers(
+        _socket: socket.socket,
+        buffers: list[bytes | memoryview]
+) -> None:
+    """
+    Writes all buffers with as few syscalls as possible:
+    scatter/gather ``sendmsg`` where available, one joined ``sendall`` otherwise (Windows).
+    """
+    if not hasattr(_socket, 'sendmsg'):
+        _socket.sendall(b''.join(buffers))
+        return
+    while buffers:
+        batch = buffers[:_SENDMSG_MAX_BUFFERS]
+        sent = _socket.sendmsg(batch)
+        consumed = 0
+        for buffer in batch:
+            if sent < len(buffer):
+                break
+            sent -= len(buffer)
+            consumed += 1
+        buffers = buffers[consumed:]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+
+def send_frames(
+        _socket: socket.socket,
+        frames: Iterable[tuple[FrameType, bytes]]
+) -> None:
+    send_buffers(_socket, frame_buffers(frames))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder over one reusable buffer.
+    Bytes are received straight into the buffer (``recv_into``) or copied in once (``feed``),
+    and complete frames are yielded as ``memoryview`` slices of it, without further copies.
+    A yielded payload is only valid until the next ``recv_into``/``feed``; keep ``bytes(payload)`` if needed.
+    """
+    __slots__ = ('_buffer', '_view', '_start', '_end', '_max_frame_size')
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE) -> None:
+        self._buffer = bytearray(_INITIAL_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._max_frame_size = max_frame_size
+
+    def _reserve(self, size: int) -> None:
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if len(self._buffer) - pending >= size:
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            buffer = bytearray(max(len(self._buffer) * 2, pending + size))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        self._start = 0
+        self._end = pending
+
+    def recv_into(self, _socket: socket.socket, size: int = _INITIAL_BUFFER_SIZE) -> int:
+        self._reserve(size)
+        received = _socket.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def feed(self, data: bytes) -> None:
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def __iter__(self) -> Iterator[tuple[FrameType, memoryview]]:
+        while self._end - self._start >= HEADER.size:
+            size, frame_type = HEADER.unpack_from(self._view, self._start)
+            if size > self._max_frame_size:
+                raise FrameError(f'Frame of {size} bytes exceeds {self._max_frame_size}')
+            if frame_type not in _FRAME_TYPES:
+                raise FrameError(f'Unknown frame type {frame_type}')
+            frame_end = self._start + HEADER.size + size
+            if frame_end > self._end:
+                return
+            payload = self._view[self._start + HEADER.size:frame_end]
+            self._start = frame_end
+            yield FrameType(frame_type), payload
+        if self._start == self._end:
+            self._start = self._end = 0
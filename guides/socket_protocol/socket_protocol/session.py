@@ -0,0 +1,101 @@
+import base64
+import itertools
+import threading
+
+import rsa
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from rsa import PrivateKey, PublicKey
+
+LEGACY_PROTOCOL_VERSION = 1
+PROTOCOL_VERSION = 2
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+_DIRECTION_SIZE = 4
+_COUNTER_SIZE = NONCE_SIZE - _DIRECTION_SIZE
+_REPLAY_WINDOW = 64
+
+
+def encode_options(**options: object) -> bytes:
+    return b':'.join(f'{key}={value}'.encode() for key, value in options.items())
+
+
+def parse_options(parts: list[bytes]) -> dict[str, str]:
+    options = {}
+    for part in parts:
+        key, _, value = part.decode().partition('=')
+        options[key] = value
+    return options
+
+
+def wrap_key(key: bytes, public_key: PublicKey) -> bytes:
+    return base64.b64encode(rsa.encrypt(key, public_key))
+
+
+def unwrap_key(wrapped_key: bytes, private_key: PrivateKey) -> bytes:
+    return rsa.decrypt(base64.b64decode(wrapped_key), private_key)
+
+
+class SessionCipher:
+    """
+    ChaCha20-Poly1305 channel for one connection.
+    Nonces are a direction prefix plus a send counter, so both sides can share one key,
+    and a sliding window on the receiving side rejects replayed messages.
+    Sealed messages are ``nonce || ciphertext || tag``.
+    """
+    __slots__ = (
+        '_aead',
+        '_send_prefix',
+        '_receive_prefix',
+        '_counter',
+        '_highest',
+        '_window',
+        '_lock'
+    )
+
+    def __init__(self, key: bytes, *, initiator: bool) -> None:
+        self._aead = ChaCha20Poly1305(key)
+        client_prefix = (0).to_bytes(_DIRECTION_SIZE, 'big')
+        server_prefix = (1).to_bytes(_DIRECTION_SIZE, 'big')
+        self._send_prefix, self._receive_prefix = (
+            (client_prefix, server_prefix) if initiator else (server_prefix, client_prefix)
+        )
+        self._counter = itertools.count()
+        self._highest = -1
+        self._window = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def generate_key() -> bytes:
+        return ChaCha20Poly1305.generate_key()
+
+    def seal(self, plaintext: bytes) -> bytes:
+        nonce = self._send_prefix + next(self._counter).to_bytes(_COUNTER_SIZE, 'big')
+        return nonce + self._aead.encrypt(nonce, plaintext, None)
+
+    def open(self, data: bytes) -> bytes:
+        nonce = bytes(data[:NONCE_SIZE])
+        if len(data) < NONCE_SIZE + TAG_SIZE or not nonce.startswith(self._receive_prefix):
+            raise ValueError('Malformed session message')
+        counter = int.from_bytes(nonce[_DIRECTION_SIZE:], 'big')
+        with self._lock:
+            self._check_replay(counter)
+            plaintext = self._aead.decrypt(nonce, bytes(data[NONCE_SIZE:]), None)
+            self._mark_seen(counter)
+        return plaintext
+
+    def _check_replay(self, counter: int) -> None:
+        if counter > self._highest:
+            return
+        offset = self._highest - counter
+        if offset >= _REPLAY_WINDOW or self._window & (1 << offset):
+            raise ValueError('Replayed session message')
+
+    def _mark_seen(self, counter: int) -> None:
+        if counter > self._highest:
+            shift = counter - self._highest
+            # a jump past the window leaves nothing of it, shifting by a peer-chosen counter would build a huge int
+            self._window = ((self._window << shift) | 1) & ((1 << _REPLAY_WINDOW) - 1) if shift < _REPLAY_WINDOW else 1
+            self._highest = counter
+        else:
+            self._window |= 1 << (self._highest - counter)
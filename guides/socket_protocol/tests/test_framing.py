@@ -0,0 +1,84 @@
+import socket
+
+import pytest
+
+from socket_protocol import FrameDecoder, FrameError, FrameType, decode_batch, encode_batch, encode_frame
+from socket_protocol.framing import HEADER
+
+
+def _frames(decoder: FrameDecoder) -> list[tuple[FrameType, bytes]]:
+    # payloads are views into the decoder's buffer, only valid until the next feed
+    return [(frame_type, bytes(payload)) for frame_type, payload in decoder]
+
+
+def test_decodes_several_frames_from_one_feed():
+    decoder = FrameDecoder()
+    decoder.feed(encode_frame(FrameType.CHAT, b'hello') + encode_frame(FrameType.AI_REPLY, b''))
+
+    assert _frames(decoder) == [(FrameType.CHAT, b'hello'), (FrameType.AI_REPLY, b'')]
+    assert _frames(decoder) == []
+
+
+def test_waits_for_the_rest_of_a_split_frame():
+    data = encode_frame(FrameType.CHAT, b'first') + encode_frame(FrameType.CHAT, b'second')
+    decoder = FrameDecoder()
+    frames = []
+    for offset in range(len(data)):
+        decoder.feed(data[offset:offset + 1])
+        frames += _frames(decoder)
+
+    assert frames == [(FrameType.CHAT, b'first'), (FrameType.CHAT, b'second')]
+
+
+def test_grows_its_buffer_for_frames_larger_than_it():
+    payload = bytes(range(256)) * 1024
+    data = encode_frame(FrameType.HISTORY_BATCH, payload)
+    decoder = FrameDecoder()
+    frames = []
+    for offset in range(0, len(data), 10_000):
+        decoder.feed(data[offset:offset + 10_000])
+        frames += _frames(decoder)
+
+    assert frames == [(FrameType.HISTORY_BATCH, payload)]
+
+
+def test_rejects_an_oversize_length_before_its_payload_arrives():
+    decoder = FrameDecoder(max_frame_size=1024)
+    decoder.feed(HEADER.pack(1025, FrameType.CHAT))
+
+    with pytest.raises(FrameError):
+        _frames(decoder)
+
+
+def test_accepts_a_frame_of_exactly_the_maximum_size():
+    decoder = FrameDecoder(max_frame_size=1024)
+    decoder.feed(encode_frame(FrameType.CHAT, b'x' * 1024))
+
+    assert _frames(decoder) == [(FrameType.CHAT, b'x' * 1024)]
+
+
+def test_rejects_an_unknown_frame_type():
+    decoder = FrameDecoder()
+    decoder.feed(HEADER.pack(0, 99))
+
+    with pytest.raises(FrameError):
+        _frames(decoder)
+
+
+def test_receives_straight_from_a_socket():
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        sender.sendall(encode_frame(FrameType.CHAT, b'over the wire')[:7])
+        decoder = FrameDecoder()
+        decoder.recv_into(receiver)
+        assert _frames(decoder) == []
+
+        sender.sendall(encode_frame(FrameType.CHAT, b'over the wire')[7:])
+        decoder.recv_into(receiver)
+        assert _frames(decoder) == [(FrameType.CHAT, b'over the wire')]
+
+
+def test_batch_round_trip():
+    entries = [b'one', b'', b'three' * 100]
+
+    assert decode_batch(encode_batch(entries)) == entries
@@ -0,0 +1,105 @@
+import itertools
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from socket_protocol import SessionCipher
+from socket_protocol.session import _REPLAY_WINDOW
+
+
+@pytest.fixture
+def ciphers() -> tuple[SessionCipher, SessionCipher]:
+    """The client and the server end of one session."""
+    key = SessionCipher.generate_key()
+    return SessionCipher(key, initiator=True), SessionCipher(key, initiator=False)
+
+
+def test_both_directions_round_trip(ciphers):
+    client, server = ciphers
+
+    assert server.open(client.seal(b'from the client')) == b'from the client'
+    assert client.open(server.seal(b'from the server')) == b'from the server'
+
+
+def test_directions_use_distinct_nonces(ciphers):
+    client, server = ciphers
+    sealed = client.seal(b'hello')
+
+    assert sealed[:12] != server.seal(b'hello')[:12]
+    # a message reflected back to its sender is not accepted as the peer's
+    with pytest.raises(ValueError):
+        client.open(sealed)
+
+
+def test_rejects_a_replayed_message(ciphers):
+    client, server = ciphers
+    sealed = client.seal(b'once')
+    server.open(sealed)
+
+    with pytest.raises(ValueError):
+        server.open(sealed)
+
+
+def test_accepts_reordered_messages_within_the_window(ciphers):
+    client, server = ciphers
+    sealed = [client.seal(f'{counter}'.encode()) for counter in range(3)]
+
+    assert [server.open(sealed[index]) for index in (2, 0, 1)] == [b'2', b'0', b'1']
+    with pytest.raises(ValueError):
+        server.open(sealed[0])
+
+
+def test_rejects_messages_older_than_the_window(ciphers):
+    client, server = ciphers
+    oldest = client.seal(b'late')
+    for _ in range(_REPLAY_WINDOW):
+        server.open(client.seal(b'newer'))
+
+    with pytest.raises(ValueError):
+        server.open(oldest)
+
+
+def test_a_counter_far_ahead_restarts_the_window(ciphers):
+    client, server = ciphers
+    earlier = client.seal(b'earlier')
+    client._counter = itertools.count(2 ** 63)
+    server.open(client.seal(b'far ahead'))
+
+    assert server._window == 1
+    assert server.open(client.seal(b'next')) == b'next'
+    with pytest.raises(ValueError):
+        server.open(earlier)
+
+
+def test_rejects_a_tampered_tag_without_consuming_its_counter(ciphers):
+    client, server = ciphers
+    sealed = client.seal(b'hello')
+    tampered = sealed[:-1] + bytes([sealed[-1] ^ 1])
+
+    with pytest.raises(InvalidTag):
+        server.open(tampered)
+    assert server.open(sealed) == b'hello'
+
+
+def test_rejects_a_tampered_ciphertext(ciphers):
+    client, server = ciphers
+    sealed = bytearray(client.seal(b'hello'))
+    sealed[12] ^= 1
+
+    with pytest.raises(InvalidTag):
+        server.open(bytes(sealed))
+
+
+def test_rejects_a_message_shorter_than_nonce_and_tag(ciphers):
+    _, server = ciphers
+
+    with pytest.raises(ValueError):
+        server.open(bytes(27))
+
+
+def test_rejects_another_sessions_key(ciphers):
+    client, _ = ciphers
+    other_server = SessionCipher(SessionCipher.generate_key(), initiator=False)
+
+    with pytest.raises(InvalidTag):
+        other_server.open(client.seal(b'hello'))
@@ -0,0 +1,168 @@
+"""
+Bytes on the wire and CPU per message with and without negotiated payload compression.
+
+Four kinds of payloads: short chat lines, pasted code (this repository's own sources),
+long prose standing in for Gemma answers (standard library docstrings), and history batches of chat lines.
+Wire bytes are frame header plus sealed payload, as a protocol 2 client receives them.
+The fan-out part relays each payload to ``--recipients`` clients: one seal per recipient,
+plus one shared compression per payload, which the other recipients get from the compressor's cache.
+
+    python -m benchmarks.compression --recipients 50 --threshold 512 --level 6
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+import zlib
+from collections.abc import Callable
+from pathlib import Path
+
+from socket_protocol import (
+    CODECS,
+    PayloadCompressor,
+    SessionCipher,
+    encode_batch,
+    encode_message
+)
+from socket_protocol.framing import HEADER
+
+from benchmarks.harness import SERVER_DIR
+from core.compression import SharedCompressor
+
+_WORDS = (
+    'the', 'server', 'room', 'message', 'ok', 'lunch', 'deploy', 'why', 'is', 'it', 'broken', 'again', 'works',
+    'for', 'me', 'see', 'logs', 'at', 'noon', 'thanks', 'who', 'has', 'the', 'key', 'gemma', 'please', 'restart'
+)
+
+
+def _chat_lines(count: int, rng: random.Random) -> list[bytes]:
+    return [
+        f'user{rng.randrange(50)}: {" ".join(rng.choices(_WORDS, k=rng.randint(2, 14)))}'.encode()
+        for _ in range(count)
+    ]
+
+
+def _pastes(count: int, rng: random.Random) -> list[bytes]:
+    sources = [path.read_bytes() for path in sorted(SERVER_DIR.rglob('*.py')) if path.stat().st_size > 8192]
+    pastes = []
+    for _ in range(count):
+        source = rng.choice(sources)
+        start = rng.randrange(len(source) - 8192)
+        pastes.append(b'user1: ' + source[start:start + rng.randint(1024, 8192)])
+    return pastes
+
+
+def _answers(count: int, rng: random.Random) -> list[bytes]:
+    prose = [
+        doc for module in (asyncio, json, socket, threading, zlib, inspect, random, Path)
+        for _, member in inspect.getmembers(module)
+        if (doc := inspect.getdoc(member)) and len(doc) > 1500
+    ]
+    return [f'Gemma: {rng.choice(prose)}'.encode() for _ in range(count)]
+
+
+def _history_batches(count: int, batch_size: int, rng: random.Random) -> list[bytes]:
+    # as a client that asked for message ids receives them
+    return [
+        encode_batch([encode_message(uuid.uuid4(), line) for line in _chat_lines(batch_size, rng)])
+        for _ in range(count)
+    ]
+
+
+def _per_message_us(operation: Callable[[bytes], object], payloads: list[bytes], rounds: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        for payload in payloads:
+            operation(payload)
+    return (time.perf_counter() - started_at) / (rounds * len(payloads)) * 1e6
+
+
+def _wire_bytes(cipher: SessionCipher, payloads: list[bytes]) -> int:
+    return sum(HEADER.size + len(cipher.seal(payload)) for payload in payloads)
+
+
+def measure(
+        kind: str,
+        payloads: list[bytes],
+        compressor: PayloadCompressor,
+        recipients: int,
+        cache_size: int,
+        rounds: int
+) -> dict:
+    cipher = SessionCipher(SessionCipher.generate_key(), initiator=False)
+    packed = [compressor.pack(payload) for payload in payloads]
+    raw_wire = _wire_bytes(cipher, payloads)
+    compressed_wire = _wire_bytes(cipher, packed)
+    # fresh per measurement, so the first recipient of every payload pays the compression
+    shared = SharedCompressor(compressor.codec, compressor.threshold, cache_size, cache_bytes=1 << 30)
+
+    def relay_raw(payload: bytes) -> None:
+        for _ in range(recipients):
+            cipher.seal(payload)
+
+    def relay_compressed(payload: bytes) -> None:
+        for _ in range(recipients):
+            cipher.seal(shared.pack(payload))
+
+    relay_raw_us = _per_message_us(relay_raw, payloads, 1)
+    relay_compressed_us = _per_message_us(relay_compressed, payloads, 1)
+    return {
+        'kind': kind,
+        'messages': len(payloads),
+        'mean_bytes': round(sum(map(len, payloads)) / len(payloads)),
+        'compressed_share': round(sum(payload[:1] == b'\x01' for payload in packed) / len(packed), 3),
+        'wire_bytes_per_message': round(raw_wire / len(payloads)),
+        'wire_bytes_per_message_compressed': round(compressed_wire / len(payloads)),
+        'wire_saved': round(1 - compressed_wire / raw_wire, 3),
+        'pack_us': round(_per_message_us(compressor.pack, payloads, rounds), 2),
+        'unpack_us': round(_per_message_us(compressor.unpack, packed, rounds), 2),
+        'fan_out_recipients': recipients,
+        'fan_out_us': round(relay_raw_us, 2),
+        'fan_out_us_compressed': round(relay_compressed_us, 2),
+        'fan_out_wire_bytes_saved': round((raw_wire - compressed_wire) / len(payloads) * recipients)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--codec', default='zlib', choices=sorted(CODECS))
+    parser.add_argument('--level', type=int, default=None)
+    parser.add_argument('--threshold', type=int, default=512)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--recipients', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', type=Path, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    compressor = PayloadCompressor(CODECS[args.codec](args.level), args.threshold)
+    corpora = {
+        'chat': _chat_lines(args.messages, rng),
+        'paste': _pastes(args.messages, rng),
+        'gemma_answer': _answers(args.messages, rng),
+        'history_batch': _history_batches(max(args.messages // 10, 1), args.batch_size, rng)
+    }
+    results = {
+        'codec': args.codec,
+        'level': args.level,
+        'threshold': args.threshold,
+        'results': [
+            measure(kind, payloads, compressor, args.recipients, args.messages, args.rounds)
+            for kind, payloads in corpora.items()
+        ]
+    }
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output is not None:
+        args.output.write_text(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Helpers shared by the benchmarks that run real server processes."""
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+
+
+def start_server(workdir: Path, port: int, **settings: object) -> subprocess.Popen:
+    """Starts ``main.py`` in ``workdir`` with ``settings`` passed as ``SOCKET_SERVER_*`` variables, logging to a file."""
+    env = os.environ | {'SOCKET_SERVER_PORT': str(port)} | {
+        f'SOCKET_SERVER_{name.upper()}': str(value)
+        for name, value in settings.items()
+    }
+    with open(workdir / f'server-{port}.log', 'wb') as log:
+        return subprocess.Popen(
+            [sys.executable, str(SERVER_DIR / 'main.py')],
+            cwd=workdir,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT
+        )
+
+
+def wait_for_port(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.2)
+    raise TimeoutError(f'Server on port {port} did not start')
+
+
+def stop_servers(servers: list[subprocess.Popen]) -> None:
+    for server in servers:
+        server.terminate()
+        server.wait()
+
+
+def percentiles(values: list[float]) -> dict[str, float | int]:
+    """Summary of latencies in seconds, reported in milliseconds."""
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+
+    def at(percentile: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * percentile))] * 1000, 3)
+
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3),
+        'p50_ms': at(0.50),
+        'p95_ms': at(0.95),
+        'p99_ms': at(0.99),
+        'max_ms': round(values[-1] * 1000, 3)
+    }
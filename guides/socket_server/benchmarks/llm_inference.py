@@ -0,0 +1,101 @@
+"""
+Generation throughput and peak memory of ``GemmaService`` per device/precision mode.
+
+Every mode runs in a fresh interpreter, so the peak RSS of one mode does not hide the next one.
+Each run loads the model, generates exactly ``--new-tokens`` tokens for a batch of prompts
+after one warm-up call, and reports tokens/sec and the process' peak RSS.
+
+    python -m benchmarks.llm_inference --device cpu --precisions float32 bfloat16 int8 --threads 8
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+PROMPT = 'Explain in a few sentences why the sky is blue.'
+
+
+def _peak_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_mode(args: argparse.Namespace) -> dict:
+    import torch
+    from core.gemma.service import GemmaService
+
+    started_at = time.perf_counter()
+    service = GemmaService(
+        device=args.device,
+        precision=args.precision,
+        threads=args.threads,
+        interop_threads=args.interop_threads
+    )
+    service.load()
+    load_seconds = time.perf_counter() - started_at
+
+    inputs = service.tokenizer([PROMPT] * args.batch_size, return_tensors='pt', padding=True).to(service.model.device)
+
+    def generate(new_tokens: int) -> None:
+        with torch.inference_mode():
+            service.model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens)
+
+    generate(4)
+    started_at = time.perf_counter()
+    for _ in range(args.repeats):
+        generate(args.new_tokens)
+    seconds = time.perf_counter() - started_at
+    return {
+        'device': service.device,
+        'precision': service.precision,
+        'threads': torch.get_num_threads(),
+        'batch_size': args.batch_size,
+        'load_seconds': round(load_seconds, 2),
+        'tokens_per_second': round(args.batch_size * args.new_tokens * args.repeats / seconds, 2),
+        'peak_rss_mib': round(_peak_rss_mib(), 1)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='auto', choices=['auto', 'cpu', 'cuda'])
+    parser.add_argument('--precisions', nargs='+', default=['float32', 'bfloat16', 'int8'])
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--interop-threads', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--new-tokens', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--precision', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.precision is not None:
+        print(json.dumps(run_mode(args)))
+        return
+
+    forwarded = [
+        '--device', args.device,
+        '--batch-size', str(args.batch_size),
+        '--new-tokens', str(args.new_tokens),
+        '--repeats', str(args.repeats)
+    ]
+    if args.threads is not None:
+        forwarded += ['--threads', str(args.threads)]
+    if args.interop_threads is not None:
+        forwarded += ['--interop-threads', str(args.interop_threads)]
+    for precision in args.precisions:
+        completed = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.llm_inference', *forwarded, '--precision', precision],
+            capture_output=True,
+            text=True
+        )
+        if completed.returncode:
+            print(json.dumps({'precision': precision, 'error': completed.stderr.strip().splitlines()[-1:]}))
+            continue
+        print(completed.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    main()
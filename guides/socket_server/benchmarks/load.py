@@ -0,0 +1,317 @@
+"""
+Latency and throughput of one server under synthetic load.
+
+Starts a server with the echo LLM backend in a fresh directory and connects ``--clients`` headless clients
+doing the same handshake as ``socket_client``. The run has four phases:
+
+* seeding: one client sends ``--history`` messages, so every later client has history to sync
+* handshake and history sync: all clients connect at once, sync is timed from the handshake answer
+  until the last seeded message arrived
+* fan-out: every client sends ``--rate`` messages/sec for ``--duration`` seconds,
+  latency is timed from the send until each room member, the sender included, received it
+* AI round trip: every client asks ``--ai-questions`` unique questions one after another,
+  timed until the final ``AI_REPLY`` frame
+
+Prints the summary as JSON, ``--output`` also writes it to a file so runs can be compared.
+
+    python -m benchmarks.load --clients 50 --rate 5 --duration 10 --server-mode asyncio
+"""
+import argparse
+import json
+import socket
+import tempfile
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import rsa
+from rsa import PrivateKey, PublicKey, common
+from socket_protocol import (
+    PROTOCOL_VERSION,
+    FrameDecoder,
+    FrameType,
+    SessionCipher,
+    decode_batch,
+    encode_frame,
+    encode_options,
+    parse_options,
+    send_frames,
+    unwrap_key
+)
+
+from benchmarks.harness import percentiles, start_server, stop_servers, wait_for_port
+
+SIGN_MESSAGE_PREFIX = b'PUBLIC_KEY:'
+PEM_END = b'-----END RSA PUBLIC KEY-----\n'
+
+
+class LoadClient:
+    """A headless chat client that timestamps everything it receives on a reader thread."""
+
+    def __init__(self, name: str, keys: tuple[PublicKey, PrivateKey], protocol: int) -> None:
+        self.name = name
+        self.public_key, self.private_key = keys
+        self.protocol = protocol
+        self.socket: socket.socket | None = None
+        self.decoder: FrameDecoder | None = None
+        self.cipher: SessionCipher | None = None
+        self.server_public_key: PublicKey | None = None
+        self.handshake_seconds = 0.0
+        self.answered_at = 0.0
+        self.history_expected = 0
+        self.history_received = 0
+        self.history_done = threading.Event()
+        self.sync_seconds: float | None = None
+        self.seeded = 0
+        # (sender, sequence number, received at)
+        self.deliveries: list[tuple[str, int, float]] = []
+        self.replies: dict[int, float] = {}
+        self.round_trips: list[float] = []
+        self.rejected = 0
+        self.reply_arrived = threading.Event()
+        # protocol 1 blocks that arrived with the handshake answer
+        self._buffer = b''
+        self._reader: threading.Thread | None = None
+
+    def connect(self, port: int, history_expected: int) -> None:
+        self.history_expected = history_expected
+        if not history_expected:
+            self.history_done.set()
+        started = time.perf_counter()
+        self.socket = socket.create_connection(('localhost', port))
+        request = SIGN_MESSAGE_PREFIX + self.public_key.save_pkcs1() + f':{self.name}'.encode()
+        if self.protocol >= PROTOCOL_VERSION:
+            request = encode_frame(FrameType.HANDSHAKE, request + b':' + encode_options(proto=PROTOCOL_VERSION))
+            self.decoder = FrameDecoder()
+        self.socket.sendall(request)
+        answer = self._receive_handshake()
+        self.answered_at = time.perf_counter()
+        self.handshake_seconds = self.answered_at - started
+        _, server_public_key, *options = answer.split(b':')
+        self.server_public_key = PublicKey.load_pkcs1(server_public_key.replace(b'\\n', b'\n'))
+        if 'key' in (server_options := parse_options(options)):
+            self.cipher = SessionCipher(unwrap_key(server_options['key'].encode(), self.private_key), initiator=True)
+        self._reader = threading.Thread(target=self._read, name=f'{self.name}-reader', daemon=True)
+        self._reader.start()
+
+    def _receive_handshake(self) -> bytes:
+        if self.decoder is None:
+            data = b''
+            while PEM_END not in data:
+                if not (received := self.socket.recv(4096)):
+                    raise ConnectionResetError('Connection closed during handshake')
+                data += received
+            answer, _, self._buffer = data.partition(PEM_END)
+            return answer + PEM_END
+        while True:
+            for _, payload in self.decoder:
+                return bytes(payload)
+            if not self.decoder.recv_into(self.socket):
+                raise ConnectionResetError('Connection closed during handshake')
+
+    def send(self, message: bytes) -> None:
+        if self.cipher is None:
+            self.socket.sendall(rsa.encrypt(message, self.server_public_key))
+            return
+        send_frames(self.socket, [(FrameType.CHAT, self.cipher.seal(message))])
+
+    def _messages(self) -> Iterator[tuple[FrameType, bytes]]:
+        if self.decoder is None:
+            block_size = common.byte_size(self.private_key.n)
+            while True:
+                while len(self._buffer) >= block_size:
+                    block, self._buffer = self._buffer[:block_size], self._buffer[block_size:]
+                    yield FrameType.CHAT, rsa.decrypt(block, self.private_key)
+                if not (data := self.socket.recv(65536)):
+                    return
+                self._buffer += data
+        while True:
+            for frame_type, payload in self.decoder:
+                message = self.cipher.open(payload)
+                if frame_type == FrameType.HISTORY_BATCH:
+                    for history_message in decode_batch(message):
+                        yield FrameType.CHAT, history_message
+                else:
+                    yield frame_type, message
+            if not self.decoder.recv_into(self.socket):
+                return
+
+    def _read(self) -> None:
+        try:
+            for frame_type, message in self._messages():
+                received_at = time.perf_counter()
+                if frame_type == FrameType.AI_REPLY:
+                    self._on_reply(message, received_at)
+                elif frame_type == FrameType.CHAT:
+                    self._on_chat(message, received_at)
+        except OSError:
+            pass
+
+    def _on_chat(self, message: bytes, received_at: float) -> None:
+        if not self.history_done.is_set():
+            self.history_received += 1
+            if self.history_received >= self.history_expected:
+                self.sync_seconds = received_at - self.answered_at
+                self.history_done.set()
+            return
+        sender, _, text = message.decode().partition(': ')
+        if sender == 'Gemma' and self.decoder is None:
+            # protocol 1 gets replies as chat messages
+            self._on_reply(message, received_at)
+        elif text.startswith('m '):
+            self.deliveries.append((sender, int(text[2:]), received_at))
+        elif text.startswith('h '):
+            self.seeded += 1
+
+    def _on_reply(self, message: bytes, received_at: float) -> None:
+        # the echo backend answers with the question, ``Gemma q <client name> <sequence number>``
+        words = message.decode().split()
+        if words[1:4] == ['Gemma', 'q', self.name] and words[4:] and words[4].isdigit():
+            self.replies[int(words[4])] = received_at
+        else:
+            self.rejected += 1
+        self.reply_arrived.set()
+
+    def send_at_rate(self, rate: float, duration: float, sent: dict[tuple[str, int], float]) -> None:
+        started = time.perf_counter()
+        for sequence in range(int(rate * duration)):
+            delay = started + sequence / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sent[(self.name, sequence)] = time.perf_counter()
+            self.send(f'm {sequence}'.encode())
+
+    def ask(self, questions: int, timeout: float) -> None:
+        for sequence in range(questions):
+            self.reply_arrived.clear()
+            asked_at = time.perf_counter()
+            # with the name, no question is answered from the answer cache
+            self.send(f'Gemma q {self.name} {sequence}'.encode())
+            if not self.reply_arrived.wait(timeout):
+                break
+            if sequence in self.replies:
+                self.round_trips.append(self.replies[sequence] - asked_at)
+
+    def close(self) -> None:
+        if self.socket is not None:
+            self.socket.close()
+
+
+def _run_all(targets: list[threading.Thread]) -> None:
+    for thread in targets:
+        thread.start()
+    for thread in targets:
+        thread.join()
+
+
+def run(args: argparse.Namespace, workdir: Path) -> dict:
+    with ProcessPoolExecutor() as executor:
+        keys = list(executor.map(rsa.newkeys, [args.key_length] * (args.clients + 1)))
+    clients = [LoadClient(f'load{index}', keys[index], args.protocol) for index in range(args.clients)]
+    seeder = LoadClient('seeder', keys[-1], args.protocol)
+    settings = dict(server_mode=args.server_mode, llm_backend='echo', gemma_streaming=False) | dict(
+        setting.split('=', 1) for setting in args.set
+    )
+    server = start_server(workdir, args.port, **settings)
+    try:
+        wait_for_port(args.port, args.timeout)
+        seeder.connect(args.port, history_expected=0)
+        for sequence in range(args.history):
+            seeder.send(f'h {sequence}'.encode())
+        # the seeder gets its own messages back once they are stored
+        deadline = time.monotonic() + args.timeout
+        while seeder.seeded < args.history and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        _run_all([threading.Thread(target=client.connect, args=(args.port, args.history)) for client in clients])
+        synced = all(client.history_done.wait(args.timeout) for client in clients)
+
+        sent: dict[tuple[str, int], float] = {}
+        load_started = time.perf_counter()
+        _run_all([
+            threading.Thread(target=client.send_at_rate, args=(args.rate, args.duration, sent))
+            for client in clients
+        ])
+        send_seconds = time.perf_counter() - load_started
+        expected = len(sent)
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline and any(len(client.deliveries) < expected for client in clients):
+            time.sleep(0.1)
+        fan_out = [
+            received_at - sent[(sender, sequence)]
+            for client in clients
+            for sender, sequence, received_at in client.deliveries
+            if (sender, sequence) in sent
+        ]
+        last_delivery = max((received_at for client in clients for *_, received_at in client.deliveries), default=0.0)
+
+        _run_all([threading.Thread(target=client.ask, args=(args.ai_questions, args.timeout)) for client in clients])
+    finally:
+        for client in [seeder, *clients]:
+            client.close()
+        stop_servers([server])
+
+    deliveries = sum(len(client.deliveries) for client in clients)
+    return {
+        'config': {
+            'clients': args.clients,
+            'protocol': args.protocol,
+            'server_mode': args.server_mode,
+            'rate_per_client': args.rate,
+            'duration': args.duration,
+            'history': args.history,
+            'ai_questions': args.ai_questions,
+            'settings': settings
+        },
+        'handshake': percentiles([client.handshake_seconds for client in clients]),
+        'history_sync': percentiles([client.sync_seconds for client in clients if client.sync_seconds is not None])
+        | {'complete': synced},
+        'fan_out': percentiles(fan_out),
+        'ai_round_trip': percentiles([seconds for client in clients for seconds in client.round_trips])
+        | {'rejected': sum(client.rejected for client in clients)},
+        'throughput': {
+            'sent': expected,
+            'sent_per_second': round(expected / send_seconds, 2) if send_seconds else 0,
+            'delivered': deliveries,
+            'missing': expected * len(clients) - deliveries,
+            'delivered_per_second': (
+                round(deliveries / (last_delivery - load_started), 2) if last_delivery > load_started else 0
+            )
+        }
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=5.0, help='messages/sec per client')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of fan-out load')
+    parser.add_argument('--history', type=int, default=200, help='messages to seed before the clients connect')
+    parser.add_argument('--ai-questions', type=int, default=3, help='questions per client')
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=PROTOCOL_VERSION)
+    parser.add_argument('--key-length', type=int, default=1024, help='client RSA key length')
+    parser.add_argument('--server-mode', choices=('threaded', 'asyncio'), default='threaded')
+    parser.add_argument(
+        '--set',
+        action='append',
+        default=[],
+        metavar='NAME=VALUE',
+        help='any other server setting, e.g. --set outbound_queue_size=1024'
+    )
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--output', type=Path, help='also write the JSON summary to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run(args, Path(workdir))
+    summary = json.dumps(results, indent=2)
+    print(summary)
+    if args.output is not None:
+        args.output.write_text(summary)
+
+
+if __name__ == '__main__':
+    main()
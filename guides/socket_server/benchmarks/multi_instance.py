@@ -0,0 +1,153 @@
+"""
+Checks fan-out between server instances sharing one database through the ``ipc`` broker.
+
+Starts ``--instances`` servers on consecutive ports in a fresh directory, connects one protocol 2 client to each,
+lets every client send ``--messages`` messages and verifies that every client received every message exactly once.
+Prints a JSON summary and exits with status 1 on a missing or duplicated message.
+
+    python -m benchmarks.multi_instance --instances 3 --messages 20
+"""
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import rsa
+from socket_protocol import (
+    FrameDecoder,
+    FrameType,
+    SessionCipher,
+    encode_frame,
+    encode_options,
+    parse_options,
+    send_frames,
+    unwrap_key
+)
+
+from benchmarks.harness import start_server, stop_servers, wait_for_port
+
+
+def start_instance(workdir: Path, port: int, broker_port: int) -> subprocess.Popen:
+    return start_server(
+        workdir,
+        port,
+        broker_backend='ipc',
+        broker_port=broker_port,
+        llm_backend='disabled',
+        crypto_workers=0
+    )
+
+
+class Client:
+    def __init__(self, port: int, name: str) -> None:
+        public_key, private_key = rsa.newkeys(1024)
+        self.name = name
+        self.socket = socket.create_connection(('localhost', port))
+        self.socket.sendall(
+            encode_frame(
+                FrameType.HANDSHAKE,
+                b'PUBLIC_KEY:' + public_key.save_pkcs1() + b':' + name.encode() + b':' + encode_options(proto=2)
+            )
+        )
+        self.decoder = FrameDecoder()
+        answer = None
+        while answer is None:
+            self.decoder.recv_into(self.socket)
+            for _, payload in self.decoder:
+                answer = bytes(payload)
+        _, _, *options = answer.split(b':')
+        session_key = unwrap_key(parse_options(options)['key'].encode(), private_key)
+        self.cipher = SessionCipher(session_key, initiator=True)
+        self.received: Counter[bytes] = Counter()
+
+    def send(self, messages: list[bytes]) -> None:
+        send_frames(self.socket, [(FrameType.CHAT, self.cipher.seal(message)) for message in messages])
+
+    def receive(self, expected: int, timeout: float) -> None:
+        self.socket.settimeout(timeout)
+        try:
+            while sum(self.received.values()) < expected and self.decoder.recv_into(self.socket):
+                for frame_type, payload in self.decoder:
+                    if frame_type == FrameType.CHAT:
+                        self.received[self.cipher.open(payload)] += 1
+            # anything beyond the expected messages would be a duplicate
+            self.socket.settimeout(0.5)
+            while self.decoder.recv_into(self.socket):
+                for frame_type, payload in self.decoder:
+                    if frame_type == FrameType.CHAT:
+                        self.received[self.cipher.open(payload)] += 1
+        except TimeoutError:
+            pass
+
+
+def check_fan_out(instances: int, messages: int, port: int, broker_port: int, timeout: float) -> dict:
+    """Runs the check on ``instances`` servers from ``port`` on, ``ok`` tells whether every message arrived once."""
+    ports = [port + index for index in range(instances)]
+    servers = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            # the first instance generates the keys and the database the others share
+            servers.append(start_instance(Path(workdir), ports[0], broker_port))
+            wait_for_port(ports[0], timeout)
+            servers += [start_instance(Path(workdir), instance_port, broker_port) for instance_port in ports[1:]]
+            for instance_port in ports[1:]:
+                wait_for_port(instance_port, timeout)
+            clients = [Client(instance_port, f'client{index}') for index, instance_port in enumerate(ports)]
+            # lets every instance reach the broker hub before anyone publishes
+            time.sleep(2)
+            expected = Counter(
+                f'{client.name}: {index}'.encode()
+                for client in clients
+                for index in range(messages)
+            )
+            receivers = [
+                threading.Thread(target=client.receive, args=(sum(expected.values()), timeout))
+                for client in clients
+            ]
+            for receiver in receivers:
+                receiver.start()
+            for client in clients:
+                client.send([str(index).encode() for index in range(messages)])
+            for receiver in receivers:
+                receiver.join()
+        finally:
+            stop_servers(servers)
+    results = {
+        client.name: {
+            'received': sum(client.received.values()),
+            'missing': sum((expected - client.received).values()),
+            'duplicates': sum((client.received - expected).values())
+        }
+        for client in clients
+    }
+    return {
+        'instances': instances,
+        'messages_per_client': messages,
+        'expected_per_client': sum(expected.values()),
+        'clients': results,
+        'ok': all(not result['missing'] and not result['duplicates'] for result in results.values())
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--instances', type=int, default=3)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--broker-port', type=int, default=9099)
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args()
+
+    results = check_fan_out(args.instances, args.messages, args.port, args.broker_port, args.timeout)
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if results['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
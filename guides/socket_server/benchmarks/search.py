@@ -0,0 +1,165 @@
+"""
+Latency of ``/search`` on a generated chat history, against decrypting and scanning the table.
+
+Generates ``--messages`` messages over ``--rooms`` rooms in a fresh database, words drawn from a Zipf-like
+vocabulary, and stores them through ``MessageHandler.upsert_instances``, which indexes them in the same transaction.
+Queries run per kind: rare, medium and common words, two medium words, a phrase of two common words,
+and a common word's tenth page. ``index`` is the ranked page of ids plus the match count,
+``command`` the whole ``/search`` answer, including reading and decrypting the page.
+The scan baseline decrypts ``--scan-sample`` messages and extrapolates to a million.
+With ``--workdir`` the database is kept, and reused by the next run asking for as many messages.
+
+    python -m benchmarks.search --messages 1000000 --rooms 10 --queries 50 --workdir /tmp/search-bench
+"""
+import argparse
+import json
+import os
+import random
+import string
+import tempfile
+import time
+import uuid
+from collections.abc import Callable
+from pathlib import Path
+
+from benchmarks.harness import percentiles
+
+
+def _vocabulary(size: int, rng: random.Random) -> list[str]:
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+def _timed(operation: Callable[[], object], repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - started_at)
+    return timings
+
+
+def run(args: argparse.Namespace, workdir: Path) -> dict:
+    # configured through the environment by ``main``, so imported only now
+    from sqlmodel import Session, func, select
+
+    from core.crypto.storage import open_content, seal_content
+    from core.handlers import MessageHandler, UserHandler
+    from core.models import ContentScheme, Message, User
+    from core.search.commands import SearchCommand
+    from core.search.index import message_search
+    from session import engine
+
+    rng = random.Random(args.seed)
+    vocabulary = _vocabulary(args.vocabulary, rng)
+    cumulative_weights, total = [], 0.0
+    for rank in range(len(vocabulary)):
+        total += 1 / (rank + 1)
+        cumulative_weights.append(total)
+    room_ids = [uuid.UUID(int=rng.getrandbits(128)) for _ in range(args.rooms)]
+
+    with Session(engine) as session:
+        stored = session.exec(select(func.count()).select_from(Message)).one()
+    store_seconds = 0.0
+    if stored < args.messages:
+        user = UserHandler.upsert_instance(instance=User(name='bench', public_key=b'', fingerprint='bench'))
+        for start in range(stored, args.messages, args.batch_size):
+            batch = [
+                Message(
+                    user_id=user.id,
+                    user_name=user.name,
+                    room_id=rng.choice(room_ids),
+                    content=seal_content(' '.join(
+                        rng.choices(vocabulary, cum_weights=cumulative_weights, k=rng.randint(3, 15))
+                    ).encode()),
+                    content_scheme=ContentScheme.SEALED
+                )
+                for _ in range(min(args.batch_size, args.messages - start))
+            ]
+            started_at = time.perf_counter()
+            MessageHandler.upsert_instances(instances=batch)
+            store_seconds += time.perf_counter() - started_at
+        stored = args.messages
+
+    search = message_search()
+    kinds = {
+        'rare_word': lambda: rng.choice(vocabulary[len(vocabulary) // 2:]),
+        'medium_word': lambda: rng.choice(vocabulary[100:1000]),
+        'common_word': lambda: rng.choice(vocabulary[:10]),
+        'two_medium_words': lambda: f'{rng.choice(vocabulary[100:1000])} {rng.choice(vocabulary[100:1000])}',
+        'common_phrase': lambda: f'"{rng.choice(vocabulary[:10])} {rng.choice(vocabulary[:10])}"',
+        'common_word_page_10': lambda: rng.choice(vocabulary[:10])
+    }
+    queries = {}
+    for kind, next_query in kinds.items():
+        page = 10 if kind.endswith('page_10') else 1
+        index_timings, command_timings, matches = [], [], []
+        for _ in range(args.queries):
+            room_id, query = rng.choice(room_ids), next_query()
+            index_timings += _timed(lambda: matches.append(search.search(room_id, query, page).total), 1)
+            command_timings += _timed(lambda: SearchCommand(query=query, page=page).answer(room_id), 1)
+        queries[kind] = {
+            'mean_matches': round(sum(matches) / len(matches)),
+            'index': percentiles(index_timings),
+            'command': percentiles(command_timings)
+        }
+
+    word = vocabulary[500]
+    scanned = 0
+    started_at = time.perf_counter()
+    for chunk in MessageHandler.iter_instances(chunk_size=1000):
+        for message in chunk:
+            # what a search without an index has to do for every row
+            _ = word in open_content(message).decode().split()
+        scanned += len(chunk)
+        if scanned >= args.scan_sample:
+            break
+    scan_seconds = time.perf_counter() - started_at
+
+    return {
+        'messages': stored,
+        'rooms': args.rooms,
+        'page_size': search.page_size,
+        'database_bytes': sum(path.stat().st_size for path in workdir.glob('search.db*')),
+        'store_us_per_message': round(store_seconds / args.messages * 1e6, 2) if store_seconds else None,
+        'queries': queries,
+        'scan_ms_per_million_messages': round(scan_seconds / scanned * 1e6 * 1000)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--vocabulary', type=int, default=20_000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--scan-sample', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', type=Path, default=None)
+    parser.add_argument('--output', type=Path, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        workdir = args.workdir or Path(temporary)
+        workdir.mkdir(parents=True, exist_ok=True)
+        os.environ |= {
+            'SOCKET_SERVER_DATABASE_URL': f'sqlite:///{workdir / "search.db"}',
+            'SOCKET_SERVER_RSA_KEYS_PATH': str(workdir / '.rsa'),
+            'SOCKET_SERVER_SEARCH_PAGE_SIZE': str(args.page_size),
+            'SOCKET_SERVER_PERSISTENCE_MODE': 'write_through'
+        }
+        results = run(args, workdir)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output is not None:
+        args.output.write_text(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Messages/sec the server can relay with per-message RSA (protocol 1)
+versus the negotiated ChaCha20-Poly1305 session (protocol 2).
+
+One relayed message is one inbound decrypt plus one outbound encrypt per recipient.
+
+    python -m benchmarks.session_crypto --messages 200 --recipients 5
+"""
+import argparse
+import os
+import time
+from collections.abc import Callable
+
+import rsa
+from socket_protocol import SessionCipher, unwrap_key, wrap_key
+
+
+def _rate(relay: Callable[[], None], messages: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(messages):
+        relay()
+    return messages / (time.perf_counter() - started_at)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--recipients', type=int, default=5)
+    parser.add_argument('--message-size', type=int, default=128)
+    parser.add_argument('--key-length', type=int, default=2048)
+    args = parser.parse_args()
+
+    server_public_key, server_private_key = rsa.newkeys(args.key_length)
+    client_public_key, client_private_key = rsa.newkeys(args.key_length)
+    payload = os.urandom(args.message_size)
+
+    inbound = rsa.encrypt(payload, server_public_key)
+
+    def relay_rsa() -> None:
+        plaintext = rsa.decrypt(inbound, server_private_key)
+        for _ in range(args.recipients):
+            rsa.encrypt(plaintext, client_public_key)
+
+    session_key = unwrap_key(
+        wrap_key(SessionCipher.generate_key(), client_public_key),
+        client_private_key
+    )
+    client_cipher = SessionCipher(session_key, initiator=True)
+    server_cipher = SessionCipher(session_key, initiator=False)
+
+    def relay_session() -> None:
+        plaintext = server_cipher.open(client_cipher.seal(payload))
+        for _ in range(args.recipients):
+            server_cipher.seal(plaintext)
+
+    rsa_rate = _rate(relay_rsa, args.messages)
+    session_rate = _rate(relay_session, args.messages)
+    print(f'recipients={args.recipients} message_size={args.message_size} key_length={args.key_length}')
+    print(f'rsa (protocol 1):     {rsa_rate:12.1f} messages/sec')
+    print(f'session (protocol 2): {session_rate:12.1f} messages/sec')
+    print(f'speedup:              {session_rate / rsa_rate:12.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 import os
 from functools import cached_property
 from pathlib import Path
+from typing import Literal
 
 import rsa
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from pydantic import Field
 from pydantic_settings import (
     BaseSettings,
@@ -16,13 +18,108 @@ class Config(BaseSettings):
     host: str = Field(default="localhost")
     port: int = Field(default=8000)
     buffer_size: int = Field(default=2048)
+    history_batch_size: int = Field(default=100)
+    history_chunk_size: int = Field(default=500)
+    history_sync_limit: int | None = Field(default=None)
+    # a message stored during a client's history sync may also be fanned out to it live,
+    # such copies of messages this recent are skipped for this long after the sync
+    history_dedup_seconds: float = Field(default=30.0)
+    sync_workers: int = Field(default=4)
+    recent_messages_cache_size: int = Field(default=1000)
+    recent_messages_cache_bytes: int = Field(default=8 * 1024 * 1024)
+    user_cache_size: int = Field(default=4096)
+    room_cache_size: int = Field(default=1024)
+    # messages of a room sent to a client that joins it
+    room_history_limit: int = Field(default=50)
+    # messages older than this many seconds move from the table to the archive, None keeps every message in the table
+    message_retention: float | None = Field(default=None)
+    archive_path: Path = Field(default=Path.cwd() / 'archive')
+    archive_interval: float = Field(default=300.0)
+    # messages per archive segment, also how many rows compaction reads and deletes at once
+    archive_segment_size: int = Field(default=1000)
+    # None is zlib's default level
+    archive_compression_level: int | None = Field(default=None)
+    # /search over an FTS5 index of keyed word hashes, SQLite databases only, archived messages are not searched
+    search_enabled: bool = Field(default=True)
+    search_page_size: int = Field(default=10)
+    search_word_cache_size: int = Field(default=65536)
+    database_url: str = Field(default='sqlite:///database.db')
+    database_pool_size: int = Field(default=8)
+    database_max_overflow: int = Field(default=8)
+    database_busy_timeout_ms: int = Field(default=5000)
+    # crash durability: FULL fsyncs every commit, NORMAL (with WAL) can lose the last commits on power loss only
+    database_synchronous: Literal['OFF', 'NORMAL', 'FULL', 'EXTRA'] = Field(default='NORMAL')
+    # write_behind acknowledges messages before they are committed, a crash loses at most one batch
+    persistence_mode: Literal['write_through', 'write_behind'] = Field(default='write_behind')
+    write_behind_batch_size: int = Field(default=256)
+    write_behind_interval: float = Field(default=0.05)
+    # a group failing this often is written row by row and the rows that still fail are dropped
+    write_behind_max_attempts: int = Field(default=5)
     sign_message_prefix: bytes = b'PUBLIC_KEY:'
     rsa_key_length: int = Field(default=2048)
     rsa_keys_path: Path = Field(default=Path.cwd() / '.rsa')
     rsa_private_key_name: str = Field(default='private.pem')
     rsa_public_key_name: str = Field(default='public.pem')
+    storage_key_name: str = Field(default='storage.key')
     hf_token: str = Field(default='')
-
+    server_mode: Literal['threaded', 'asyncio'] = Field(default='threaded')
+    outbound_queue_size: int = Field(default=256)
+    outbound_overflow_policy: Literal['drop_oldest', 'coalesce', 'disconnect'] = Field(default='drop_oldest')
+    executor_workers: int = Field(default=4)
+    accept_backlog: int = Field(default=128)
+    handshake_workers: int = Field(default=8)
+    # connections accepted beyond this many unfinished handshakes are closed right away
+    max_pending_handshakes: int = Field(default=64)
+    handshake_read_timeout: float = Field(default=5.0)
+    # asyncio only, the threaded server bounds the user lookup with database_busy_timeout_ms
+    handshake_auth_timeout: float = Field(default=5.0)
+    handshake_answer_timeout: float = Field(default=5.0)
+    history_sync_timeout: float = Field(default=30.0)
+    # RSA worker processes for protocol 1 clients, started with the first one, None uses every core, 0 runs RSA inline
+    crypto_workers: int | None = Field(default=None)
+    crypto_batch_size: int = Field(default=64)
+    crypto_batch_wait: float = Field(default=0.002)
+    # codecs protocol 2 clients may negotiate, an empty list turns compression off
+    compression_codecs: list[str] = Field(default=['zlib'])
+    # None is the codec's default level, zlib's 6
+    compression_level: int | None = Field(default=None)
+    # smaller payloads are sent as they are, e.g. most chat lines
+    compression_threshold: int = Field(default=512)
+    # payloads compressed once and reused for every recipient of a fan-out
+    compression_cache_size: int = Field(default=256)
+    compression_cache_bytes: int = Field(default=8 * 1024 * 1024)
+    # ipc lets instances sharing the database and keys fan messages out to each other's clients
+    broker_backend: Literal['local', 'ipc'] = Field(default='local')
+    broker_host: str = Field(default='127.0.0.1')
+    broker_port: int = Field(default=8765)
+    broker_reconnect_interval: float = Field(default=0.5)
+    broker_outbox_size: int = Field(default=10000)
+    broker_dedup_size: int = Field(default=4096)
+    # /metrics (Prometheus text) and /stats (JSON), only served when enabled
+    metrics_enabled: bool = Field(default=False)
+    metrics_host: str = Field(default='127.0.0.1')
+    metrics_port: int = Field(default=9464)
+    llm_backend: Literal['gemma', 'echo', 'disabled'] = Field(default='gemma')
+    gemma_model_name: str = Field(default='google/gemma-2b-it')
+    llm_device: Literal['auto', 'cpu', 'cuda'] = Field(default='auto')
+    llm_precision: Literal['auto', 'float32', 'float16', 'bfloat16', 'int8'] = Field(default='auto')
+    llm_threads: int | None = Field(default=None)
+    llm_interop_threads: int | None = Field(default=None)
+    gemma_max_batch_size: int = Field(default=8)
+    gemma_max_wait: float = Field(default=0.05)
+    gemma_max_new_tokens: int = Field(default=256)
+    gemma_queue_limit: int = Field(default=64)
+    gemma_pending_per_client: int = Field(default=2)
+    answer_cache_size: int = Field(default=1024)
+    answer_cache_bytes: int = Field(default=4 * 1024 * 1024)
+    answer_cache_ttl: float = Field(default=3600.0)
+    answer_cache_persist: bool = Field(default=False)
+    gemma_streaming: bool = Field(default=True)
+    gemma_stream_interval: float = Field(default=0.1)
+    conversation_max_turns: int = Field(default=8)
+    conversation_cache_bytes: int = Field(default=512 * 1024 * 1024)
+    conversation_idle_seconds: float = Field(default=900.0)
+    conversation_max_sessions: int = Field(default=256)
 
     def _generate_new_keys(self) -> tuple[PublicKey, PrivateKey]:
         public_key, private_key = rsa.newkeys(self.rsa_key_length)
@@ -42,10 +139,22 @@ class Config(BaseSettings):
 
     @cached_property
     def server_keys(self) -> tuple[PublicKey, PrivateKey]:
-        if Path.exists(self.rsa_keys_path):
+        if Path.exists(self.rsa_keys_path / self.rsa_private_key_name):
             return self._load_existing_keys()
         return self._generate_new_keys()
 
+    @cached_property
+    def storage_key(self) -> bytes:
+        storage_key_path = self.rsa_keys_path / self.storage_key_name
+        if Path.exists(storage_key_path):
+            with open(storage_key_path, 'rb') as storage_key_file:
+                return storage_key_file.read()
+        storage_key = ChaCha20Poly1305.generate_key()
+        os.makedirs(self.rsa_keys_path, exist_ok=True)
+        with open(storage_key_path, 'wb') as storage_key_file:
+            storage_key_file.write(storage_key)
+        return storage_key
+
 
 CONFIG = Config()
 __all__ = ['CONFIG']
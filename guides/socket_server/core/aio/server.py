@@ -0,0 +1,560 @@
+import asyncio
+import dataclasses
+import functools
+import logging
+import time
+import uuid
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from socket_protocol import FrameDecoder, FrameError, FrameType
+
+from config import CONFIG
+from core.aio.transport import StreamSocket
+from core.archive.compaction import Compactor
+from core.auth.context import PROTOCOL_ERRORS, AuthContext, HistoryCursor, SignedMessage
+from core.auth.handshake import HandshakeMetrics, HandshakePhase
+from core.broker import Broker, BrokerMessage, create_broker
+from core.cache import CachedMessage, RecentMessagesCache, read_history, warm_from_database
+from core.crypto.pool import rsa_block_size
+from core.gemma.answers import store_answer
+from core.gemma.scheduler import InferenceScheduler, QuestionRejectedError
+from core.handlers import MessageHandler, RoomHandler, UserHandler, WriteBehindError
+from core.metrics import METRICS, Timing, start_metrics_endpoint
+from core.models import LOBBY_ROOM_NAME
+from core.outbound import AsyncOutboundQueue, OutboundMessage, OutboundMetrics, OverflowPolicy, SlowConsumerError
+from core.rooms import RoomCommand, RoomMembers
+from core.search.commands import SearchCommand
+from core.search.index import build_search_index
+
+logger = logging.getLogger(__name__)
+
+FRAMED_READ_SIZE = 64 * 1024
+
+
+def _persist_message(
+        auth_context: AuthContext,
+        data: bytes,
+        recent_messages: RecentMessagesCache
+) -> SignedMessage | RoomCommand | SearchCommand:
+    """Commands are returned as they are, without being stored."""
+    decrypted_message = auth_context.decrypt(data)
+    if (command := RoomCommand.parse(decrypted_message)) is not None:
+        return command
+    if (search := SearchCommand.parse(decrypted_message)) is not None:
+        return search
+    # decoded before it is stored, a message that is not UTF-8 is stored the way it is shown
+    text = decrypted_message.decode(errors='replace')
+    message = MessageHandler.store_message(
+        user=auth_context.user,
+        content=text.encode(),
+        room_id=auth_context.room_id
+    )
+    signed_message = f'{auth_context.user.name}: {text}'.encode()
+    recent_messages.append(message.id, signed_message, auth_context.room_id)
+    return SignedMessage(
+        auth_context=auth_context,
+        content=signed_message,
+        message_id=message.id,
+        room_id=auth_context.room_id
+    )
+
+
+def _next_history_chunk(
+        auth_context: AuthContext,
+        history: Iterator[list[CachedMessage]]
+) -> list[bytes] | None:
+    messages = next(history, None)
+    if messages is None:
+        return None
+    return auth_context.encode_history(messages)
+
+
+@dataclasses.dataclass(slots=True)
+class AsyncServer:
+    """
+    Single event loop alternative to the thread-per-client ``Server``.
+    Socket IO stays on the loop, database and RSA work runs in an executor,
+    Gemma questions go through the batching scheduler thread.
+    """
+    message_queue: asyncio.Queue = dataclasses.field(default_factory=asyncio.Queue)
+    client_contexts: dict[int, AuthContext] = dataclasses.field(default_factory=dict)
+    outbound_metrics: OutboundMetrics = dataclasses.field(default_factory=OutboundMetrics)
+    recent_messages: RecentMessagesCache = dataclasses.field(
+        default_factory=lambda: RecentMessagesCache(
+            max_size=CONFIG.recent_messages_cache_size,
+            max_bytes=CONFIG.recent_messages_cache_bytes
+        )
+    )
+    executor: ThreadPoolExecutor = dataclasses.field(
+        default_factory=lambda: ThreadPoolExecutor(
+            max_workers=CONFIG.executor_workers,
+            thread_name_prefix='aio-worker'
+        )
+    )
+    scheduler: InferenceScheduler = dataclasses.field(default_factory=InferenceScheduler.from_config)
+    handshake_metrics: HandshakeMetrics = dataclasses.field(default_factory=HandshakeMetrics)
+    broker: Broker = dataclasses.field(default_factory=create_broker)
+    rooms: RoomMembers = dataclasses.field(default_factory=RoomMembers)
+    compactor: Compactor = dataclasses.field(default_factory=Compactor.from_config)
+    # created in ``serve``, a semaphore is bound to the loop it is first used on
+    handshake_slots: asyncio.Semaphore | None = None
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(func, *args, **kwargs)
+        )
+
+    @staticmethod
+    async def read_handshake(
+            reader: asyncio.StreamReader
+    ) -> tuple[bytes, FrameDecoder | None]:
+        """Event loop counterpart of ``core.auth.context.read_handshake``."""
+        data = await reader.read(CONFIG.buffer_size)
+        if data[:1] == CONFIG.sign_message_prefix[:1]:
+            return data, None
+        decoder = FrameDecoder()
+        decoder.feed(data)
+        while True:
+            for frame_type, payload in decoder:
+                if frame_type != FrameType.HANDSHAKE:
+                    raise FrameError(f'Expected handshake, got {frame_type.name}')
+                return bytes(payload), decoder
+            data = await reader.read(CONFIG.buffer_size)
+            if not data:
+                raise ConnectionResetError('Connection closed during handshake')
+            decoder.feed(data)
+
+    @staticmethod
+    async def receive(
+            reader: asyncio.StreamReader,
+            auth_context: AuthContext
+    ) -> AsyncIterator[bytes]:
+        decoder = auth_context.decoder
+        if decoder is None:
+            block_size = rsa_block_size()
+            while True:
+                try:
+                    block = await reader.readexactly(block_size)
+                except asyncio.IncompleteReadError:
+                    return
+                yield block
+        while True:
+            for frame_type, payload in decoder:
+                if frame_type == FrameType.CHAT:
+                    yield payload
+            data = await reader.read(FRAMED_READ_SIZE)
+            if not data:
+                return
+            decoder.feed(data)
+
+    async def handshake(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter
+    ) -> AuthContext:
+        with self.handshake_metrics.phase(HandshakePhase.READ):
+            handshake, decoder = await asyncio.wait_for(
+                self.read_handshake(reader),
+                timeout=CONFIG.handshake_read_timeout
+            )
+        with self.handshake_metrics.phase(HandshakePhase.AUTH):
+            client_public_key, user_name, options = SignedMessage.validate(
+                message=handshake
+            )
+            answer, cipher, compressor = SignedMessage.answer(
+                client_public_key,
+                options,
+                framed=decoder is not None
+            )
+            user = await asyncio.wait_for(
+                self._run(
+                    UserHandler.get_or_create,
+                    public_key=client_public_key,
+                    name=user_name
+                ),
+                timeout=CONFIG.handshake_auth_timeout
+            )
+            room = await asyncio.wait_for(
+                self._run(RoomHandler.get_or_create, name=options.get('room', LOBBY_ROOM_NAME)),
+                timeout=CONFIG.handshake_auth_timeout
+            )
+        with self.handshake_metrics.phase(HandshakePhase.ANSWER):
+            writer.write(answer)
+            await asyncio.wait_for(writer.drain(), timeout=CONFIG.handshake_answer_timeout)
+        return AuthContext(
+            user=user,
+            socket=StreamSocket(writer),
+            public_key=client_public_key,
+            cipher=cipher,
+            decoder=decoder,
+            history_cursor=HistoryCursor.from_options(options),
+            compressor=compressor,
+            room_id=room.id,
+            outbound=AsyncOutboundQueue(
+                max_size=CONFIG.outbound_queue_size,
+                policy=OverflowPolicy(CONFIG.outbound_overflow_policy),
+                metrics=self.outbound_metrics
+            )
+        )
+
+    async def sync_messages_for_current_context(
+            self,
+            auth_context: AuthContext
+    ) -> None:
+        history = read_history(
+            self.recent_messages,
+            room_id=auth_context.room_id,
+            since=auth_context.history_cursor.since,
+            limit=auth_context.history_cursor.limit,
+            chunk_size=CONFIG.history_chunk_size
+        )
+        while buffers := await self._run(_next_history_chunk, auth_context, history):
+            auth_context.write(buffers)
+            # a client that stops reading its history is dropped
+            await asyncio.wait_for(auth_context.socket.drain(), timeout=CONFIG.history_sync_timeout)
+
+    async def listen(
+            self,
+            reader: asyncio.StreamReader,
+            auth_context: AuthContext
+    ) -> None:
+        """Returns when the client disconnects or sends something it cannot have sealed, ``handle_client`` cleans up."""
+        try:
+            async for data in self.receive(reader, auth_context):
+                message = await self._run(
+                    _persist_message,
+                    auth_context,
+                    data,
+                    self.recent_messages
+                )
+                if isinstance(message, RoomCommand):
+                    await self.enter_room(auth_context, message)
+                    continue
+                if isinstance(message, SearchCommand):
+                    answer = await self._run(message.answer, auth_context.room_id)
+                    self.send_to_context(OutboundMessage(content=answer), auth_context=auth_context)
+                    continue
+                await self.message_queue.put(message)
+        except PROTOCOL_ERRORS as e:
+            logger.warning(msg=f'Disconnecting {auth_context.user.name} after a protocol error: {e!r}')
+
+    async def enter_room(self, auth_context: AuthContext, command: RoomCommand) -> None:
+        """
+        Messages after the command are stored in the new room right away,
+        ``handle_messages`` moves the membership and sends the room's history.
+        """
+        try:
+            room = await self._run(RoomHandler.get_or_create, name=command.room_name)
+        except ValueError as e:
+            self.send_to_context(OutboundMessage(content=f'* {e}'.encode()), auth_context=auth_context)
+            return
+        auth_context.room_id = room.id
+        await self.message_queue.put(
+            SignedMessage(
+                auth_context=auth_context,
+                content=f'* you are in #{room.name}'.encode(),
+                room_id=room.id,
+                command=command
+            )
+        )
+
+    async def write_outbound(self, auth_context: AuthContext) -> None:
+        """Per-client writer task, a slow socket only ever waits in its own ``drain``."""
+        try:
+            while messages := await auth_context.outbound.get_all():
+                # empty when every message already came with the history sync
+                if buffers := await self._run(auth_context.encode_outbound, messages):
+                    auth_context.write(buffers)
+                    await auth_context.socket.drain()
+        except OSError:
+            pass
+        except Exception as e:
+            logger.error(msg=f'Writer for {auth_context.user.name} failed: {e}', exc_info=True)
+        finally:
+            self.disconnect(auth_context)
+
+    async def handle_client(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter
+    ) -> None:
+        started = time.perf_counter()
+        if self.handshake_slots.locked():
+            self.handshake_metrics.reject()
+            logger.warning(msg='Too many pending handshakes, closing connection')
+            writer.close()
+            return
+        auth_context = None
+        writer_task = None
+        try:
+            auth_context = await self.authenticate(reader, writer, started)
+            if auth_context is None:
+                return
+            with self.handshake_metrics.phase(HandshakePhase.SYNC), METRICS.time(Timing.HISTORY_SYNC):
+                await self.sync_messages_for_current_context(auth_context)
+            logger.info(
+                msg=f'Messages for {auth_context.user.name} synced, '
+                    f'recent messages cache: {self.recent_messages.stats}'
+            )
+            # live messages queued during the sync are written after the history, in order
+            writer_task = asyncio.create_task(self.write_outbound(auth_context))
+            await self.listen(reader, auth_context)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except TimeoutError as e:
+            reason = self.handshake_metrics.fail(e)
+            logger.warning(
+                msg=f'History sync for {auth_context.user.name} failed ({reason}): {e}, '
+                    f'handshakes: {self.handshake_metrics.report()}'
+            )
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+        finally:
+            if auth_context is not None:
+                self.disconnect(auth_context)
+            if writer_task is not None:
+                await writer_task
+            writer.close()
+
+    async def authenticate(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            started: float
+    ) -> AuthContext | None:
+        """Runs the handshake holding one of ``max_pending_handshakes`` slots, failures close the connection."""
+        async with self.handshake_slots:
+            try:
+                auth_context = await self.handshake(reader, writer)
+            except Exception as e:
+                reason = self.handshake_metrics.fail(e)
+                logger.warning(
+                    msg=f'Handshake from {writer.get_extra_info("peername", ("?",))[0]} failed ({reason}): {e}, '
+                        f'handshakes: {self.handshake_metrics.report()}'
+                )
+                writer.close()
+                return None
+        self.client_contexts[auth_context.connection_id] = auth_context
+        self.rooms.join(auth_context.room_id, auth_context.connection_id)
+        self.handshake_metrics.complete(started)
+        logger.info(
+            msg=f'New client context: {auth_context.user.name}, handshakes: {self.handshake_metrics.report()}'
+        )
+        return auth_context
+
+    def disconnect(self, auth_context: AuthContext) -> None:
+        if self.client_contexts.pop(auth_context.connection_id, None) is None:
+            return
+        self.rooms.leave(auth_context.connection_id)
+        auth_context.outbound.close()
+        # ends ``listen`` with EOF if the client is still connected
+        auth_context.socket.close()
+        logger.info(
+            msg=f'Client {auth_context.user.name} disconnected, '
+                f'outbound queues: {self.outbound_metrics.report(self._outbound_queues())}'
+        )
+
+    def _outbound_queues(self) -> list[AsyncOutboundQueue]:
+        return [auth_context.outbound for auth_context in self.client_contexts.values()]
+
+    def send_to_context(
+            self,
+            message: OutboundMessage,
+            auth_context: AuthContext
+    ) -> None:
+        try:
+            with METRICS.time(Timing.OUTBOUND_ENQUEUE):
+                auth_context.outbound.put(message)
+        except SlowConsumerError as e:
+            logger.warning(msg=f'Evicting slow client {auth_context.user.name}: {e}')
+            self.outbound_metrics.add(evictions=1)
+            self.disconnect(auth_context)
+
+    async def handle_messages(self) -> None:
+        while True:
+            message: SignedMessage = await self.message_queue.get()
+            if message.command is not None:
+                await self.move_to_room(message)
+                self.message_queue.task_done()
+                continue
+            if message.auth_context is not None:
+                if b'Gemma' in message.content and self.scheduler.enabled:
+                    self.ask_gemma(message)
+                self.broker.publish(
+                    BrokerMessage(id=message.message_id, content=message.content, room_id=message.room_id)
+                )
+            outbound_message = OutboundMessage(content=message.content, message_ids=(message.message_id,))
+            for connection_id in self.rooms.members(message.room_id):
+                if connection_id == message.skip:
+                    continue
+                if (auth_context := self.client_contexts.get(connection_id)) is not None:
+                    self.send_to_context(outbound_message, auth_context=auth_context)
+            self.message_queue.task_done()
+
+    async def move_to_room(self, message: SignedMessage) -> None:
+        """
+        Awaited by ``handle_messages``, so no message of the room is fanned out between its history and the join.
+        """
+        auth_context = message.auth_context
+        history = await self._run(
+            lambda: list(
+                read_history(
+                    self.recent_messages,
+                    room_id=message.room_id,
+                    since=None,
+                    limit=CONFIG.room_history_limit,
+                    chunk_size=CONFIG.history_chunk_size
+                )
+            )
+        )
+        if auth_context.connection_id not in self.client_contexts:
+            return
+        self.send_to_context(OutboundMessage(content=message.content), auth_context=auth_context)
+        for chunk in history:
+            self.send_to_context(
+                OutboundMessage(
+                    content=tuple(message.content for message in chunk),
+                    message_ids=tuple(message.id for message in chunk)
+                ),
+                auth_context=auth_context
+            )
+        self.rooms.join(message.room_id, auth_context.connection_id)
+        logger.info(msg=f'{auth_context.user.name} moved to room {message.room_id}, rooms: {self.rooms.stats}')
+
+    def receive_remote(self, message: BrokerMessage) -> None:
+        """Called on the loop for messages stored by another instance."""
+        self.recent_messages.append(message.id, message.content, message.room_id)
+        if message.broadcast:
+            self.message_queue.put_nowait(
+                SignedMessage(
+                    auth_context=None,
+                    content=message.content,
+                    message_id=message.id,
+                    room_id=message.room_id
+                )
+            )
+
+    def ask_gemma(self, question: SignedMessage) -> None:
+        auth_context = question.auth_context
+        loop = asyncio.get_running_loop()
+        stream = uuid.uuid4()
+        try:
+            # answers arrive on the scheduler thread, outbound queues belong to the loop
+            self.scheduler.submit(
+                # without the author prefix, so the same question from anyone shares one cached answer
+                question.content.decode().removeprefix(f'{auth_context.user.name}: '),
+                on_answer=functools.partial(self._gemma_answered, loop, auth_context, stream, question.room_id),
+                on_partial=(
+                    functools.partial(
+                        loop.call_soon_threadsafe,
+                        self.send_gemma_reply,
+                        auth_context,
+                        stream,
+                        FrameType.AI_PARTIAL
+                    )
+                    if CONFIG.gemma_streaming and auth_context.decoder is not None else None
+                ),
+                owner=auth_context.connection_id,
+                conversation=auth_context.user.id
+            )
+        except QuestionRejectedError as e:
+            logger.warning(msg=f'Gemma question from {auth_context.user.name} rejected: {e}')
+            self.send_gemma_reply(auth_context, stream, FrameType.AI_REPLY, e.reply)
+
+    def _gemma_answered(
+            self,
+            loop: asyncio.AbstractEventLoop,
+            auth_context: AuthContext,
+            stream: uuid.UUID,
+            room_id: uuid.UUID,
+            answer: str
+    ) -> None:
+        """Runs on the scheduler thread, the room sees the stored answer live as well, the asker only as its reply."""
+        message_id, signed_answer = store_answer(answer, self.recent_messages, room_id)
+        self.broker.publish(BrokerMessage(id=message_id, content=signed_answer, room_id=room_id))
+        loop.call_soon_threadsafe(
+            self.send_gemma_reply,
+            auth_context,
+            stream,
+            FrameType.AI_REPLY,
+            answer,
+            message_id
+        )
+        loop.call_soon_threadsafe(
+            self.message_queue.put_nowait,
+            SignedMessage(
+                auth_context=None,
+                content=signed_answer,
+                message_id=message_id,
+                room_id=room_id,
+                skip=auth_context.connection_id
+            )
+        )
+
+    def send_gemma_reply(
+            self,
+            auth_context: AuthContext,
+            stream: uuid.UUID,
+            frame_type: FrameType,
+            text: str,
+            message_id: uuid.UUID | None = None
+    ) -> None:
+        if auth_context.connection_id not in self.client_contexts:
+            return
+        self.send_to_context(
+            OutboundMessage(
+                content=f'Gemma: {text}'.encode(),
+                frame_type=frame_type,
+                key=stream,
+                message_ids=(message_id,)
+            ),
+            auth_context=auth_context
+        )
+
+    async def serve(self) -> None:
+        await self._run(build_search_index)
+        await self._run(warm_from_database, self.recent_messages)
+        logger.info(msg=f'Recent messages cache warmed: {len(self.recent_messages)} messages')
+        start_metrics_endpoint(self)
+        self.handshake_slots = asyncio.Semaphore(CONFIG.max_pending_handshakes)
+        server = await asyncio.start_server(
+            self.handle_client,
+            host=CONFIG.host,
+            port=CONFIG.port,
+            backlog=CONFIG.accept_backlog
+        )
+        logger.info(f'BIND on {CONFIG.host}:{CONFIG.port} (asyncio)')
+        logger.info(msg='Waiting for connections..')
+        async with server:
+            self.scheduler.start()
+            self.compactor.start()
+            # messages from other instances arrive on the broker thread
+            loop = asyncio.get_running_loop()
+            self.broker.start(
+                on_message=functools.partial(loop.call_soon_threadsafe, self.receive_remote),
+                # after the messages handed to the loop before it
+                on_gap=functools.partial(loop.call_soon_threadsafe, self.recent_messages.invalidate)
+            )
+            background_tasks = (
+                asyncio.create_task(self.handle_messages()),
+            )
+            try:
+                await server.serve_forever()
+            finally:
+                for task in background_tasks:
+                    task.cancel()
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.broker.close()
+                try:
+                    MessageHandler.flush()
+                except WriteBehindError as e:
+                    logger.error(f'Messages lost on shutdown: {e}')
+
+    def run(self) -> None:
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
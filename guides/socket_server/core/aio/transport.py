@@ -0,0 +1,34 @@
+import asyncio
+
+
+class StreamSocket:
+    """
+    Socket-like facade over an asyncio stream writer, so code written against
+    ``AuthContext.socket`` works in both server modes.
+    Must only be used from the event loop thread.
+    """
+    __slots__ = ('_writer',)
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self._writer = writer
+
+    def send(self, data: bytes) -> int:
+        if self._writer.is_closing():
+            raise ConnectionResetError('Stream is closed')
+        self._writer.write(data)
+        return len(data)
+
+    def sendall(self, data: bytes) -> None:
+        self.send(data)
+
+    def sendmsg(self, buffers: list[bytes | memoryview]) -> int:
+        if self._writer.is_closing():
+            raise ConnectionResetError('Stream is closed')
+        self._writer.writelines(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+    def close(self) -> None:
+        self._writer.close()
+
+    async def drain(self) -> None:
+        await self._writer.drain()
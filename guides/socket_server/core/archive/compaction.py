@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+import uuid
+from typing import Self
+
+from config import CONFIG
+from core.archive.segments import MessageArchive, message_archive
+from core.handlers import MessageHandler, RoomHandler
+from core.models import LOBBY_ROOM_ID, Message
+
+logger = logging.getLogger(__name__)
+
+
+class Compactor:
+    """
+    Moves messages older than ``retention`` seconds from the messages table to the ``MessageArchive``,
+    every ``interval`` seconds from a background thread, so the table only holds the retention window.
+    Rooms are compacted oldest first, ``segment_size`` rows at a time: the segment is synced before its rows
+    are deleted, and rows a crash left behind are found in the room's last segment and only deleted the next pass.
+    Rows leave the search index in the transaction deleting them, ``/search`` covers the retention window only.
+    Only one instance sharing a database should compact it, the others read the archive.
+    """
+    __slots__ = (
+        'archive',
+        'retention',
+        'interval',
+        'segment_size',
+        '_thread',
+        'passes',
+        'archived',
+        'last_pass_seconds'
+    )
+
+    def __init__(self, archive: MessageArchive, retention: float | None, interval: float, segment_size: int) -> None:
+        self.archive = archive
+        self.retention = retention
+        self.interval = interval
+        self.segment_size = segment_size
+        self._thread: threading.Thread | None = None
+        self.passes = 0
+        self.archived = 0
+        self.last_pass_seconds = 0.0
+
+    @classmethod
+    def from_config(cls) -> Self:
+        return cls(
+            archive=message_archive(),
+            retention=CONFIG.message_retention,
+            interval=CONFIG.archive_interval,
+            segment_size=CONFIG.archive_segment_size
+        )
+
+    def start(self) -> None:
+        """Does nothing without a ``retention``, every message then stays in the table."""
+        if self.retention is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='compactor', daemon=True)
+        self._thread.start()
+
+    def compact(self, now: float | None = None) -> int:
+        """One pass over every room, returns how many messages were archived."""
+        cutoff = (time.time() if now is None else now) - self.retention
+        started = time.perf_counter()
+        # messages stored before rooms existed are in the lobby, which may have no row yet
+        room_ids = {LOBBY_ROOM_ID} | {room.id for room in RoomHandler.read_instances()}
+        archived = sum(self._compact_room(room_id, cutoff) for room_id in room_ids)
+        self.passes += 1
+        self.archived += archived
+        self.last_pass_seconds = time.perf_counter() - started
+        return archived
+
+    def _compact_room(self, room_id: uuid.UUID, cutoff: float) -> int:
+        archived_ids: set[uuid.UUID] | None = None
+        archived = 0
+        for chunk in MessageHandler.iter_instances(
+                filters=(Message.room_id == room_id, Message.created_at < cutoff),
+                chunk_size=self.segment_size
+        ):
+            if archived_ids is None:
+                # only the last segment can hold rows whose deletion was interrupted
+                segments = self.archive.segments(room_id)
+                last = self.archive.read(room_id, segments[-1]) if segments else []
+                archived_ids = {message.id for message in last}
+            if messages := [message for message in chunk if message.id not in archived_ids]:
+                self.archive.append(room_id, messages)
+                archived += len(messages)
+            MessageHandler.delete_messages(chunk)
+        return archived
+
+    def _run(self) -> None:
+        while True:
+            try:
+                if archived := self.compact():
+                    logger.info(f'Archived {archived} messages older than {self.retention} seconds')
+            except Exception as e:
+                logger.error(f'Compaction failed: {e}', exc_info=True)
+            time.sleep(self.interval)
+
+    @property
+    def stats(self) -> dict[str, float | int | None]:
+        return {
+            'retention': self.retention,
+            'passes': self.passes,
+            'archived': self.archived,
+            'last_pass_seconds': round(self.last_pass_seconds, 3)
+        }
@@ -0,0 +1,199 @@
+import dataclasses
+import functools
+import os
+import struct
+import threading
+import uuid
+import zlib
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from typing import Self
+
+from config import CONFIG
+from core.crypto.storage import keep_plaintext, open_content, open_sealed, seal_content
+from core.models import ContentScheme, Message
+
+# first id, last id, first and last created_at, message count, offset and length of the block in the segment file
+_INDEX_ENTRY = struct.Struct('!16s16sddIQI')
+# id, user id, created_at, then the lengths of the user name and the content that follow
+_RECORD = struct.Struct('!16s16sdHI')
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class ArchiveSegment:
+    first_id: uuid.UUID
+    last_id: uuid.UUID
+    first_created_at: float
+    last_created_at: float
+    count: int
+    offset: int
+    length: int
+
+    def pack(self) -> bytes:
+        return _INDEX_ENTRY.pack(
+            self.first_id.bytes,
+            self.last_id.bytes,
+            self.first_created_at,
+            self.last_created_at,
+            self.count,
+            self.offset,
+            self.length
+        )
+
+    @classmethod
+    def unpack(cls, entry: bytes) -> Self:
+        first_id, last_id, first_created_at, last_created_at, count, offset, length = _INDEX_ENTRY.unpack(entry)
+        return cls(
+            first_id=uuid.UUID(bytes=first_id),
+            last_id=uuid.UUID(bytes=last_id),
+            first_created_at=first_created_at,
+            last_created_at=last_created_at,
+            count=count,
+            offset=offset,
+            length=length
+        )
+
+
+def _encode_records(messages: Sequence[Message]) -> bytes:
+    records = []
+    for message in messages:
+        user_name, content = message.user_name.encode(), open_content(message)
+        records += [
+            _RECORD.pack(message.id.bytes, message.user_id.bytes, message.created_at, len(user_name), len(content)),
+            user_name,
+            content
+        ]
+    return b''.join(records)
+
+
+def _decode_records(data: bytes, room_id: uuid.UUID) -> list[Message]:
+    messages = []
+    offset = 0
+    while offset < len(data):
+        message_id, user_id, created_at, name_size, content_size = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        user_name = data[offset:offset + name_size].decode()
+        offset += name_size
+        content = data[offset:offset + content_size]
+        offset += content_size
+        message = Message(
+            id=uuid.UUID(bytes=message_id),
+            room_id=room_id,
+            user_id=uuid.UUID(bytes=user_id),
+            user_name=user_name,
+            content_scheme=ContentScheme.SEALED,
+            created_at=created_at
+        )
+        # the block was opened already, readers get the plaintext from ``open_content`` without sealing it again
+        keep_plaintext(message, content)
+        messages.append(message)
+    return messages
+
+
+class MessageArchive:
+    """
+    Messages moved out of the messages table, kept per room in two append-only files under ``path``.
+    ``<room id>.seg`` holds one block per segment: the segment's messages compressed together, then sealed
+    with the storage key, so archived content stays encrypted at rest and still compresses.
+    ``<room id>.idx`` holds one fixed-size entry per segment with its id and time range and where its block is,
+    so a read only opens the segments overlapping what it asks for.
+    A block is synced before its entry is appended, a crash in between leaves unreferenced bytes and nothing else.
+    """
+    __slots__ = ('path', 'level', '_lock')
+
+    def __init__(self, path: Path, level: int | None = None) -> None:
+        self.path = path
+        self.level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls) -> Self:
+        return cls(path=CONFIG.archive_path, level=CONFIG.archive_compression_level)
+
+    def _paths(self, room_id: uuid.UUID) -> tuple[Path, Path]:
+        return self.path / f'{room_id.hex}.seg', self.path / f'{room_id.hex}.idx'
+
+    def is_empty(self) -> bool:
+        return not any(self.path.glob('*.idx'))
+
+    def segments(self, room_id: uuid.UUID) -> list[ArchiveSegment]:
+        """Oldest first, read on every call since the index is small and another instance may be compacting."""
+        try:
+            index = self._paths(room_id)[1].read_bytes()
+        except FileNotFoundError:
+            return []
+        # a torn last entry is ignored, the next ``append`` cuts it off
+        entries = len(index) // _INDEX_ENTRY.size
+        segments = [
+            ArchiveSegment.unpack(index[position:position + _INDEX_ENTRY.size])
+            for position in range(0, entries * _INDEX_ENTRY.size, _INDEX_ENTRY.size)
+        ]
+        return sorted(segments, key=lambda segment: segment.first_id)
+
+    def append(self, room_id: uuid.UUID, messages: Sequence[Message]) -> ArchiveSegment:
+        """Archives ``messages`` of ``room_id``, in id order, as one new segment."""
+        block = seal_content(zlib.compress(_encode_records(messages), self.level))
+        segment_path, index_path = self._paths(room_id)
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(segment_path, 'ab') as segment_file:
+                offset = segment_file.seek(0, os.SEEK_END)
+                segment_file.write(block)
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            segment = ArchiveSegment(
+                first_id=messages[0].id,
+                last_id=messages[-1].id,
+                first_created_at=messages[0].created_at,
+                last_created_at=messages[-1].created_at,
+                count=len(messages),
+                offset=offset,
+                length=len(block)
+            )
+            with open(index_path, 'ab') as index_file:
+                size = index_file.seek(0, os.SEEK_END)
+                index_file.truncate(size - size % _INDEX_ENTRY.size)
+                index_file.write(segment.pack())
+                index_file.flush()
+                os.fsync(index_file.fileno())
+        return segment
+
+    def read(self, room_id: uuid.UUID, segment: ArchiveSegment) -> list[Message]:
+        with open(self._paths(room_id)[0], 'rb') as segment_file:
+            segment_file.seek(segment.offset)
+            block = segment_file.read(segment.length)
+        return _decode_records(zlib.decompress(open_sealed(block)), room_id)
+
+    def iter_history(
+            self,
+            room_id: uuid.UUID,
+            since: uuid.UUID | None = None,
+            limit: int | None = None,
+            chunk_size: int = 500
+    ) -> Iterator[list[Message]]:
+        """
+        Archived messages of ``room_id`` newer than ``since`` in chronological chunks, inflating one segment at a time.
+        With ``limit`` only the newest ``limit`` of them, from the newest segments that hold that many.
+        """
+        segments = [segment for segment in self.segments(room_id) if since is None or segment.last_id > since]
+        if limit is not None:
+            newest, count = [], 0
+            for segment in reversed(segments):
+                if count >= limit:
+                    break
+                newest.append(segment)
+                count += segment.count
+            segments = newest[::-1]
+        for position, segment in enumerate(segments):
+            messages = [message for message in self.read(room_id, segment) if since is None or message.id > since]
+            if limit is not None and position == 0:
+                # the newer segments hold fewer than ``limit``, the oldest one fills up the rest
+                newer = sum(segment.count for segment in segments[1:])
+                messages = messages[max(len(messages) + newer - limit, 0):]
+            for start in range(0, len(messages), chunk_size):
+                yield messages[start:start + chunk_size]
+
+
+@functools.cache
+def message_archive() -> MessageArchive:
+    return MessageArchive.from_config()
@@ -1,10 +1,320 @@
 import dataclasses
-
-from core.models import User
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections.abc import Iterator
 from socket import socket
+from typing import Self
+
+import rsa
+from cryptography.exceptions import InvalidTag
+from rsa import PublicKey
+from socket_protocol import (
+    LEGACY_PROTOCOL_VERSION,
+    PROTOCOL_VERSION,
+    FrameDecoder,
+    FrameError,
+    FrameType,
+    SessionCipher,
+    encode_batch,
+    encode_frame,
+    encode_message,
+    encode_options,
+    frame_buffers,
+    parse_options,
+    send_buffers,
+    wrap_key
+)
+
+from config import CONFIG
+from core.aio.transport import StreamSocket
+from core.cache import CachedMessage
+from core.compression import SharedCompressor, negotiate_compressor
+from core.crypto.pool import rsa_block_size, rsa_decrypt, rsa_encrypt
+from core.metrics import METRICS, Timing
+from core.models import LOBBY_ROOM_ID, User
+from core.models.message import newest_uuid_at
+from core.outbound import AsyncOutboundQueue, OutboundMessage, OutboundQueue
+from core.rooms import RoomCommand
+
+logger = logging.getLogger(__name__)
+
+_connection_ids = itertools.count(1)
+# what a corrupt frame, a tampered, replayed or malformed message raises while a client is read
+PROTOCOL_ERRORS = (FrameError, InvalidTag, rsa.DecryptionError, ValueError)
+
+
+def _set_deadline(conn: socket, deadline: float | None) -> None:
+    if deadline is None:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError('Handshake deadline passed')
+    conn.settimeout(remaining)
+
+
+def read_handshake(conn: socket, timeout: float | None = None) -> tuple[bytes, FrameDecoder | None]:
+    """
+    Reads the handshake request and detects the transport.
+    Protocol 1 clients send the bare ``PUBLIC_KEY:`` line, framed clients a HANDSHAKE frame.
+    The first byte is enough to tell them apart, since no allowed frame length starts with ``P``.
+    The returned decoder keeps any frames the client pipelined after its handshake.
+    ``timeout`` bounds the whole read, a client trickling its handshake byte by byte gets no more time.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    _set_deadline(conn, deadline)
+    data = conn.recv(CONFIG.buffer_size)
+    if data[:1] == CONFIG.sign_message_prefix[:1]:
+        return data, None
+    decoder = FrameDecoder()
+    decoder.feed(data)
+    while True:
+        for frame_type, payload in decoder:
+            if frame_type != FrameType.HANDSHAKE:
+                raise FrameError(f'Expected handshake, got {frame_type.name}')
+            return bytes(payload), decoder
+        _set_deadline(conn, deadline)
+        if not decoder.recv_into(conn):
+            raise ConnectionResetError('Connection closed during handshake')
+
+
+def _wants_message_ids(options: dict[str, str]) -> bool:
+    return options.get('ids') == '1'
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class HistoryCursor:
+    """
+    History a client asked for in its handshake: messages after ``since``, at most the newest ``limit``.
+    A client that keeps its own history cache asks for ``message_ids`` to learn the ``since`` of its next handshake.
+    """
+    since: uuid.UUID | None = None
+    limit: int | None = None
+    message_ids: bool = False
+
+    @classmethod
+    def from_options(cls, options: dict[str, str]) -> Self:
+        since = uuid.UUID(options['since']) if options.get('since') else None
+        if since is not None and since.version != 7:
+            # an id from before ids were ordered, the message has an ordered one now: the client gets a full sync
+            since = None
+        limits = [
+            limit for limit in (
+                max(int(options['limit']), 1) if options.get('limit') else None,
+                CONFIG.history_sync_limit
+            )
+            if limit is not None
+        ]
+        return cls(since=since, limit=min(limits, default=None), message_ids=_wants_message_ids(options))
 
 
 @dataclasses.dataclass(slots=True)
 class AuthContext:
     user: User
-    socket: socket
+    socket: socket | StreamSocket
+    public_key: PublicKey
+    cipher: SessionCipher | None = None
+    decoder: FrameDecoder | None = None
+    history_cursor: HistoryCursor = dataclasses.field(default_factory=HistoryCursor)
+    # set when the client negotiated compression, see ``SignedMessage.answer``
+    compressor: SharedCompressor | None = None
+    room_id: uuid.UUID = LOBBY_ROOM_ID
+    outbound: OutboundQueue | AsyncOutboundQueue | None = None
+    connection_id: int = dataclasses.field(default_factory=lambda: next(_connection_ids))
+    # the client is in its room before the history is read, so recent messages may come both ways
+    _synced_ids: set[uuid.UUID] = dataclasses.field(default_factory=set, repr=False, compare=False)
+    _synced_at: float = 0.0
+    _write_lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock,
+        repr=False,
+        compare=False
+    )
+
+    def encrypt_all(self, messages: list[bytes]) -> list[bytes]:
+        """Protocol 1 messages are RSA encrypted on the crypto pool, all of them submitted before waiting."""
+        if self.cipher is not None:
+            return [self.cipher.seal(message) for message in messages]
+        return rsa_encrypt(messages, self.public_key)
+
+    def encrypt(self, message: bytes) -> bytes:
+        return self.encrypt_all([message])[0]
+
+    @property
+    def fingerprint(self) -> str:
+        return self.user.fingerprint
+
+    def decrypt(self, data: bytes) -> bytes:
+        with METRICS.time(Timing.DECRYPT):
+            if self.cipher is not None:
+                return self.cipher.open(data)
+            return rsa_decrypt(data)
+
+    def encode(
+            self,
+            message: bytes,
+            frame_type: FrameType = FrameType.CHAT
+    ) -> list[bytes]:
+        return self._encode_payloads([(frame_type, message)])
+
+    @property
+    def message_ids(self) -> bool:
+        """Whether stored messages go out prefixed with their id, only protocol 2 clients can ask for it."""
+        return self.cipher is not None and self.history_cursor.message_ids
+
+    def _tag(self, message_id: uuid.UUID | None, message: bytes) -> bytes:
+        return encode_message(message_id, message) if self.message_ids else message
+
+    def _history_payloads(
+            self,
+            messages: tuple[bytes, ...] | list[bytes],
+            message_ids: tuple[uuid.UUID | None, ...] | list[uuid.UUID | None]
+    ) -> list[tuple[FrameType, bytes]]:
+        """Framed clients get ``CONFIG.history_batch_size`` messages per encrypted frame."""
+        messages = [self._tag(message_id, message) for message_id, message in zip(message_ids, messages)]
+        if self.decoder is None:
+            return [(FrameType.CHAT, message) for message in messages]
+        return [
+            (FrameType.HISTORY_BATCH, encode_batch(messages[start:start + CONFIG.history_batch_size]))
+            for start in range(0, len(messages), CONFIG.history_batch_size)
+        ]
+
+    def _encode_payloads(self, payloads: list[tuple[FrameType, bytes]]) -> list[bytes]:
+        with METRICS.time(Timing.ENCODE):
+            if self.compressor is not None:
+                payloads = [(frame_type, self.compressor.pack(payload)) for frame_type, payload in payloads]
+            encrypted = self.encrypt_all([payload for _, payload in payloads])
+            if self.decoder is None:
+                return encrypted
+            return frame_buffers(zip((frame_type for frame_type, _ in payloads), encrypted))
+
+    def encode_history(self, messages: list[CachedMessage]) -> list[bytes]:
+        """Remembers the ids of the recent ones, ``encode_outbound`` skips them if they are fanned out as well."""
+        recent = newest_uuid_at(time.time() - CONFIG.history_dedup_seconds)
+        self._synced_ids.update(message.id for message in messages if message.id > recent)
+        self._synced_at = time.monotonic()
+        return self._encode_payloads(
+            self._history_payloads(
+                [message.content for message in messages],
+                [message.id for message in messages]
+            )
+        )
+
+    def _skip_synced(self, messages: list[OutboundMessage]) -> list[OutboundMessage]:
+        if not self._synced_ids:
+            return messages
+        if time.monotonic() - self._synced_at > CONFIG.history_dedup_seconds:
+            self._synced_ids.clear()
+            return messages
+        unsynced = []
+        for message in messages:
+            if not message.message_ids or self._synced_ids.isdisjoint(message.message_ids):
+                unsynced.append(message)
+            elif entries := [
+                (entry, message_id)
+                for entry, message_id in zip(message.entries, message.message_ids)
+                if message_id not in self._synced_ids
+            ]:
+                unsynced.append(dataclasses.replace(
+                    message,
+                    content=tuple(entry for entry, _ in entries),
+                    message_ids=tuple(message_id for _, message_id in entries)
+                ))
+        return unsynced
+
+    def encode_outbound(self, messages: list[OutboundMessage]) -> list[bytes]:
+        payloads = []
+        for message in self._skip_synced(messages):
+            if not isinstance(message.content, bytes):
+                payloads.extend(self._history_payloads(message.content, message.entry_ids))
+            elif message.frame_type == FrameType.AI_PARTIAL:
+                payloads.append((message.frame_type, message.content))
+            else:
+                payloads.append((message.frame_type, self._tag(message.entry_ids[0], message.content)))
+        return self._encode_payloads(payloads)
+
+    def write(self, buffers: list[bytes]) -> None:
+        # history sync and the outbound writer run on different threads
+        with self._write_lock, METRICS.time(Timing.SOCKET_WRITE):
+            send_buffers(self.socket, buffers)
+
+    def receive(self) -> Iterator[bytes]:
+        """Yields raw chat messages read from a blocking socket until the client disconnects."""
+        if self.decoder is None:
+            # blocks sent while the previous one was decrypted arrive in one read
+            block_size = rsa_block_size()
+            buffer = b''
+            while data := self.socket.recv(CONFIG.buffer_size):
+                buffer += data
+                while len(buffer) >= block_size:
+                    yield buffer[:block_size]
+                    buffer = buffer[block_size:]
+            return
+        while True:
+            for frame_type, payload in self.decoder:
+                if frame_type == FrameType.CHAT:
+                    yield payload
+            if not self.decoder.recv_into(self.socket):
+                return
+
+
+@dataclasses.dataclass(slots=True)
+class SignedMessage:
+    """
+    A message to fan out to the members of ``room_id``, ``auth_context`` is ``None`` for messages from another
+    server instance or from Gemma. With a ``command`` the client entered ``room_id`` and ``content`` is the notice
+    it gets. The member with the connection id ``skip`` already has the message, e.g. Gemma's answer to its question.
+    """
+    auth_context: AuthContext | None
+    content: bytes
+    message_id: uuid.UUID | None = None
+    room_id: uuid.UUID = LOBBY_ROOM_ID
+    command: RoomCommand | None = None
+    skip: int | None = None
+
+    @classmethod
+    def validate(cls, message: bytes) -> tuple[PublicKey, str, dict[str, str]]:
+        assert message.startswith(CONFIG.sign_message_prefix)
+        _, public_key, user_name, *options = message.split(b':')
+        client_public_key = rsa.PublicKey.load_pkcs1(public_key.replace(b'\\n', b'\n'))
+        # the fingerprint identifies the key in logs, the key itself is not logged
+        logger.info(f'Received handshake from {user_name.decode("utf-8")}, key {User.fingerprint_of(client_public_key)}')
+        return (
+            client_public_key,
+            user_name.decode('utf-8'),
+            parse_options(options)
+        )
+
+    @classmethod
+    def answer(
+            cls,
+            client_public_key: PublicKey,
+            options: dict[str, str],
+            framed: bool = False
+    ) -> tuple[bytes, SessionCipher | None, SharedCompressor | None]:
+        """
+        Builds the handshake answer, framed if the request was.
+        Clients that ask for protocol 2 get a fresh session key wrapped with their public key,
+        everyone else keeps per-message RSA. Protocol 2 clients may also ask for message ids and compression,
+        the negotiated compressor is returned for the client's ``AuthContext``.
+        """
+        answer = CONFIG.sign_message_prefix + CONFIG.server_keys[0].save_pkcs1()
+        cipher = None
+        compressor = None
+        protocol_version = int(options.get('proto', LEGACY_PROTOCOL_VERSION))
+        if protocol_version >= PROTOCOL_VERSION:
+            session_key = SessionCipher.generate_key()
+            answer_options = {
+                'proto': PROTOCOL_VERSION,
+                'key': wrap_key(session_key, client_public_key).decode()
+            }
+            if _wants_message_ids(options):
+                answer_options['ids'] = 1
+            if (compressor := negotiate_compressor(options)) is not None:
+                answer_options['compress'] = compressor.codec.name
+            answer += b':' + encode_options(**answer_options)
+            cipher = SessionCipher(session_key, initiator=False)
+        if framed:
+            answer = encode_frame(FrameType.HANDSHAKE, answer)
+        return answer, cipher, compressor
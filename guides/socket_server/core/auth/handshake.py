@@ -0,0 +1,110 @@
+import contextlib
+import dataclasses
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Iterator
+from enum import StrEnum
+
+from socket_protocol import FrameError
+
+from core.metrics.registry import METRICS, Timing
+
+LATENCY_WINDOW = 1024
+
+
+class HandshakePhase(StrEnum):
+    READ = 'read'
+    AUTH = 'auth'
+    ANSWER = 'answer'
+    SYNC = 'sync'
+
+
+class HandshakeTimeoutError(TimeoutError):
+    def __init__(self, phase: HandshakePhase) -> None:
+        super().__init__(f'Handshake timed out in the {phase} phase')
+        self.phase = phase
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+@dataclasses.dataclass(slots=True)
+class HandshakeMetrics:
+    """
+    Handshake counters shared by a server's accept loop and handshake workers.
+    Latency is measured from ``accept`` until the client is registered, over the last ``LATENCY_WINDOW`` handshakes.
+    """
+    completed: int = 0
+    rejected: int = 0
+    failures: Counter[str] = dataclasses.field(default_factory=Counter)
+    phase_seconds: Counter[str] = dataclasses.field(default_factory=Counter)
+    phase_counts: Counter[str] = dataclasses.field(default_factory=Counter)
+    latencies: deque[float] = dataclasses.field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW))
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock,
+        repr=False,
+        compare=False
+    )
+
+    @contextlib.contextmanager
+    def phase(self, phase: HandshakePhase) -> Iterator[None]:
+        """Times one phase, a timeout inside it is re-raised as ``HandshakeTimeoutError``."""
+        started = time.perf_counter()
+        try:
+            yield
+        except TimeoutError as e:
+            if isinstance(e, HandshakeTimeoutError):
+                raise
+            raise HandshakeTimeoutError(phase) from e
+        finally:
+            with self._lock:
+                self.phase_seconds[phase] += time.perf_counter() - started
+                self.phase_counts[phase] += 1
+
+    def complete(self, started: float) -> None:
+        latency = time.perf_counter() - started
+        METRICS.observe(Timing.HANDSHAKE, latency)
+        with self._lock:
+            self.completed += 1
+            self.latencies.append(latency)
+
+    def reject(self) -> None:
+        """Counts a connection closed right after ``accept`` because too many handshakes were pending."""
+        with self._lock:
+            self.rejected += 1
+
+    def fail(self, error: BaseException) -> str:
+        match error:
+            case HandshakeTimeoutError():
+                reason = f'{error.phase}_timeout'
+            case ConnectionError():
+                reason = 'reset'
+            case AssertionError() | ValueError() | FrameError():
+                reason = 'invalid'
+            case _:
+                reason = 'error'
+        with self._lock:
+            self.failures[reason] += 1
+        return reason
+
+    def report(self) -> str:
+        with self._lock:
+            latencies = sorted(self.latencies)
+            failures = ','.join(f'{reason}:{count}' for reason, count in sorted(self.failures.items()))
+            phases = ' '.join(
+                f'{phase}_mean={self.phase_seconds[phase] / count * 1000:.1f}ms'
+                for phase, count in self.phase_counts.items()
+            )
+            return (
+                f'completed={self.completed} '
+                f'rejected={self.rejected} '
+                f'failed={sum(self.failures.values())}({failures}) '
+                f'p50={_percentile(latencies, 0.50) * 1000:.1f}ms '
+                f'p95={_percentile(latencies, 0.95) * 1000:.1f}ms '
+                f'p99={_percentile(latencies, 0.99) * 1000:.1f}ms '
+                f'{phases}'
+            ).rstrip()
@@ -0,0 +1,10 @@
+from core.broker.base import Broker, BrokerMessage, LocalBroker, create_broker
+from core.broker.ipc import IPCBroker
+
+__all__ = [
+    'Broker',
+    'BrokerMessage',
+    'IPCBroker',
+    'LocalBroker',
+    'create_broker'
+]
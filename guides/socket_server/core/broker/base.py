@@ -0,0 +1,94 @@
+import abc
+import dataclasses
+import uuid
+from collections.abc import Callable
+from typing import Self
+
+from config import CONFIG
+from core.models import LOBBY_ROOM_ID
+
+MESSAGE_ID_SIZE = 16
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class BrokerMessage:
+    """
+    A stored chat message as it travels between server instances.
+    ``broadcast`` is false for messages that only belong in history, other instances cache them without a fan-out.
+    A ``gap`` carries no message: its sender dropped messages with ids up to ``id`` without publishing them.
+    """
+    id: uuid.UUID
+    content: bytes
+    room_id: uuid.UUID = LOBBY_ROOM_ID
+    broadcast: bool = True
+    gap: bool = False
+
+    def encode(self) -> bytes:
+        flags = self.broadcast | self.gap << 1
+        return self.id.bytes + self.room_id.bytes + bytes((flags,)) + self.content
+
+    @classmethod
+    def decode(cls, data: bytes) -> Self:
+        flags = data[2 * MESSAGE_ID_SIZE]
+        return cls(
+            id=uuid.UUID(bytes=data[:MESSAGE_ID_SIZE]),
+            room_id=uuid.UUID(bytes=data[MESSAGE_ID_SIZE:2 * MESSAGE_ID_SIZE]),
+            content=data[2 * MESSAGE_ID_SIZE + 1:],
+            broadcast=bool(flags & 1),
+            gap=bool(flags & 2)
+        )
+
+
+class Broker(abc.ABC):
+    """
+    Fan-out of stored messages to the other server instances sharing the database.
+    Every instance delivers its own messages to its own clients, ``publish`` hands them to the others,
+    whose ``on_message`` is called once per message, so each client gets a message exactly once.
+    When messages with ids up to some id may have been lost on the way, ``on_gap`` is called with that id,
+    so what was cached from the broker up to there is no longer taken as complete.
+    """
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def start(
+            self,
+            on_message: Callable[[BrokerMessage], None],
+            on_gap: Callable[[uuid.UUID], None] | None = None
+    ) -> None:
+        ...
+
+    @abc.abstractmethod
+    def publish(self, message: BrokerMessage) -> None:
+        ...
+
+    def close(self) -> None:
+        pass
+
+    @property
+    def stats(self) -> dict[str, int | str]:
+        return {}
+
+
+@dataclasses.dataclass(slots=True)
+class LocalBroker(Broker):
+    """A single instance has no one to publish to."""
+
+    def start(
+            self,
+            on_message: Callable[[BrokerMessage], None],
+            on_gap: Callable[[uuid.UUID], None] | None = None
+    ) -> None:
+        pass
+
+    def publish(self, message: BrokerMessage) -> None:
+        pass
+
+
+def create_broker() -> Broker:
+    match CONFIG.broker_backend:
+        case 'local':
+            return LocalBroker()
+        case 'ipc':
+            from core.broker.ipc import IPCBroker
+            return IPCBroker.from_config()
+    raise ValueError(f'Unknown broker backend {CONFIG.broker_backend}')
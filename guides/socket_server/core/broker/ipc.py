@@ -0,0 +1,267 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Callable
+from multiprocessing.connection import AuthenticationError, Client, Connection, Listener
+from typing import Self
+
+from config import CONFIG
+from core.broker.base import Broker, BrokerMessage
+from core.models.message import newest_uuid_at
+
+logger = logging.getLogger(__name__)
+
+
+class _Hub:
+    """Relays every message to all connected instances but its sender."""
+    __slots__ = ('_listener', '_send_locks', '_lock')
+
+    def __init__(self, listener: Listener) -> None:
+        self._listener = listener
+        self._send_locks: dict[Connection, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError) as e:
+                logger.warning(f'Broker hub refused a connection: {e}')
+                continue
+            except OSError:
+                return
+            with self._lock:
+                self._send_locks[connection] = threading.Lock()
+            threading.Thread(target=self._relay, args=(connection,), name='broker-relay', daemon=True).start()
+
+    def _relay(self, connection: Connection) -> None:
+        try:
+            while True:
+                data = connection.recv_bytes()
+                with self._lock:
+                    peers = [(peer, lock) for peer, lock in self._send_locks.items() if peer is not connection]
+                for peer, lock in peers:
+                    try:
+                        with lock:
+                            peer.send_bytes(data)
+                    except OSError:
+                        self._drop(peer)
+        except (EOFError, OSError):
+            self._drop(connection)
+
+    def _drop(self, connection: Connection) -> None:
+        with self._lock:
+            self._send_locks.pop(connection, None)
+        connection.close()
+
+
+class IPCBroker(Broker):
+    """
+    Broker over local TCP between instances, with a hub bundled into the instances themselves.
+    The first instance to find no hub on ``address`` binds it and relays for everyone, itself included;
+    when the hub instance stops, the others reconnect and one of them takes over.
+    Messages wait in a bounded outbox while disconnected and are resent if a send fails,
+    duplicates are dropped by message id, so a resend never reaches a client twice.
+    What cannot be delivered is reported through ``on_gap`` instead: on every reconnection for what was relayed
+    while this instance was not connected, and on the peers for what a full outbox dropped, with a gap message.
+    The first connection reports nothing, this instance had no clients yet to miss anything.
+    The connections authenticate with the storage key, which instances sharing a database share anyway.
+    """
+    __slots__ = (
+        '_address',
+        '_authkey',
+        '_outbox',
+        '_connection',
+        '_condition',
+        '_seen',
+        '_on_message',
+        '_on_gap',
+        '_dropped_until',
+        '_listener',
+        'reconnect_interval',
+        'dedup_size',
+        'hub',
+        'published',
+        'received',
+        'duplicates',
+        'dropped',
+        'gaps'
+    )
+
+    def __init__(
+            self,
+            address: tuple[str, int],
+            authkey: bytes,
+            *,
+            reconnect_interval: float,
+            outbox_size: int,
+            dedup_size: int
+    ) -> None:
+        self._address = address
+        self._authkey = authkey
+        self._outbox: queue.Queue[BrokerMessage] = queue.Queue(maxsize=outbox_size)
+        self._connection: Connection | None = None
+        self._condition = threading.Condition()
+        self._seen: OrderedDict[uuid.UUID, None] = OrderedDict()
+        self._on_message: Callable[[BrokerMessage], None] | None = None
+        self._on_gap: Callable[[uuid.UUID], None] | None = None
+        # newest id dropped from the full outbox, announced to the peers before the next message
+        self._dropped_until: uuid.UUID | None = None
+        self._listener: Listener | None = None
+        self.reconnect_interval = reconnect_interval
+        self.dedup_size = dedup_size
+        self.hub = False
+        self.published = 0
+        self.received = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.gaps = 0
+
+    @classmethod
+    def from_config(cls) -> Self:
+        return cls(
+            (CONFIG.broker_host, CONFIG.broker_port),
+            CONFIG.storage_key,
+            reconnect_interval=CONFIG.broker_reconnect_interval,
+            outbox_size=CONFIG.broker_outbox_size,
+            dedup_size=CONFIG.broker_dedup_size
+        )
+
+    @property
+    def stats(self) -> dict[str, int | str]:
+        return {
+            'role': 'hub' if self.hub else 'peer',
+            'connected': int(self._connection is not None),
+            'outbox': self._outbox.qsize(),
+            'published': self.published,
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'dropped': self.dropped,
+            'gaps': self.gaps
+        }
+
+    def start(
+            self,
+            on_message: Callable[[BrokerMessage], None],
+            on_gap: Callable[[uuid.UUID], None] | None = None
+    ) -> None:
+        self._on_message = on_message
+        self._on_gap = on_gap
+        threading.Thread(target=self._receive, name='broker-receiver', daemon=True).start()
+        threading.Thread(target=self._send, name='broker-sender', daemon=True).start()
+
+    def publish(self, message: BrokerMessage) -> None:
+        try:
+            self._outbox.put_nowait(message)
+        except queue.Full:
+            with self._condition:
+                self.dropped += 1
+                if self._dropped_until is None or message.id > self._dropped_until:
+                    self._dropped_until = message.id
+            logger.warning(f'Broker outbox full, message {message.id} is not published')
+
+    def close(self) -> None:
+        with self._condition:
+            if self._connection is not None:
+                self._connection.close()
+        if self._listener is not None:
+            self._listener.close()
+
+    def _connect(self) -> Connection | None:
+        try:
+            return Client(self._address, authkey=self._authkey)
+        except ConnectionRefusedError:
+            pass
+        try:
+            self._listener = Listener(self._address, authkey=self._authkey)
+        except OSError:
+            # another instance bound the hub first
+            return None
+        self.hub = True
+        threading.Thread(target=_Hub(self._listener).serve, name='broker-hub', daemon=True).start()
+        logger.info(f'Broker hub listening on {self._address[0]}:{self._address[1]}')
+        return Client(self._address, authkey=self._authkey)
+
+    def _receive(self) -> None:
+        reconnected = False
+        while True:
+            try:
+                connection = self._connect()
+            except (OSError, AuthenticationError, EOFError) as e:
+                logger.warning(f'Broker connection failed: {e}')
+                connection = None
+            if connection is None:
+                time.sleep(self.reconnect_interval)
+                continue
+            logger.info(f'Broker connected as {"hub" if self.hub else "peer"}, {self.stats}')
+            with self._condition:
+                self._connection = connection
+                self._condition.notify_all()
+            if reconnected:
+                # whatever was relayed while disconnected did not reach this instance
+                self._gap(newest_uuid_at(time.time()))
+            reconnected = True
+            try:
+                while True:
+                    self._deliver(BrokerMessage.decode(connection.recv_bytes()))
+            except (EOFError, OSError):
+                logger.warning(f'Broker connection lost, {self.stats}')
+            with self._condition:
+                self._connection = None
+            connection.close()
+            time.sleep(self.reconnect_interval)
+
+    def _gap(self, until: uuid.UUID) -> None:
+        self.gaps += 1
+        if self._on_gap is None:
+            return
+        try:
+            self._on_gap(until)
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+
+    def _deliver(self, message: BrokerMessage) -> None:
+        if message.gap:
+            logger.warning(f'A peer dropped messages up to {message.id}')
+            self._gap(message.id)
+            return
+        if message.id in self._seen:
+            self.duplicates += 1
+            return
+        self._seen[message.id] = None
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+        self.received += 1
+        try:
+            self._on_message(message)
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+
+    def _send(self) -> None:
+        message = None
+        while True:
+            if message is None:
+                message = self._outbox.get()
+            with self._condition:
+                self._condition.wait_for(lambda: self._connection is not None)
+                connection = self._connection
+                dropped_until, self._dropped_until = self._dropped_until, None
+            try:
+                if dropped_until is not None:
+                    connection.send_bytes(BrokerMessage(id=dropped_until, content=b'', gap=True).encode())
+                connection.send_bytes(message.encode())
+            except OSError:
+                # resent once reconnected, the receivers drop it if the hub relayed it already
+                with self._condition:
+                    if dropped_until is not None and (
+                            self._dropped_until is None or dropped_until > self._dropped_until
+                    ):
+                        self._dropped_until = dropped_until
+                connection.close()
+                time.sleep(self.reconnect_interval)
+                continue
+            self.published += 1
+            message = None
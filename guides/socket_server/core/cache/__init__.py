@@ -0,0 +1,4 @@
+from core.cache.answers import AnswerCache
+from core.cache.messages import CachedMessage, RecentMessagesCache, read_history, warm_from_database
+
+__all__ = ['AnswerCache', 'CachedMessage', 'RecentMessagesCache', 'read_history', 'warm_from_database']
@@ -0,0 +1,128 @@
+import dataclasses
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from core.handlers import CachedAnswerHandler
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Case, spacing and trailing punctuation do not change what is being asked."""
+    return _WHITESPACE.sub(' ', prompt.casefold()).strip().rstrip('?!. ')
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class CachedAnswerEntry:
+    answer: str
+    # the answer's share of the time its batch took, what a hit saves
+    generation_seconds: float
+    created_at: float
+
+
+class AnswerCache:
+    """
+    LRU cache of Gemma answers keyed by the normalized prompt and the generation parameters.
+    Bounded by ``max_size`` entries and ``max_bytes`` of answer text, entries expire after ``ttl`` seconds.
+    With ``persist`` misses fall back to the ``cached_answers`` table, so answers survive restarts;
+    ``get`` may therefore query the database, ``lookup`` only ever reads memory.
+    """
+    __slots__ = (
+        '_entries',
+        '_bytes',
+        '_lock',
+        'max_size',
+        'max_bytes',
+        'ttl',
+        'persist',
+        'hits',
+        'misses',
+        'saved_seconds'
+    )
+
+    def __init__(self, max_size: int, max_bytes: int, ttl: float, persist: bool = False) -> None:
+        self._entries: OrderedDict[str, CachedAnswerEntry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(prompt: str, **parameters: object) -> str:
+        parameters = '\0'.join(f'{name}={value}' for name, value in sorted(parameters.items()))
+        return hashlib.sha256(f'{parameters}\0{normalize_prompt(prompt)}'.encode()).hexdigest()
+
+    def lookup(self, key: str) -> str | None:
+        """Memory only and never blocks on the database, a miss is not counted since ``get`` follows."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.created_at > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return self._hit(entry)
+
+    def get(self, key: str) -> str | None:
+        if (answer := self.lookup(key)) is not None:
+            return answer
+        stored = CachedAnswerHandler.get_answer(key, ttl=self.ttl) if self.persist else None
+        with self._lock:
+            if stored is None:
+                self.misses += 1
+                return None
+            answer, generation_seconds, created_at = stored
+            entry = CachedAnswerEntry(answer=answer, generation_seconds=generation_seconds, created_at=created_at)
+            self._put(key, entry)
+            return self._hit(entry)
+
+    def put(self, key: str, answer: str, generation_seconds: float) -> None:
+        entry = CachedAnswerEntry(answer=answer, generation_seconds=generation_seconds, created_at=time.time())
+        with self._lock:
+            self._put(key, entry)
+        if self.persist:
+            CachedAnswerHandler.store_answer(key=key, answer=answer, generation_seconds=generation_seconds)
+
+    def delete_expired(self) -> None:
+        """Persisted entries nobody asks for again are never deleted by ``get``, they are deleted here."""
+        if self.persist:
+            CachedAnswerHandler.delete_expired(ttl=self.ttl)
+
+    def _hit(self, entry: CachedAnswerEntry) -> str:
+        self.hits += 1
+        self.saved_seconds += entry.generation_seconds
+        return entry.answer
+
+    def _put(self, key: str, entry: CachedAnswerEntry) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += len(entry.answer)
+        while self._entries and (len(self._entries) > self.max_size or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        self._bytes -= len(self._entries.pop(key).answer)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'saved_seconds': round(self.saved_seconds, 2)
+        }
@@ -0,0 +1,174 @@
+import bisect
+import dataclasses
+import logging
+import threading
+import uuid
+from collections import deque
+from collections.abc import Iterator
+
+from core.archive.segments import message_archive
+from core.handlers import MessageHandler, WriteBehindError
+from core.models import LOBBY_ROOM_ID
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class CachedMessage:
+    id: uuid.UUID
+    content: bytes
+    room_id: uuid.UUID = LOBBY_ROOM_ID
+
+
+class RecentMessagesCache:
+    """
+    Bounded ring of the newest decrypted messages of all rooms, ordered by id.
+    Oldest messages are evicted once either ``max_size`` or ``max_bytes`` is exceeded.
+    The cache remembers the newest id it has evicted, so it knows which history requests it can answer on its own.
+    Until ``warm`` has been called it answers nothing, since it cannot know what the table holds.
+    """
+    __slots__ = (
+        '_messages',
+        '_bytes',
+        '_covered_after',
+        '_warm',
+        '_lock',
+        'max_size',
+        'max_bytes',
+        'hits',
+        'misses'
+    )
+
+    def __init__(self, max_size: int, max_bytes: int) -> None:
+        self._messages: deque[CachedMessage] = deque()
+        self._bytes = 0
+        self._covered_after: uuid.UUID | None = None
+        self._warm = False
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def warm(self, messages: list[tuple[uuid.UUID, bytes, uuid.UUID]], complete: bool) -> None:
+        """
+        Seeds the cache with the newest messages of the table, oldest first.
+        ``complete`` tells whether these are all the messages there are.
+        """
+        with self._lock:
+            self._messages.clear()
+            self._bytes = 0
+            self._covered_after = None
+            for message_id, content, room_id in messages:
+                self._append(CachedMessage(id=message_id, content=content, room_id=room_id))
+            if not complete and self._messages and self._covered_after is None:
+                # what precedes the oldest message is unknown, so only what comes after it counts as covered
+                oldest = self._messages.popleft()
+                self._bytes -= len(oldest.content)
+                self._covered_after = oldest.id
+            self._warm = True
+
+    def append(self, message_id: uuid.UUID, content: bytes, room_id: uuid.UUID = LOBBY_ROOM_ID) -> None:
+        with self._lock:
+            self._append(CachedMessage(id=message_id, content=content, room_id=room_id))
+
+    def invalidate(self, until: uuid.UUID) -> None:
+        """
+        Forgets the messages up to ``until``, some of those may never have reached the cache,
+        e.g. while the broker was disconnected. History reaching back before it is read from the table again.
+        """
+        with self._lock:
+            while self._messages and self._messages[0].id <= until:
+                self._bytes -= len(self._messages.popleft().content)
+            if self._covered_after is None or until > self._covered_after:
+                self._covered_after = until
+
+    def _append(self, message: CachedMessage) -> None:
+        if self._covered_after is not None and message.id <= self._covered_after:
+            # history up to there is read from the table anyway
+            return
+        if self._messages and message.id < self._messages[-1].id:
+            # writers race between persisting and caching, keep id order
+            index = bisect.bisect(self._messages, message.id, key=lambda cached: cached.id)
+            self._messages.insert(index, message)
+        else:
+            self._messages.append(message)
+        self._bytes += len(message.content)
+        while self._messages and (len(self._messages) > self.max_size or self._bytes > self.max_bytes):
+            evicted = self._messages.popleft()
+            self._bytes -= len(evicted.content)
+            self._covered_after = evicted.id
+
+    def history(
+            self,
+            room_id: uuid.UUID = LOBBY_ROOM_ID,
+            since: uuid.UUID | None = None,
+            limit: int | None = None
+    ) -> list[CachedMessage] | None:
+        """
+        Messages of ``room_id`` newer than ``since`` (at most the newest ``limit``), or ``None`` on a miss,
+        meaning some of them may have been evicted and the caller has to read the table.
+        Eviction is shared by all rooms, so what is covered does not depend on the room.
+        """
+        with self._lock:
+            newer = [
+                message
+                for message in self._messages
+                if message.room_id == room_id and (since is None or message.id > since)
+            ]
+            covered = self._covered_after is None or (since is not None and since >= self._covered_after)
+            if self._warm and (covered or (limit is not None and len(newer) >= limit)):
+                self.hits += 1
+                return newer[-limit:] if limit is not None else newer
+            self.misses += 1
+            return None
+
+    def recent(self, limit: int, room_id: uuid.UUID = LOBBY_ROOM_ID) -> list[CachedMessage] | None:
+        return self.history(room_id=room_id, limit=limit)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            'size': len(self._messages),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def warm_from_database(cache: RecentMessagesCache) -> None:
+    messages = [
+        (message.id, MessageHandler.signed_content(message), message.room_id)
+        for chunk in MessageHandler.iter_history(limit=cache.max_size + 1)
+        for message in chunk
+    ]
+    # archived messages are older than the table's, so the cache cannot hold all there are
+    cache.warm(messages, complete=len(messages) <= cache.max_size and message_archive().is_empty())
+
+
+def read_history(
+        cache: RecentMessagesCache,
+        *,
+        room_id: uuid.UUID = LOBBY_ROOM_ID,
+        since: uuid.UUID | None,
+        limit: int | None,
+        chunk_size: int
+) -> Iterator[list[CachedMessage]]:
+    """Signed history of a room in chunks, served from ``cache`` when it can, from the messages table otherwise."""
+    history = cache.history(room_id=room_id, since=since, limit=limit)
+    if history is not None:
+        for start in range(0, len(history), chunk_size):
+            yield history[start:start + chunk_size]
+        return
+    try:
+        MessageHandler.flush()
+    except WriteBehindError as e:
+        logger.warning(f'History of room {room_id} served without uncommitted messages: {e}')
+    for messages in MessageHandler.iter_history(room_id=room_id, since=since, limit=limit, chunk_size=chunk_size):
+        yield [
+            CachedMessage(id=message.id, content=MessageHandler.signed_content(message), room_id=message.room_id)
+            for message in messages
+        ]
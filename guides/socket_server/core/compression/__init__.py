@@ -0,0 +1,3 @@
+from core.compression.shared import SharedCompressor, compression_stats, negotiate_compressor, shared_compressor
+
+__all__ = ['SharedCompressor', 'compression_stats', 'negotiate_compressor', 'shared_compressor']
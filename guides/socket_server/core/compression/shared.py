@@ -0,0 +1,103 @@
+import functools
+import threading
+from collections import OrderedDict
+from typing import Self
+
+from socket_protocol import (
+    CODECS,
+    LEGACY_PROTOCOL_VERSION,
+    PROTOCOL_VERSION,
+    Codec,
+    PayloadCompressor,
+    negotiate_codec
+)
+
+from config import CONFIG
+
+
+class SharedCompressor(PayloadCompressor):
+    """
+    One per codec, shared by every client that negotiated it. Payloads are encrypted per client
+    but compressed before that, so a message fanned out to a room is compressed once:
+    the newest packed payloads are kept, keyed by the payload, up to ``cache_size`` of them and ``cache_bytes``.
+    """
+    __slots__ = (
+        '_packed',
+        '_bytes',
+        '_lock',
+        'cache_size',
+        'cache_bytes',
+        'hits',
+        'compressed',
+        'bytes_in',
+        'bytes_out'
+    )
+
+    def __init__(self, codec: Codec, threshold: int, cache_size: int, cache_bytes: int) -> None:
+        super().__init__(codec, threshold)
+        self._packed: OrderedDict[bytes, bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.hits = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @classmethod
+    def from_config(cls, name: str) -> Self:
+        return cls(
+            codec=CODECS[name](CONFIG.compression_level),
+            threshold=CONFIG.compression_threshold,
+            cache_size=CONFIG.compression_cache_size,
+            cache_bytes=CONFIG.compression_cache_bytes
+        )
+
+    def pack(self, payload: bytes) -> bytes:
+        if len(payload) < self.threshold:
+            return super().pack(payload)
+        with self._lock:
+            if (packed := self._packed.get(payload)) is not None:
+                self._packed.move_to_end(payload)
+                self.hits += 1
+                return packed
+        # compressed outside the lock, two writers racing on the same payload both compress it once
+        packed = super().pack(payload)
+        with self._lock:
+            if payload not in self._packed:
+                self._packed[payload] = packed
+                self._bytes += len(payload) + len(packed)
+            while self._packed and (len(self._packed) > self.cache_size or self._bytes > self.cache_bytes):
+                evicted, evicted_packed = self._packed.popitem(last=False)
+                self._bytes -= len(evicted) + len(evicted_packed)
+            self.compressed += 1
+            self.bytes_in += len(payload)
+            self.bytes_out += len(packed)
+        return packed
+
+    @property
+    def stats(self) -> dict[str, str | int | float]:
+        return {
+            'codec': self.codec.name,
+            'compressed': self.compressed,
+            'cache_hits': self.hits,
+            'ratio': round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else 0
+        }
+
+
+@functools.cache
+def shared_compressor(name: str) -> SharedCompressor:
+    return SharedCompressor.from_config(name)
+
+
+def negotiate_compressor(options: dict[str, str]) -> SharedCompressor | None:
+    """The compressor for the codec a protocol 2 client offered in its handshake, if the server accepts one."""
+    if int(options.get('proto', LEGACY_PROTOCOL_VERSION)) < PROTOCOL_VERSION or not options.get('compress'):
+        return None
+    name = negotiate_codec(options['compress'], CONFIG.compression_codecs)
+    return shared_compressor(name) if name is not None else None
+
+
+def compression_stats() -> dict[str, dict]:
+    return {name: shared_compressor(name).stats for name in CONFIG.compression_codecs if name in CODECS}
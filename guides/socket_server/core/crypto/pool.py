@@ -0,0 +1,226 @@
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from enum import StrEnum
+from typing import Self
+
+import rsa
+from rsa import PrivateKey, PublicKey, common
+
+from config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+RSA_PADDING_SIZE = 11
+
+# set in every worker process by ``_load_private_key``
+_private_key: PrivateKey | None = None
+
+
+def _utf8_chunks(message: bytes, chunk_size: int) -> list[bytes]:
+    """Splits ``message`` into chunks of at most ``chunk_size`` bytes without cutting a UTF-8 sequence."""
+    chunks = []
+    start = 0
+    while start < len(message):
+        end = min(start + chunk_size, len(message))
+        while start < end < len(message) and message[end] & 0xC0 == 0x80:
+            end -= 1
+        chunks.append(message[start:end])
+        start = end
+    return chunks
+
+
+def encrypt_message(message: bytes, public_key: PublicKey) -> bytes:
+    """Protocol 1 clients read one RSA block per line, so long messages go out as several blocks."""
+    block_size = common.byte_size(public_key.n) - RSA_PADDING_SIZE
+    return b''.join(
+        rsa.encrypt(chunk, pub_key=public_key)
+        for chunk in _utf8_chunks(message, block_size)
+    )
+
+
+def _load_private_key() -> None:
+    global _private_key
+    _private_key = CONFIG.server_keys[1]
+
+
+def _decrypt_batch(blocks: list[bytes]) -> list[bytes | rsa.DecryptionError]:
+    results = []
+    for block in blocks:
+        try:
+            results.append(rsa.decrypt(block, _private_key))
+        except rsa.DecryptionError as e:
+            results.append(e)
+    return results
+
+
+def _encrypt_batch(items: list[tuple[bytes, PublicKey]]) -> list[bytes]:
+    return [encrypt_message(message, public_key) for message, public_key in items]
+
+
+class CryptoOperation(StrEnum):
+    DECRYPT = 'decrypt'
+    ENCRYPT = 'encrypt'
+
+
+_BATCH_FUNCTIONS = {
+    CryptoOperation.DECRYPT: _decrypt_batch,
+    CryptoOperation.ENCRYPT: _encrypt_batch
+}
+
+
+class CryptoPool:
+    """
+    Runs RSA private-key decryption and bulk protocol 1 encryption in worker processes,
+    so pure-Python big integer work scales with cores instead of serializing every thread on the GIL.
+    Every worker loads the server private key from ``Config`` once, only ciphertexts and public keys cross processes.
+    Operations submitted within ``max_wait`` seconds of each other go to a worker together,
+    up to ``max_batch_size`` per task. Callers get one future per operation;
+    waiting for them in submission order keeps a client's messages in order.
+    """
+    __slots__ = (
+        '_executor',
+        '_pending',
+        '_condition',
+        '_thread',
+        'workers',
+        'max_batch_size',
+        'max_wait',
+        'batches',
+        'operations'
+    )
+
+    def __init__(self, workers: int, *, max_batch_size: int, max_wait: float) -> None:
+        # generates the key pair on a first run, before any worker tries to load it
+        CONFIG.server_keys  # noqa
+        # forking a process that already runs client threads can copy locks held by them
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_load_private_key
+        )
+        self._pending: deque[tuple[CryptoOperation, object, Future]] = deque()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='crypto-batcher', daemon=True)
+        self.workers = workers
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.operations = 0
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls) -> Self:
+        return cls(
+            CONFIG.crypto_workers or os.cpu_count() or 1,
+            max_batch_size=CONFIG.crypto_batch_size,
+            max_wait=CONFIG.crypto_batch_wait
+        )
+
+    @property
+    def stats(self) -> dict[str, float]:
+        return {
+            'pending': len(self._pending),
+            'batches': self.batches,
+            'operations': self.operations,
+            'mean_batch_size': round(self.operations / self.batches, 2) if self.batches else 0
+        }
+
+    def decrypt(self, block: bytes) -> Future[bytes]:
+        return self._submit(CryptoOperation.DECRYPT, block)
+
+    def encrypt(self, message: bytes, public_key: PublicKey) -> Future[bytes]:
+        return self._submit(CryptoOperation.ENCRYPT, (message, public_key))
+
+    def _submit(self, operation: CryptoOperation, item: object) -> Future:
+        future = Future()
+        with self._condition:
+            self._pending.append((operation, item, future))
+            self._condition.notify()
+        return future
+
+    def _next_batch(self) -> list[tuple[CryptoOperation, object, Future]]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending)
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    break
+            return [self._pending.popleft() for _ in range(min(self.max_batch_size, len(self._pending)))]
+
+    @staticmethod
+    def _resolve(futures: list[Future], done: Future) -> None:
+        try:
+            results = done.result()
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            for operation in CryptoOperation:
+                operations = [(item, future) for kind, item, future in batch if kind == operation]
+                if not operations:
+                    continue
+                items, futures = zip(*operations)
+                try:
+                    done = self._executor.submit(_BATCH_FUNCTIONS[operation], list(items))
+                except RuntimeError as e:
+                    # the pool was shut down with the server
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                done.add_done_callback(functools.partial(self._resolve, list(futures)))
+                self.batches += 1
+                self.operations += len(operations)
+
+
+@functools.cache
+def crypto_pool() -> CryptoPool | None:
+    """
+    The server-wide pool, created when the first protocol 1 client needs RSA,
+    so a server only protocol 2 clients connect to never spawns the workers. ``crypto_workers=0`` runs RSA inline.
+    """
+    if CONFIG.crypto_workers == 0:
+        return None
+    pool = CryptoPool.from_config()
+    logger.info(f'Crypto pool started with {pool.workers} workers')
+    return pool
+
+
+def crypto_pool_stats() -> dict[str, float] | None:
+    """``None`` until the pool was created, a metrics scrape must not spawn it."""
+    if not crypto_pool.cache_info().currsize or (pool := crypto_pool()) is None:
+        return None
+    return pool.stats
+
+
+def rsa_block_size() -> int:
+    """Protocol 1 clients send every message as one block of this size, encrypted with the server key."""
+    return common.byte_size(CONFIG.server_keys[0].n)
+
+
+def rsa_decrypt(block: bytes) -> bytes:
+    if (pool := crypto_pool()) is None:
+        return rsa.decrypt(block, CONFIG.server_keys[1])
+    return pool.decrypt(block).result()
+
+
+def rsa_encrypt(messages: list[bytes], public_key: PublicKey) -> list[bytes]:
+    """Encrypts ``messages`` for a protocol 1 client, spread over the pool and returned in order."""
+    if (pool := crypto_pool()) is None:
+        return [encrypt_message(message, public_key) for message in messages]
+    return [future.result() for future in [pool.encrypt(message, public_key) for message in messages]]
@@ -0,0 +1,43 @@
+import functools
+import os
+
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from sqlalchemy import inspect
+
+from config import CONFIG
+from core.crypto.pool import rsa_decrypt
+from core.models import ContentScheme, Message
+
+NONCE_SIZE = 12
+# key of the plaintext kept in a stored message's instance state, see ``keep_plaintext``
+_PLAINTEXT = 'plaintext'
+
+
+@functools.cache
+def _storage_cipher() -> ChaCha20Poly1305:
+    return ChaCha20Poly1305(CONFIG.storage_key)
+
+
+def seal_content(plaintext: bytes) -> bytes:
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + _storage_cipher().encrypt(nonce, plaintext, None)
+
+
+def open_sealed(sealed: bytes) -> bytes:
+    return _storage_cipher().decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], None)
+
+
+def keep_plaintext(message: Message, plaintext: bytes) -> None:
+    """
+    Keeps what a message was sealed from with the instance, e.g. until a write-behind group indexes it,
+    so ``open_content`` does not decrypt what was just encrypted. Rows read back from the database are opened.
+    """
+    inspect(message).info[_PLAINTEXT] = plaintext
+
+
+def open_content(message: Message) -> bytes:
+    if (plaintext := inspect(message).info.get(_PLAINTEXT)) is not None:
+        return plaintext
+    if message.content_scheme == ContentScheme.SEALED:
+        return open_sealed(message.content)
+    return rsa_decrypt(message.content)
@@ -0,0 +1,27 @@
+import functools
+import uuid
+
+from config import CONFIG
+from core.cache import RecentMessagesCache
+from core.handlers import MessageHandler, UserHandler
+from core.models import User
+
+GEMMA_USER_NAME = 'Gemma'
+
+
+@functools.cache
+def gemma_user() -> User:
+    """Gemma posts under the server's own key, so its answers have one stable author."""
+    return UserHandler.get_or_create(public_key=CONFIG.server_keys[0], name=GEMMA_USER_NAME)
+
+
+def store_answer(
+        answer: str,
+        recent_messages: RecentMessagesCache,
+        room_id: uuid.UUID
+) -> tuple[uuid.UUID, bytes]:
+    """Persists a final answer once, in the room of the question, partial answers are never stored."""
+    message = MessageHandler.store_message(user=gemma_user(), content=answer.encode(), room_id=room_id)
+    signed_answer = f'{GEMMA_USER_NAME}: {answer}'.encode()
+    recent_messages.append(message.id, signed_answer, room_id)
+    return message.id, signed_answer
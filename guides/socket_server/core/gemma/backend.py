@@ -0,0 +1,69 @@
+import abc
+import dataclasses
+from collections.abc import Callable, Hashable
+
+
+class LLMBackend(abc.ABC):
+    """
+    What ``InferenceScheduler`` needs from a model: a slow ``load`` and batched answers.
+    A question with a ``conversation`` key is answered in the context of the earlier ones with that key,
+    backends without conversations answer every question on its own.
+    """
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def load(self) -> None:
+        ...
+
+    @abc.abstractmethod
+    def get_answers(
+            self,
+            messages: list[str],
+            max_new_tokens: list[int],
+            on_partial: Callable[[int, str], None] | None = None,
+            conversations: list[Hashable] | None = None
+    ) -> list[str]:
+        ...
+
+    def has_context(self, conversation: Hashable) -> bool:
+        return False
+
+    def remember(self, conversation: Hashable, prompt: str, answer: str) -> None:
+        """Records a turn answered without the backend, e.g. from the answer cache."""
+
+    def get_answer(self, message: str, max_new_tokens: int) -> str:
+        return self.get_answers([message], max_new_tokens=[max_new_tokens])[0]
+
+
+@dataclasses.dataclass(slots=True)
+class EchoBackend(LLMBackend):
+    """Answers with the question itself, word by word, for tests and local runs without a GPU."""
+
+    def load(self) -> None:
+        pass
+
+    def get_answers(
+            self,
+            messages: list[str],
+            max_new_tokens: list[int],
+            on_partial: Callable[[int, str], None] | None = None,
+            conversations: list[Hashable] | None = None
+    ) -> list[str]:
+        answers = [' '.join(message.split()[:limit]) for message, limit in zip(messages, max_new_tokens)]
+        if on_partial is not None:
+            for row, answer in enumerate(answers):
+                words = answer.split()
+                for end in range(1, len(words)):
+                    on_partial(row, ' '.join(words[:end]))
+        return answers
+
+
+def create_backend(name: str) -> LLMBackend:
+    """Imports the backend only when it is created, so transformers is not loaded by the echo backend."""
+    match name:
+        case 'echo':
+            return EchoBackend()
+        case 'gemma':
+            from core.gemma.service import GemmaService
+            return GemmaService()
+    raise ValueError(f'Unknown LLM backend {name}')
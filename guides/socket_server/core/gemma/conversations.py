@@ -0,0 +1,153 @@
+import dataclasses
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any
+
+
+def cache_size(past_key_values: Any) -> int:
+    """Bytes held by a ``DynamicCache`` or a legacy tuple of per-layer (key, value) tensors."""
+    if past_key_values is None:
+        return 0
+    return sum(
+        tensor.element_size() * tensor.nelement()
+        for layer in past_key_values
+        for tensor in layer[:2]
+    )
+
+
+@dataclasses.dataclass(slots=True)
+class Conversation:
+    turns: list[dict[str, str]] = dataclasses.field(default_factory=list)
+    # the tokens ``past_key_values`` was computed for, a prefix of the next turn's prompt
+    token_ids: list[int] = dataclasses.field(default_factory=list)
+    past_key_values: Any = None
+    cache_bytes: int = 0
+    last_used: float = dataclasses.field(default_factory=time.monotonic)
+
+    def drop_cache(self) -> None:
+        self.token_ids = []
+        self.past_key_values = None
+        self.cache_bytes = 0
+
+
+class ConversationStore:
+    """
+    Per-user chat history for the LLM, together with the key/value cache of its last prompt.
+    The text of at most ``max_turns`` turns is kept per user; trimming older turns invalidates the cache.
+    Caches are dropped least recently used first once they hold more than ``cache_budget`` bytes,
+    whole conversations after ``idle_seconds`` without a question or beyond ``max_conversations``.
+    """
+    __slots__ = (
+        '_conversations',
+        '_cache_bytes',
+        '_lock',
+        'max_turns',
+        'cache_budget',
+        'idle_seconds',
+        'max_conversations',
+        'cache_reuses',
+        'reused_tokens'
+    )
+
+    def __init__(
+            self,
+            *,
+            max_turns: int,
+            cache_budget: int,
+            idle_seconds: float,
+            max_conversations: int
+    ) -> None:
+        self._conversations: OrderedDict[Hashable, Conversation] = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self.max_turns = max_turns
+        self.cache_budget = cache_budget
+        self.idle_seconds = idle_seconds
+        self.max_conversations = max_conversations
+        self.cache_reuses = 0
+        self.reused_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def has_context(self, key: Hashable) -> bool:
+        with self._lock:
+            conversation = self._conversations.get(key)
+            return conversation is not None and bool(conversation.turns)
+
+    def checkout(self, key: Hashable) -> Conversation:
+        """
+        Hands the conversation over to a generation: its cache is detached from the budget,
+        since ``generate`` extends it in place, and comes back with ``remember``.
+        """
+        with self._lock:
+            self._evict_idle()
+            conversation = self._conversations.pop(key, None) or Conversation()
+            self._cache_bytes -= conversation.cache_bytes
+            self._conversations[key] = Conversation(turns=list(conversation.turns))
+            return conversation
+
+    def remember(
+            self,
+            key: Hashable,
+            prompt: str,
+            answer: str,
+            *,
+            token_ids: list[int] | None = None,
+            past_key_values: Any = None
+    ) -> None:
+        with self._lock:
+            conversation = self._conversations.pop(key, None) or Conversation()
+            self._cache_bytes -= conversation.cache_bytes
+            conversation.turns += [
+                {'role': 'user', 'content': prompt},
+                {'role': 'assistant', 'content': answer}
+            ]
+            conversation.drop_cache()
+            if len(conversation.turns) > 2 * self.max_turns:
+                conversation.turns = conversation.turns[-2 * self.max_turns:]
+            elif past_key_values is not None:
+                conversation.token_ids = token_ids
+                conversation.past_key_values = past_key_values
+                conversation.cache_bytes = cache_size(past_key_values)
+            conversation.last_used = time.monotonic()
+            self._conversations[key] = conversation
+            self._cache_bytes += conversation.cache_bytes
+            self._enforce_limits()
+
+    def record_reuse(self, tokens: int) -> None:
+        with self._lock:
+            self.cache_reuses += 1
+            self.reused_tokens += tokens
+
+    def _evict_idle(self) -> None:
+        deadline = time.monotonic() - self.idle_seconds
+        while self._conversations:
+            key, conversation = next(iter(self._conversations.items()))
+            if conversation.last_used > deadline:
+                return
+            self._remove(key)
+
+    def _enforce_limits(self) -> None:
+        self._evict_idle()
+        while len(self._conversations) > self.max_conversations:
+            self._remove(next(iter(self._conversations)))
+        for conversation in self._conversations.values():
+            if self._cache_bytes <= self.cache_budget:
+                return
+            self._cache_bytes -= conversation.cache_bytes
+            conversation.drop_cache()
+
+    def _remove(self, key: Hashable) -> None:
+        self._cache_bytes -= self._conversations.pop(key).cache_bytes
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            'conversations': len(self._conversations),
+            'cache_bytes': self._cache_bytes,
+            'cache_reuses': self.cache_reuses,
+            'reused_tokens': self.reused_tokens
+        }
@@ -0,0 +1,58 @@
+import logging
+
+import torch
+from transformers import PreTrainedModel
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_device(device: str) -> str:
+    """``auto`` picks CUDA when a GPU is visible and the CPU otherwise."""
+    if device == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device == 'cuda' and not torch.cuda.is_available():
+        logger.warning('CUDA requested but no GPU is available, falling back to CPU')
+        return 'cpu'
+    return device
+
+
+def resolve_precision(device: str, precision: str) -> str:
+    if precision == 'auto':
+        # fp16 kernels are GPU only, on CPU float32 is the safe default
+        return 'float16' if device == 'cuda' else 'float32'
+    if precision == 'int8' and device != 'cpu':
+        # dynamic quantization only has CPU kernels
+        logger.warning('int8 dynamic quantization is CPU only, using float16 on %s', device)
+        return 'float16'
+    return precision
+
+
+def model_load_options(device: str, precision: str) -> dict:
+    """``from_pretrained`` keyword arguments for a resolved device and precision."""
+    options = {
+        'torch_dtype': torch.bfloat16 if precision == 'bfloat16' else (
+            torch.float16 if precision == 'float16' else torch.float32
+        ),
+        'low_cpu_mem_usage': True
+    }
+    if device == 'cuda':
+        options['device_map'] = 'auto'
+    return options
+
+
+def quantize(model: PreTrainedModel, precision: str) -> PreTrainedModel:
+    """Swaps the linear layers for int8 dynamically quantized ones, the bulk of a decoder's weights."""
+    if precision != 'int8':
+        return model
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def configure_threads(threads: int | None, interop_threads: int | None) -> None:
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        # only allowed before the first parallel op, so this has to run before the model loads
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            logger.warning(f'Could not set inter-op threads: {e}')
@@ -0,0 +1,325 @@
+import dataclasses
+import functools
+import logging
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Callable, Hashable
+from enum import StrEnum
+from typing import Self
+
+from config import CONFIG
+from core.cache import AnswerCache
+from core.gemma.backend import LLMBackend, create_backend
+from core.metrics import METRICS, Timing
+
+logger = logging.getLogger(__name__)
+
+
+class BackendState(StrEnum):
+    DISABLED = 'disabled'
+    WARMING_UP = 'warming_up'
+    READY = 'ready'
+    FAILED = 'failed'
+
+
+class QuestionRejectedError(Exception):
+    """
+    Raised by ``InferenceScheduler.submit``, ``reply`` is what the asking user is told.
+    Questions of a batch that failed to generate are answered with this one's ``reply``.
+    """
+    reply = 'I cannot answer right now'
+
+
+class SchedulerFullError(QuestionRejectedError):
+    reply = 'too many questions are waiting, ask me again later'
+
+
+class WarmingUpError(QuestionRejectedError):
+    reply = 'warming up, ask me again in a moment'
+
+
+class BackendUnavailableError(QuestionRejectedError):
+    reply = 'I am not available on this server'
+
+
+@dataclasses.dataclass(slots=True)
+class InferenceRequest:
+    prompt: str
+    on_answer: Callable[[str], None]
+    max_new_tokens: int
+    on_partial: Callable[[str], None] | None = None
+    owner: Hashable = None
+    conversation: Hashable = None
+    cache_key: str | None = None
+
+
+class InferenceScheduler:
+    """
+    Micro-batching front of an ``LLMBackend``.
+    The backend is created and loaded on the scheduler thread, so the server accepts chat right away;
+    until it is ``READY`` questions are refused with ``WarmingUpError``.
+    Once a question arrives, the worker waits at most ``max_wait`` seconds for more,
+    then answers up to ``max_batch_size`` of them sharing the oldest one's token budget with one ``generate`` call
+    and hands every answer to its request's ``on_answer``, or ``QuestionRejectedError.reply`` if the batch failed.
+    ``submit`` refuses questions beyond ``queue_limit`` pending ones, or ``owner_limit`` per owner.
+    With an ``answer_cache``, questions asked before are answered without generating,
+    from memory right in ``submit`` (even while warming up), or from the persisted cache on the scheduler thread.
+    Only the first question of a ``conversation`` is cached, follow-ups depend on what was said before.
+    Persisted answers that expired are deleted when the scheduler thread starts.
+    """
+    __slots__ = (
+        '_create_backend',
+        '_backend',
+        '_pending',
+        '_pending_by_owner',
+        '_condition',
+        '_thread',
+        'max_batch_size',
+        'max_wait',
+        'max_new_tokens',
+        'queue_limit',
+        'owner_limit',
+        'answer_cache',
+        'state',
+        'batches',
+        'answered'
+    )
+
+    def __init__(
+            self,
+            create_backend: Callable[[], LLMBackend] | None,
+            *,
+            max_batch_size: int,
+            max_wait: float,
+            max_new_tokens: int,
+            queue_limit: int,
+            owner_limit: int,
+            answer_cache: AnswerCache | None = None
+    ) -> None:
+        self._create_backend = create_backend
+        self._backend: LLMBackend | None = None
+        self._pending: deque[InferenceRequest] = deque()
+        self._pending_by_owner: Counter[Hashable] = Counter()
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self.queue_limit = queue_limit
+        self.owner_limit = owner_limit
+        self.answer_cache = answer_cache
+        self.batches = 0
+        self.answered = 0
+        self.state = BackendState.DISABLED if create_backend is None else BackendState.WARMING_UP
+
+    @classmethod
+    def from_config(cls) -> Self:
+        return cls(
+            None if CONFIG.llm_backend == 'disabled' else functools.partial(create_backend, CONFIG.llm_backend),
+            max_batch_size=CONFIG.gemma_max_batch_size,
+            max_wait=CONFIG.gemma_max_wait,
+            max_new_tokens=CONFIG.gemma_max_new_tokens,
+            queue_limit=CONFIG.gemma_queue_limit,
+            owner_limit=CONFIG.gemma_pending_per_client,
+            answer_cache=AnswerCache(
+                max_size=CONFIG.answer_cache_size,
+                max_bytes=CONFIG.answer_cache_bytes,
+                ttl=CONFIG.answer_cache_ttl,
+                persist=CONFIG.answer_cache_persist
+            ) if CONFIG.answer_cache_size else None
+        )
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def enabled(self) -> bool:
+        return self.state != BackendState.DISABLED
+
+    @property
+    def stats(self) -> dict[str, float | str | dict]:
+        return {
+            'answer_cache': self.answer_cache.stats if self.answer_cache is not None else None,
+            'state': str(self.state),
+            'pending': len(self._pending),
+            'batches': self.batches,
+            'answered': self.answered,
+            'mean_batch_size': round(self.answered / self.batches, 2) if self.batches else 0
+        }
+
+    def submit(
+            self,
+            prompt: str,
+            on_answer: Callable[[str], None],
+            *,
+            on_partial: Callable[[str], None] | None = None,
+            owner: Hashable = None,
+            conversation: Hashable = None,
+            max_new_tokens: int | None = None
+    ) -> None:
+        request = InferenceRequest(
+            prompt=prompt,
+            on_answer=on_answer,
+            max_new_tokens=min(max_new_tokens or self.max_new_tokens, self.max_new_tokens),
+            on_partial=on_partial,
+            owner=owner,
+            conversation=conversation
+        )
+        if self.answer_cache is not None and not self._has_context(conversation):
+            request.cache_key = self.answer_cache.key(
+                prompt,
+                backend=CONFIG.llm_backend,
+                model=CONFIG.gemma_model_name,
+                precision=CONFIG.llm_precision,
+                max_new_tokens=request.max_new_tokens
+            )
+            if (answer := self.answer_cache.lookup(request.cache_key)) is not None:
+                logger.info(f'Gemma answered from cache, {self.answer_cache.stats}')
+                self._remember(request, answer)
+                on_answer(answer)
+                return
+        match self.state:
+            case BackendState.WARMING_UP:
+                raise WarmingUpError('Backend is still loading')
+            case BackendState.DISABLED | BackendState.FAILED:
+                raise BackendUnavailableError(f'Backend is {self.state}')
+        with self._condition:
+            if len(self._pending) >= self.queue_limit:
+                raise SchedulerFullError(f'{len(self._pending)} questions pending')
+            if owner is not None and self._pending_by_owner[owner] >= self.owner_limit:
+                raise SchedulerFullError(f'{self._pending_by_owner[owner]} questions pending for this client')
+            self._pending.append(request)
+            self._pending_by_owner[owner] += 1
+            self._condition.notify()
+
+    def start(self) -> None:
+        if not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._run, name='gemma-scheduler', daemon=True)
+        self._thread.start()
+
+    def _has_context(self, conversation: Hashable) -> bool:
+        return conversation is not None and self._backend is not None and self._backend.has_context(conversation)
+
+    def _remember(self, request: InferenceRequest, answer: str) -> None:
+        if request.conversation is not None and self._backend is not None:
+            self._backend.remember(request.conversation, request.prompt, answer)
+
+    def _next_batch(self) -> list[InferenceRequest]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending)
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    break
+            # a batch generates as many tokens as its largest budget, so only questions sharing one go together
+            limit = self._pending[0].max_new_tokens
+            batch, waiting = [], deque()
+            for request in self._pending:
+                if len(batch) < self.max_batch_size and request.max_new_tokens == limit:
+                    batch.append(request)
+                else:
+                    waiting.append(request)
+            self._pending = waiting
+            for request in batch:
+                self._pending_by_owner[request.owner] -= 1
+                if not self._pending_by_owner[request.owner]:
+                    del self._pending_by_owner[request.owner]
+            return batch
+
+    def _answer_from_cache(self, batch: list[InferenceRequest]) -> list[InferenceRequest]:
+        """Answers what the persisted cache knows, returns the requests that still need generating."""
+        if self.answer_cache is None:
+            return batch
+        misses = []
+        for request in batch:
+            if request.cache_key is not None and self._has_context(request.conversation):
+                # an earlier question of the conversation was answered while this one waited
+                request.cache_key = None
+            if request.cache_key is None or (answer := self.answer_cache.get(request.cache_key)) is None:
+                misses.append(request)
+                continue
+            logger.info(f'Gemma answered from cache, {self.answer_cache.stats}')
+            self._remember(request, answer)
+            self._reply(request, answer)
+        return misses
+
+    @staticmethod
+    def _reply(request: InferenceRequest, answer: str) -> None:
+        try:
+            request.on_answer(answer)
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+
+    @staticmethod
+    def _forward_partial(batch: list[InferenceRequest], row: int, text: str) -> None:
+        on_partial = batch[row].on_partial
+        if on_partial is None:
+            return
+        try:
+            on_partial(text)
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+
+    def _warm_up(self) -> bool:
+        started = time.perf_counter()
+        try:
+            self._backend = self._create_backend()
+            self._backend.load()
+        except Exception as e:
+            self.state = BackendState.FAILED
+            logger.error(f'LLM backend failed to load: {e}', exc_info=True)
+            return False
+        self.state = BackendState.READY
+        logger.info(f'LLM backend {type(self._backend).__name__} ready in {time.perf_counter() - started:.2f}s')
+        return True
+
+    def _delete_expired_answers(self) -> None:
+        if self.answer_cache is None:
+            return
+        try:
+            self.answer_cache.delete_expired()
+        except Exception as e:
+            logger.error(f'Deleting expired Gemma answers failed: {e}', exc_info=True)
+
+    def _run(self) -> None:
+        self._delete_expired_answers()
+        if not self._warm_up():
+            return
+        while True:
+            batch = self._answer_from_cache(self._next_batch())
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                answers = self._backend.get_answers(
+                    [request.prompt for request in batch],
+                    max_new_tokens=[request.max_new_tokens for request in batch],
+                    on_partial=(
+                        functools.partial(self._forward_partial, batch)
+                        if any(request.on_partial is not None for request in batch) else None
+                    ),
+                    conversations=[request.conversation for request in batch]
+                )
+            except Exception as e:
+                logger.error(f'Gemma batch of {len(batch)} failed: {e}', exc_info=True)
+                # the askers are told, otherwise they wait for an answer that never comes
+                for request in batch:
+                    self._reply(request, QuestionRejectedError.reply)
+                continue
+            seconds = time.perf_counter() - started
+            METRICS.observe(Timing.LLM_BATCH, seconds)
+            self.batches += 1
+            self.answered += len(batch)
+            logger.info(f'Gemma answered {len(batch)} questions in {seconds:.2f}s, {self.stats}')
+            for request, answer in zip(batch, answers):
+                if request.cache_key is not None:
+                    try:
+                        # the questions of a batch share its time, a hit saves one share rather than the whole batch
+                        self.answer_cache.put(request.cache_key, answer, generation_seconds=seconds / len(batch))
+                    except Exception as e:
+                        # the asker still gets the answer, only the next one asking generates it again
+                        logger.error(f'Caching a Gemma answer failed: {e}', exc_info=True)
+                self._reply(request, answer)
@@ -1,18 +1,188 @@
 import dataclasses
+import logging
+from collections.abc import Callable, Hashable
 
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, PreTrainedModel, PreTrainedTokenizerBase
 
 from config import CONFIG
+from core.gemma.backend import LLMBackend
+from core.gemma.conversations import Conversation, ConversationStore
+from core.gemma.device import configure_threads, model_load_options, quantize, resolve_device, resolve_precision
+from core.gemma.streaming import BatchStreamer
+
+logger = logging.getLogger(__name__)
+
+
+def _shared_prefix(cached: list[int], prompt: list[int]) -> int:
+    length = 0
+    for cached_token, token in zip(cached, prompt):
+        if cached_token != token:
+            break
+        length += 1
+    return length
 
 
 @dataclasses.dataclass(slots=True)
-class GemmaService:
-    tokenizer = AutoTokenizer.from_pretrained("google/gemma-2b-it", token=CONFIG.hf_token)
-    model = AutoModelForCausalLM.from_pretrained("google/gemma-2b-it", device_map="auto", token=CONFIG.hf_token)
+class GemmaService(LLMBackend):
+    model_name: str = CONFIG.gemma_model_name
+    device: str = CONFIG.llm_device
+    precision: str = CONFIG.llm_precision
+    threads: int | None = CONFIG.llm_threads
+    interop_threads: int | None = CONFIG.llm_interop_threads
+    tokenizer: PreTrainedTokenizerBase | None = None
+    model: PreTrainedModel | None = None
+    conversations: ConversationStore | None = dataclasses.field(
+        default_factory=lambda: ConversationStore(
+            max_turns=CONFIG.conversation_max_turns,
+            cache_budget=CONFIG.conversation_cache_bytes,
+            idle_seconds=CONFIG.conversation_idle_seconds,
+            max_conversations=CONFIG.conversation_max_sessions
+        ) if CONFIG.conversation_max_turns else None
+    )
+
+    def load(self) -> None:
+        """Resolves ``auto`` device and precision, so the same config runs on GPU and CPU-only nodes."""
+        configure_threads(self.threads, self.interop_threads)
+        self.device = resolve_device(self.device)
+        self.precision = resolve_precision(self.device, self.precision)
+        # decoder-only models continue the rightmost token, so batched prompts are padded on the left
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, token=CONFIG.hf_token, padding_side="left")
+        model = AutoModelForCausalLM.from_pretrained(
+            self.model_name,
+            token=CONFIG.hf_token,
+            **model_load_options(self.device, self.precision)
+        )
+        self.model = quantize(model, self.precision).eval()
+        logger.info(f'{self.model_name} loaded on {self.device} ({self.precision}, {torch.get_num_threads()} threads)')
+
+    def has_context(self, conversation: Hashable) -> bool:
+        return self.conversations is not None and self.conversations.has_context(conversation)
+
+    def remember(self, conversation: Hashable, prompt: str, answer: str) -> None:
+        if self.conversations is not None:
+            self.conversations.remember(conversation, prompt, answer)
+
+    def get_answers(
+            self,
+            messages: list[str],
+            max_new_tokens: list[int],
+            on_partial: Callable[[int, str], None] | None = None,
+            conversations: list[Hashable] | None = None
+    ) -> list[str]:
+        """
+        Follow-up questions are answered one by one on top of their conversation's cached key/values,
+        all the others as one padded batch per token budget, so no row pays for a longer budget than its own.
+        With ``on_partial`` the answers so far are streamed as ``(row, text)`` while generating.
+        """
+        if self.conversations is None or conversations is None:
+            conversations = [None] * len(messages)
+        answers: list[str | None] = [None] * len(messages)
+        fresh: dict[int, list[int]] = {}
+        for row, (message, limit, conversation) in enumerate(zip(messages, max_new_tokens, conversations)):
+            if conversation is not None and self.conversations.has_context(conversation):
+                answers[row] = self._continue_conversation(
+                    conversation,
+                    message,
+                    max_new_tokens=limit,
+                    on_partial=(lambda _, text, row=row: on_partial(row, text)) if on_partial is not None else None
+                )
+            else:
+                fresh.setdefault(limit, []).append(row)
+        for limit, rows in fresh.items():
+            batch_answers = self._answer_batch(
+                [messages[row] for row in rows],
+                max_new_tokens=limit,
+                on_partial=(
+                    (lambda index, text, rows=rows: on_partial(rows[index], text)) if on_partial is not None else None
+                )
+            )
+            for row, answer in zip(rows, batch_answers):
+                answers[row] = answer
+                if conversations[row] is not None:
+                    self.conversations.remember(conversations[row], messages[row], answer)
+        return answers
+
+    def _chat_prompt(self, turns: list[dict[str, str]]) -> list[int]:
+        return self.tokenizer.apply_chat_template(turns, add_generation_prompt=True)
+
+    def _streamer(self, on_partial: Callable[[int, str], None] | None, max_new_tokens: list[int]) -> BatchStreamer | None:
+        if on_partial is None:
+            return None
+        return BatchStreamer(
+            self.tokenizer,
+            on_text=on_partial,
+            max_new_tokens=max_new_tokens,
+            interval=CONFIG.gemma_stream_interval
+        )
 
-    def get_answer(self, message: str) -> str:
-        input_ids = self.tokenizer(message, return_tensors="pt").to("cuda")
+    def _answer_batch(
+            self,
+            messages: list[str],
+            max_new_tokens: int,
+            on_partial: Callable[[int, str], None] | None
+    ) -> list[str]:
+        """Answers a padded batch sharing one token budget with one ``generate`` call."""
+        inputs = self.tokenizer.pad(
+            {'input_ids': [self._chat_prompt([{'role': 'user', 'content': message}]) for message in messages]},
+            return_tensors="pt"
+        ).to(self.model.device)
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                streamer=self._streamer(on_partial, [max_new_tokens] * len(messages))
+            )
+        prompt_length = inputs["input_ids"].shape[1]
+        return [self.tokenizer.decode(output[prompt_length:], skip_special_tokens=True) for output in outputs]
 
-        outputs = self.model.generate(**input_ids)
-        return self.tokenizer.decode(outputs[0])
+    def _continue_conversation(
+            self,
+            key: Hashable,
+            message: str,
+            max_new_tokens: int,
+            on_partial: Callable[[int, str], None] | None
+    ) -> str:
+        """
+        Prefills only what follows the longest prefix the conversation's cache already covers,
+        so a follow-up costs its own tokens rather than the whole history.
+        The cache of this prompt and answer is kept for the next turn.
+        """
+        conversation = self.conversations.checkout(key)
+        prompt = self._chat_prompt([*conversation.turns, {'role': 'user', 'content': message}])
+        past_key_values = self._reusable_cache(conversation, prompt)
+        input_ids = torch.tensor([prompt], device=self.model.device)
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                streamer=self._streamer(on_partial, [max_new_tokens]),
+                return_dict_in_generate=True
+            )
+        sequence = outputs.sequences[0]
+        answer = self.tokenizer.decode(sequence[len(prompt):], skip_special_tokens=True)
+        cache = outputs.past_key_values
+        self.conversations.remember(
+            key,
+            message,
+            answer,
+            # the last generated token is never fed back, so the cache stops one short of the sequence
+            token_ids=sequence[:cache.get_seq_length()].tolist() if hasattr(cache, 'get_seq_length') else None,
+            past_key_values=cache if hasattr(cache, 'get_seq_length') else None
+        )
+        return answer
 
+    def _reusable_cache(self, conversation: Conversation, prompt: list[int]):
+        if conversation.past_key_values is None:
+            return None
+        cache = conversation.past_key_values
+        # at least the last prompt token has to be fed to get the logits of the first answer token
+        reusable = min(_shared_prefix(conversation.token_ids, prompt), len(prompt) - 1)
+        if reusable < len(conversation.token_ids):
+            if not reusable or not hasattr(cache, 'crop'):
+                return None
+            cache.crop(reusable)
+        self.conversations.record_reuse(reusable)
+        return cache
@@ -0,0 +1,52 @@
+import time
+from collections.abc import Callable
+
+from transformers.generation.streamers import BaseStreamer
+
+
+class BatchStreamer(BaseStreamer):
+    """
+    ``generate`` streamer for a whole batch, transformers' own streamers only handle one sequence.
+    Collects the new tokens of every row and, at most every ``interval`` seconds,
+    calls ``on_text(row, text)`` with the answer so far of each row that changed.
+    The first token is forwarded right away, that is what the user waits for.
+    """
+
+    def __init__(
+            self,
+            tokenizer,
+            on_text: Callable[[int, str], None],
+            max_new_tokens: list[int],
+            interval: float
+    ) -> None:
+        self._tokenizer = tokenizer
+        self._on_text = on_text
+        self._max_new_tokens = max_new_tokens
+        self._interval = interval
+        self._tokens: list[list[int]] = [[] for _ in max_new_tokens]
+        self._texts = [''] * len(max_new_tokens)
+        self._prompt_skipped = False
+        self._last_emit = 0.0
+
+    def put(self, value) -> None:
+        # the first call carries the prompts
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        for tokens, new_tokens in zip(self._tokens, value.reshape(len(self._tokens), -1).tolist()):
+            tokens.extend(new_tokens)
+        now = time.monotonic()
+        if now - self._last_emit >= self._interval:
+            self._last_emit = now
+            self._emit()
+
+    def end(self) -> None:
+        # the final answers follow right after generate returns
+        pass
+
+    def _emit(self) -> None:
+        for row, (tokens, limit) in enumerate(zip(self._tokens, self._max_new_tokens)):
+            text = self._tokenizer.decode(tokens[:limit], skip_special_tokens=True)
+            if text != self._texts[row]:
+                self._texts[row] = text
+                self._on_text(row, text)
@@ -1,4 +1,7 @@
+from core.handlers.answer import CachedAnswerHandler
 from core.handlers.message import MessageHandler
+from core.handlers.room import RoomHandler
 from core.handlers.user import UserHandler
+from core.handlers.writer import WriteBehindError
 
-__all__ = ['MessageHandler', 'UserHandler']
\ No newline at end of file
+__all__ = ['CachedAnswerHandler', 'MessageHandler', 'RoomHandler', 'UserHandler', 'WriteBehindError']
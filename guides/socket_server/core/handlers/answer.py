@@ -0,0 +1,47 @@
+import time
+
+from config import CONFIG
+from core.crypto.storage import open_sealed, seal_content
+from core.handlers.crud import CRUDHandler
+from core.models import CachedAnswer
+
+
+class CachedAnswerHandler(CRUDHandler[CachedAnswer]):
+    _cls = CachedAnswer
+
+    @classmethod
+    def get_answer(cls, key: str, ttl: float) -> tuple[str, float, float] | None:
+        """
+        Unsealed answer, generation time and creation time stored for ``key``;
+        an expired entry is deleted on the way.
+        """
+        entries = cls.read_instances(filters=(CachedAnswer.id == key,))
+        if not entries:
+            return None
+        entry = entries[0]
+        if time.time() - entry.created_at > ttl:
+            cls.delete_instances(filters=(CachedAnswer.id == key,))
+            return None
+        return open_sealed(entry.answer).decode(), entry.generation_seconds, entry.created_at
+
+    @classmethod
+    def store_answer(
+            cls,
+            *,
+            key: str,
+            answer: str,
+            generation_seconds: float
+    ) -> CachedAnswer:
+        entry = CachedAnswer(
+            id=key,
+            answer=seal_content(answer.encode()),
+            generation_seconds=generation_seconds
+        )
+        if CONFIG.persistence_mode == 'write_behind':
+            return cls.enqueue_instance(instance=entry)
+        # the same question may be answered twice, e.g. asked twice in one batch
+        return cls.upsert_instances(instances=[entry])[0]
+
+    @classmethod
+    def delete_expired(cls, ttl: float) -> None:
+        cls.delete_instances(filters=(CachedAnswer.created_at < time.time() - ttl,))
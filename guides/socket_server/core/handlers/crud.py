@@ -1,17 +1,28 @@
-from collections.abc import Sequence
-from typing import TypeVar, Generic, ClassVar
+import threading
+from collections.abc import Iterator, Sequence
+from typing import Any, TypeVar, Generic, ClassVar
 
 from sqlalchemy import delete
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlmodel import SQLModel, select, update, Session
 from sqlmodel.sql.expression import _ColumnExpressionArgument  # noqa
 
+from config import CONFIG
+from core.handlers.writer import WriteBehindQueue
+from core.metrics import METRICS, Timing
 from session import engine
 
 T = TypeVar("T", bound=SQLModel)
 
+# dialects with ``INSERT ... ON CONFLICT DO UPDATE``, others upsert row by row through ``Session.merge``
+_UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+_write_behind_lock = threading.Lock()
+
 
 class CRUDHandler(Generic[T]):
     _cls: ClassVar[type[SQLModel]] = T
+    _write_behind: ClassVar[WriteBehindQueue | None] = None
 
     @classmethod
     def upsert_instance(
@@ -20,8 +31,9 @@ class CRUDHandler(Generic[T]):
             instance: T
     ) -> T:
         assert isinstance(instance, cls._cls)
-        with Session(engine) as session:
+        with METRICS.time(Timing.DB_UPSERT), Session(engine) as session:
             session.add(instance)
+            cls._on_write(session, [instance])
             session.commit()
             session.refresh(instance)
         return instance
@@ -32,14 +44,76 @@ class CRUDHandler(Generic[T]):
             *,
             instances: Sequence[T]
     ) -> Sequence[T]:
+        """One bulk ``INSERT ... ON CONFLICT DO UPDATE`` and one commit, without refreshing every row."""
         assert all(isinstance(instance, cls._cls) for instance in instances)
-        with Session(engine) as session:
-            session.add_all(instances)
+        if not instances:
+            return instances
+        if (insert := _UPSERT_INSERTS.get(engine.dialect.name)) is None:
+            with METRICS.time(Timing.DB_BULK_UPSERT), Session(engine) as session:
+                for instance in instances:
+                    session.merge(instance)
+                cls._on_write(session, instances)
+                session.commit()
+            return instances
+        table = cls._cls.__table__
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key],
+            set_={
+                column.name: statement.excluded[column.name]
+                for column in table.columns
+                if not column.primary_key
+            }
+        )
+        with METRICS.time(Timing.DB_BULK_UPSERT), Session(engine) as session:
+            session.execute(
+                statement,
+                [
+                    {column.name: getattr(instance, column.name) for column in table.columns}
+                    for instance in instances
+                ]
+            )
+            cls._on_write(session, instances)
             session.commit()
-            for instance in instances:
-                session.refresh(instance)
         return instances
 
+    @classmethod
+    def _on_write(cls, session: Session, instances: Sequence[T]) -> None:
+        """Runs in the transaction upserting ``instances`` before it commits, e.g. to keep an index of them."""
+
+    @classmethod
+    def enqueue_instance(
+            cls,
+            *,
+            instance: T
+    ) -> T:
+        """
+        Write-behind insert: the instance is committed with the next group by a background thread.
+        Defaults are applied on construction, so the returned instance already carries its id.
+        """
+        assert isinstance(instance, cls._cls)
+        if cls._write_behind is None:
+            with _write_behind_lock:
+                if cls._write_behind is None:
+                    cls._write_behind = WriteBehindQueue(
+                        flush=lambda instances: cls.upsert_instances(instances=instances),
+                        batch_size=CONFIG.write_behind_batch_size,
+                        flush_interval=CONFIG.write_behind_interval,
+                        max_attempts=CONFIG.write_behind_max_attempts,
+                        name=f'write-behind-{cls._cls.__tablename__}'
+                    )
+        cls._write_behind.put(instance)
+        return instance
+
+    @classmethod
+    def flush(cls) -> None:
+        """
+        Commits everything ``enqueue_instance`` still holds, e.g. before reading the table back.
+        Raises ``WriteBehindError`` when some of it could not be committed.
+        """
+        if cls._write_behind is not None:
+            cls._write_behind.flush()
+
     @classmethod
     def read_instances(
             cls,
@@ -52,6 +126,33 @@ class CRUDHandler(Generic[T]):
                 statement = statement.where(*filters)
             return session.exec(statement=statement).all()
 
+    @classmethod
+    def iter_instances(
+            cls,
+            *,
+            filters: tuple[bool, ...] | None = None,
+            after: Any | None = None,
+            chunk_size: int = 500
+    ) -> Iterator[Sequence[T]]:
+        """
+        Keyset-paginated read ordered by primary key.
+        Every chunk is a separate ``id > last_id ... LIMIT chunk_size`` query in its own session,
+        so memory stays flat however many rows match.
+        """
+        while True:
+            with Session(engine) as session:
+                statement = select(cls._cls).order_by(cls._cls.id).limit(chunk_size)
+                if filters is not None:
+                    statement = statement.where(*filters)
+                if after is not None:
+                    statement = statement.where(cls._cls.id > after)
+                chunk = session.exec(statement=statement).all()
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after = chunk[-1].id
+
     @classmethod
     def update_instances(
             cls,
@@ -1,6 +1,123 @@
+import itertools
+import logging
+import uuid
+from collections.abc import Iterator, Sequence
+
+from sqlalchemy import delete
+from sqlmodel import Session, func, select
+
+from config import CONFIG
+from core.archive.segments import message_archive
+from core.crypto.storage import keep_plaintext, open_content, seal_content
 from core.handlers.crud import CRUDHandler
-from core.models import Message
+from core.handlers.writer import WriteBehindError
+from core.models import LOBBY_ROOM_ID, ContentScheme, Message, User
+from core.search.index import SearchPage, message_search
+from session import engine
+
+logger = logging.getLogger(__name__)
 
 
 class MessageHandler(CRUDHandler[Message]):
     _cls = Message
+
+    @classmethod
+    def store_message(
+            cls,
+            *,
+            user: User,
+            content: bytes,
+            room_id: uuid.UUID = LOBBY_ROOM_ID
+    ) -> Message:
+        message = Message(
+            user_id=user.id,
+            user_name=user.name,
+            room_id=room_id,
+            content=seal_content(content),
+            content_scheme=ContentScheme.SEALED
+        )
+        # the search index reads it in ``_on_write``
+        keep_plaintext(message, content)
+        if CONFIG.persistence_mode == 'write_behind':
+            return cls.enqueue_instance(instance=message)
+        return cls.upsert_instance(instance=message)
+
+    @classmethod
+    def _on_write(cls, session: Session, instances: Sequence[Message]) -> None:
+        if (search := message_search()) is not None:
+            search.index(session, instances)
+
+    @classmethod
+    def delete_instances(cls, filters: tuple[bool, ...]) -> None:
+        """Goes through ``delete_messages``, so the search index never points at a deleted message."""
+        for chunk in cls.iter_instances(filters=filters):
+            cls.delete_messages(chunk)
+
+    @classmethod
+    def delete_messages(cls, messages: Sequence[Message]) -> None:
+        """Deletes ``messages`` and their search index entries in one transaction."""
+        with Session(engine) as session:
+            if (search := message_search()) is not None:
+                search.unindex(session, messages)
+            session.execute(statement=delete(Message).where(Message.id.in_([message.id for message in messages])))
+            session.commit()
+
+    @classmethod
+    def search(cls, *, room_id: uuid.UUID, query: str, page: int = 1) -> tuple[SearchPage, list[Message]] | None:
+        """One page of the best matches of ``query`` in ``room_id``, best first, ``None`` without a search index."""
+        if (search := message_search()) is None:
+            return None
+        try:
+            cls.flush()
+        except WriteBehindError as e:
+            logger.warning(f'Searching without uncommitted messages: {e}')
+        result = search.search(room_id, query, page)
+        found = cls.read_instances(filters=(Message.id.in_(result.message_ids),))
+        messages = {message.id: message for message in found}
+        # a message archived since the search is left out
+        return result, [messages[message_id] for message_id in result.message_ids if message_id in messages]
+
+    @staticmethod
+    def signed_content(message: Message) -> bytes:
+        """Decoded leniently, one row that is not UTF-8 must not fail every history sync or search reading it."""
+        return f'{message.user_name}: {open_content(message).decode(errors="replace")}'.encode()
+
+    @classmethod
+    def iter_history(
+            cls,
+            *,
+            room_id: uuid.UUID | None = None,
+            since: uuid.UUID | None = None,
+            limit: int | None = None,
+            chunk_size: int = 500
+    ) -> Iterator[Sequence[Message]]:
+        """
+        Streams messages of ``room_id`` (of every room with ``None``) newer than ``since`` in chronological chunks.
+        With ``limit`` only the newest ``limit`` of them are streamed:
+        the cursor first skips to the message just before them.
+        Both queries of a room are range scans of the ``(room_id, id)`` index.
+        A room's archived messages precede the table's, they are only read when the table holds too few.
+        """
+        filters = (Message.room_id == room_id,) if room_id is not None else None
+        archived = room_id is not None and bool(message_archive().segments(room_id))
+        archived_limit = limit
+        if limit is not None:
+            with Session(engine) as session:
+                statement = select(Message.id).order_by(Message.id.desc()).offset(limit).limit(1)
+                if filters is not None:
+                    statement = statement.where(*filters)
+                if since is not None:
+                    statement = statement.where(Message.id > since)
+                cursor = session.exec(statement=statement).first()
+                if cursor is not None:
+                    since, archived = cursor, False
+                elif archived:
+                    statement = select(func.count()).select_from(Message).where(*filters)
+                    if since is not None:
+                        statement = statement.where(Message.id > since)
+                    archived_limit = limit - session.exec(statement=statement).one()
+        rows = cls.iter_instances(filters=filters, after=since, chunk_size=chunk_size)
+        if not archived:
+            return rows
+        history = message_archive().iter_history(room_id, since=since, limit=archived_limit, chunk_size=chunk_size)
+        return itertools.chain(history, rows)
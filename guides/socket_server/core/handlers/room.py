@@ -0,0 +1,47 @@
+import functools
+import re
+
+from sqlalchemy.exc import IntegrityError
+
+from config import CONFIG
+from core.handlers.crud import CRUDHandler
+from core.models import LOBBY_ROOM_ID, LOBBY_ROOM_NAME, Room
+
+ROOM_NAME_PATTERN = re.compile(r'[a-z0-9_-]{1,32}')
+
+
+class RoomHandler(CRUDHandler[Room]):
+    _cls = Room
+
+    @staticmethod
+    def normalize_name(name: str) -> str:
+        """Room names are lowercase, ``#general`` and ``General`` are the same room."""
+        normalized = name.strip().removeprefix('#').lower()
+        if not ROOM_NAME_PATTERN.fullmatch(normalized):
+            raise ValueError(f'Invalid room name {name!r}, use up to 32 of a-z, 0-9, _ and -')
+        return normalized
+
+    @classmethod
+    @functools.lru_cache(maxsize=CONFIG.room_cache_size)
+    def get_by_name(cls, name: str) -> Room:
+        """Unknown names raise ``LookupError``, which ``lru_cache`` does not remember."""
+        rooms = cls.read_instances(
+            filters=(Room.name == name,)
+        )
+        if not rooms:
+            raise LookupError(name)
+        return rooms[0]
+
+    @classmethod
+    def get_or_create(cls, *, name: str) -> Room:
+        name = cls.normalize_name(name)
+        try:
+            return cls.get_by_name(name)
+        except LookupError:
+            pass
+        try:
+            room = Room(id=LOBBY_ROOM_ID, name=name) if name == LOBBY_ROOM_NAME else Room(name=name)
+            return cls.upsert_instance(instance=room)
+        except IntegrityError:
+            # created by another client or instance in the meantime
+            return cls.get_by_name(name)
@@ -1,6 +1,45 @@
+import functools
+
+from rsa import PublicKey
+
+from config import CONFIG
 from core.handlers.crud import CRUDHandler
 from core.models import User
 
 
 class UserHandler(CRUDHandler[User]):
     _cls = User
+
+    @classmethod
+    @functools.lru_cache(maxsize=CONFIG.user_cache_size)
+    def get_by_fingerprint(cls, fingerprint: str) -> User:
+        """
+        Indexed lookup behind an LRU cache.
+        Unknown fingerprints raise ``LookupError``, which ``lru_cache`` does not remember,
+        so a user created later is found on the next call.
+        """
+        users = cls.read_instances(
+            filters=(User.fingerprint == fingerprint,)
+        )
+        if not users:
+            raise LookupError(fingerprint)
+        return users[0]
+
+    @classmethod
+    def get_or_create(
+            cls,
+            *,
+            public_key: PublicKey,
+            name: str
+    ) -> User:
+        fingerprint = User.fingerprint_of(public_key)
+        try:
+            return cls.get_by_fingerprint(fingerprint)
+        except LookupError:
+            return cls.upsert_instance(
+                instance=User(
+                    public_key=public_key.save_pkcs1(),
+                    name=name,
+                    fingerprint=fingerprint
+                )
+            )
@@ -0,0 +1,158 @@
+import atexit
+import logging
+import threading
+import time
+from collections.abc import Callable, Sequence
+from typing import Generic, TypeVar
+
+from core.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class WriteBehindError(Exception):
+    """Rows a ``flush`` was asked to write are not committed: they wait for a retry or were dropped."""
+
+
+class WriteBehindQueue(Generic[T]):
+    """
+    Collects instances and hands them to ``flush`` in groups, from a background thread.
+    A group is written once ``batch_size`` instances are pending or ``flush_interval`` seconds have passed,
+    so one commit (and one fsync) covers many rows.
+    A group that fails is retried before anything newer, up to ``max_attempts`` times,
+    ``flush_interval * 2 ** attempts`` seconds apart, so a database locked for a moment does not use them all up.
+    Then its rows are written one by one and those that still fail are logged and dropped,
+    so one row the database always rejects cannot hold back every later one.
+    Pending instances are flushed on ``close``, which is registered with ``atexit``.
+    """
+
+    def __init__(
+            self,
+            *,
+            flush: Callable[[Sequence[T]], object],
+            batch_size: int,
+            flush_interval: float,
+            max_attempts: int,
+            name: str = 'write-behind'
+    ) -> None:
+        self._flush = flush
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_attempts = max_attempts
+        self._pending: list[T] = []
+        # the group that failed last and how often it has
+        self._failed: list[T] = []
+        self._attempts = 0
+        self._retry_at = 0.0
+        self.dropped = 0
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        METRICS.gauge(
+            f'{name.replace("-", "_")}_dropped_total',
+            'Rows dropped after every write-behind attempt failed',
+            lambda: self.dropped,
+            kind='counter'
+        )
+
+    def __len__(self) -> int:
+        return len(self._pending) + len(self._failed)
+
+    def put(self, instance: T) -> None:
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Write-behind queue is closed')
+            self._pending.append(instance)
+            if len(self._pending) >= self._batch_size:
+                self._condition.notify()
+
+    def flush(self) -> None:
+        """Writes everything queued so far before returning, raises ``WriteBehindError`` if some of it was not."""
+        with self._condition:
+            batch, self._pending = self._pending, []
+        dropped = self.dropped
+        if not self._write(batch):
+            raise WriteBehindError(f'{len(self)} instances wait for a retry, {self.dropped - dropped} were dropped')
+        if self.dropped > dropped:
+            raise WriteBehindError(f'{self.dropped - dropped} instances were dropped')
+
+    def close(self) -> None:
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _backoff(self) -> float:
+        """Seconds until a failed group may be retried, 0 without one."""
+        return max(self._retry_at - time.monotonic(), 0.0) if self._failed else 0.0
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                # a full group does not cut a backoff short
+                self._condition.wait_for(
+                    lambda: (len(self._pending) >= self._batch_size and not self._failed) or self._closed,
+                    timeout=self._backoff() or self._flush_interval
+                )
+                batch, self._pending = self._pending, []
+                closed = self._closed
+            if not closed:
+                self._write(batch)
+                continue
+            # a failed group is retried until it is written or dropped
+            while not self._write(batch):
+                time.sleep(self._backoff())
+                with self._condition:
+                    batch, self._pending = self._pending, []
+            return
+
+    def _write(self, batch: list[T]) -> bool:
+        """Whether everything up to ``batch`` is committed or dropped, ``False`` while a group waits for a retry."""
+        # the background thread and explicit flushes must not commit overlapping groups out of order
+        with self._write_lock:
+            if self._failed and (self._backoff() or not self._retry()):
+                with self._condition:
+                    self._pending[:0] = batch
+                return False
+            if not batch:
+                return True
+            try:
+                self._flush(batch)
+            except Exception as e:
+                logger.error(f'Write-behind flush of {len(batch)} instances failed: {e}', exc_info=True)
+                self._failed, self._attempts = batch, 1
+                self._retry_at = time.monotonic() + self._flush_interval * 2 ** self._attempts
+                return False
+            return True
+
+    def _retry(self) -> bool:
+        try:
+            self._flush(self._failed)
+        except Exception as e:
+            self._attempts += 1
+            if self._attempts < self._max_attempts:
+                logger.error(f'Write-behind retry {self._attempts} of {len(self._failed)} instances failed: {e}')
+                self._retry_at = time.monotonic() + self._flush_interval * 2 ** self._attempts
+                return False
+            self._drop_failing(self._failed)
+        self._failed, self._attempts = [], 0
+        return True
+
+    def _drop_failing(self, batch: list[T]) -> None:
+        """Writes ``batch`` row by row, the rows that fail on their own are dropped."""
+        for instance in batch:
+            try:
+                self._flush([instance])
+            except Exception as e:
+                self.dropped += 1
+                logger.error(
+                    f'Dropped write-behind instance after {self._max_attempts} attempts: {instance!r}: {e}',
+                    exc_info=True
+                )
@@ -0,0 +1,12 @@
+from core.metrics.endpoint import MetricsHTTPServer, register_server, start_metrics_endpoint
+from core.metrics.registry import METRICS, Histogram, Metrics, Timing
+
+__all__ = [
+    'METRICS',
+    'Histogram',
+    'Metrics',
+    'MetricsHTTPServer',
+    'Timing',
+    'register_server',
+    'start_metrics_endpoint'
+]
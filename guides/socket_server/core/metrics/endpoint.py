@@ -0,0 +1,132 @@
+import json
+import logging
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Protocol
+
+from config import CONFIG
+from core.compression import compression_stats
+from core.crypto.pool import crypto_pool_stats
+from core.metrics.registry import METRICS, Metrics
+from core.outbound import OutboundMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedServer(Protocol):
+    """
+    What ``Server`` and ``AsyncServer`` have in common. Most of it is typed loosely,
+    the modules behind it import ``core.metrics`` themselves.
+    """
+    message_queue: Any
+    client_contexts: dict
+    outbound_metrics: OutboundMetrics
+    handshake_metrics: Any
+    scheduler: Any
+    recent_messages: Any
+    rooms: Any
+    broker: Any
+    compactor: Any
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    server: 'MetricsHTTPServer'
+
+    def do_GET(self) -> None:
+        match self.path:
+            case '/metrics':
+                body = self.server.metrics.render().encode()
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            case '/stats':
+                body = json.dumps(self.server.metrics.snapshot(), default=str).encode()
+                content_type = 'application/json'
+            case _:
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # scrapes every few seconds would drown the chat log
+        pass
+
+
+class MetricsHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], metrics: Metrics) -> None:
+        super().__init__(address, _MetricsHandler)
+        self.metrics = metrics
+
+
+def register_server(server: InstrumentedServer, metrics: Metrics = METRICS) -> None:
+    """Queue depths, client counts and the engine's component stats, read on every scrape."""
+    metrics.gauge('connected_clients', 'Clients past their handshake', lambda: len(server.client_contexts))
+    metrics.gauge('message_queue_depth', 'Messages waiting for fan-out', server.message_queue.qsize)
+    metrics.gauge('gemma_queue_depth', 'Questions waiting for the LLM backend', lambda: len(server.scheduler))
+    metrics.gauge(
+        'outbound_queued',
+        'Messages waiting in all outbound queues',
+        lambda: sum(len(context.outbound) for context in _auth_contexts(server))
+    )
+    metrics.gauge(
+        'outbound_dropped_total',
+        'Outbound messages dropped by the overflow policy',
+        lambda: server.outbound_metrics.dropped,
+        kind='counter'
+    )
+    metrics.gauge(
+        'outbound_evictions_total',
+        'Slow clients disconnected by the overflow policy',
+        lambda: server.outbound_metrics.evictions,
+        kind='counter'
+    )
+    metrics.gauge(
+        'handshakes_completed_total',
+        'Handshakes that registered a client',
+        lambda: server.handshake_metrics.completed,
+        kind='counter'
+    )
+    metrics.gauge(
+        'handshakes_failed_total',
+        'Handshakes that failed or timed out',
+        lambda: sum(server.handshake_metrics.failures.values()),
+        kind='counter'
+    )
+    metrics.gauge(
+        'handshakes_rejected_total',
+        'Connections closed because too many handshakes were pending',
+        lambda: server.handshake_metrics.rejected,
+        kind='counter'
+    )
+    metrics.source('scheduler', lambda: server.scheduler.stats)
+    metrics.source('recent_messages', lambda: server.recent_messages.stats)
+    metrics.source('rooms', lambda: server.rooms.stats)
+    metrics.source('broker', lambda: server.broker.stats)
+    metrics.source('handshakes', server.handshake_metrics.report)
+    metrics.source('crypto_pool', crypto_pool_stats)
+    metrics.source('compression', compression_stats)
+    metrics.source('archive', lambda: server.compactor.stats)
+
+
+def _auth_contexts(server: InstrumentedServer) -> list:
+    # the threaded engine keeps ``ClientContext``s, the asyncio one ``AuthContext``s
+    return [getattr(context, 'auth_context', context) for context in list(server.client_contexts.values())]
+
+
+def start_metrics_endpoint(server: InstrumentedServer) -> MetricsHTTPServer | None:
+    """
+    Serves ``/metrics`` in the Prometheus text format and ``/stats`` as JSON on a daemon thread.
+    Does nothing unless ``metrics_enabled`` is set, the endpoint binds to localhost by default.
+    """
+    if not CONFIG.metrics_enabled:
+        return None
+    register_server(server)
+    http_server = MetricsHTTPServer((CONFIG.metrics_host, CONFIG.metrics_port), METRICS)
+    threading.Thread(target=http_server.serve_forever, name='metrics-endpoint', daemon=True).start()
+    logger.info(f'Metrics on http://{CONFIG.metrics_host}:{CONFIG.metrics_port}/metrics and /stats')
+    return http_server
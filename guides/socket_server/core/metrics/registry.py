@@ -0,0 +1,174 @@
+import bisect
+import contextlib
+import dataclasses
+import threading
+import time
+from collections.abc import Callable
+from enum import StrEnum
+
+from config import CONFIG
+
+METRIC_PREFIX = 'socket_server'
+
+# seconds, from a fast session decrypt up to a slow Gemma batch
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Timing(StrEnum):
+    DECRYPT = 'decrypt'
+    DB_UPSERT = 'db_upsert'
+    DB_BULK_UPSERT = 'db_bulk_upsert'
+    OUTBOUND_ENQUEUE = 'outbound_enqueue'
+    ENCODE = 'encode'
+    SOCKET_WRITE = 'socket_write'
+    HISTORY_SYNC = 'history_sync'
+    HANDSHAKE = 'handshake'
+    LLM_BATCH = 'llm_batch'
+    SEARCH = 'search'
+
+
+_TIMING_HELP = {
+    Timing.DECRYPT: 'Decrypting one inbound chat message, session cipher or RSA',
+    Timing.DB_UPSERT: 'Committing one row, e.g. a write-through message',
+    Timing.DB_BULK_UPSERT: 'Committing a group of rows, e.g. a write-behind flush',
+    Timing.OUTBOUND_ENQUEUE: "Putting one message on a client's outbound queue",
+    Timing.ENCODE: 'Encrypting and framing one batch of outbound or history messages',
+    Timing.SOCKET_WRITE: 'Writing encoded buffers to one client socket',
+    Timing.HISTORY_SYNC: 'Syncing the history of one client after its handshake',
+    Timing.HANDSHAKE: 'From accept until the client is registered',
+    Timing.LLM_BATCH: 'Generating the answers of one batch of questions',
+    Timing.SEARCH: 'Answering one /search command, query and decryption of the page'
+}
+
+
+@dataclasses.dataclass(slots=True)
+class Histogram:
+    """Cumulative-bucket histogram as Prometheus expects it, ``counts[i]`` counts values up to ``buckets[i]``."""
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    counts: list[int] = dataclasses.field(default_factory=list)
+    total: float = 0.0
+    count: int = 0
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock,
+        repr=False,
+        compare=False
+    )
+
+    def __post_init__(self) -> None:
+        # the last slot counts values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, seconds: float) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    def quantile(self, quantile: float) -> float:
+        """Upper bound of the bucket holding ``quantile``, the largest bucket for values above all of them."""
+        with self._lock:
+            target = self.count * quantile
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                if cumulative >= target and cumulative:
+                    return bound
+        return self.buckets[-1] if self.count else 0.0
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_started')
+
+    def __init__(self, histogram: Histogram) -> None:
+        self._histogram = histogram
+        self._started = 0.0
+
+    def __enter__(self) -> None:
+        self._started = time.perf_counter()
+
+    def __exit__(self, *_) -> None:
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+_DISABLED = contextlib.nullcontext()
+
+
+@dataclasses.dataclass(slots=True)
+class Gauge:
+    help: str
+    read: Callable[[], float]
+    # 'counter' for totals that only grow, e.g. handshakes completed so far
+    kind: str = 'gauge'
+
+
+class Metrics:
+    """
+    Process-wide timings of the hot paths, plus gauges and component stats registered by the server.
+    Disabled, ``time`` hands out one shared no-op context manager and ``observe`` returns right away,
+    so instrumented code pays an attribute check and nothing else.
+    Everything is read by the metrics endpoint, see ``core.metrics.endpoint``.
+    """
+    __slots__ = ('enabled', 'histograms', 'gauges', 'sources')
+
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.histograms = {timing: Histogram() for timing in Timing}
+        self.gauges: dict[str, Gauge] = {}
+        self.sources: dict[str, Callable[[], object]] = {}
+
+    def time(self, timing: Timing) -> contextlib.AbstractContextManager[None]:
+        if not self.enabled:
+            return _DISABLED
+        return _Timer(self.histograms[timing])
+
+    def observe(self, timing: Timing, seconds: float) -> None:
+        if self.enabled:
+            self.histograms[timing].observe(seconds)
+
+    def gauge(self, name: str, help: str, read: Callable[[], float], kind: str = 'gauge') -> None:
+        self.gauges[name] = Gauge(help=help, read=read, kind=kind)
+
+    def source(self, name: str, read: Callable[[], object]) -> None:
+        """A component's own ``stats``, only shown in the JSON snapshot."""
+        self.sources[name] = read
+
+    def render(self) -> str:
+        """Prometheus text exposition format, version 0.0.4."""
+        lines = []
+        for timing, histogram in self.histograms.items():
+            name = f'{METRIC_PREFIX}_{timing}_seconds'
+            lines += [f'# HELP {name} {_TIMING_HELP[timing]}', f'# TYPE {name} histogram']
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [
+                f'{name}_bucket{{le="+Inf"}} {histogram.count}',
+                f'{name}_sum {histogram.total}',
+                f'{name}_count {histogram.count}'
+            ]
+        for gauge_name, gauge in self.gauges.items():
+            name = f'{METRIC_PREFIX}_{gauge_name}'
+            lines += [f'# HELP {name} {gauge.help}', f'# TYPE {name} {gauge.kind}', f'{name} {gauge.read()}']
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict[str, dict]:
+        """Everything as one JSON-friendly dict, timings in milliseconds estimated from the buckets."""
+        return {
+            'timings': {
+                str(timing): {
+                    'count': histogram.count,
+                    'mean_ms': round(histogram.total / histogram.count * 1000, 3) if histogram.count else 0,
+                    'p50_ms': round(histogram.quantile(0.50) * 1000, 3),
+                    'p95_ms': round(histogram.quantile(0.95) * 1000, 3),
+                    'p99_ms': round(histogram.quantile(0.99) * 1000, 3)
+                }
+                for timing, histogram in self.histograms.items()
+            },
+            'gauges': {name: gauge.read() for name, gauge in self.gauges.items()},
+            'components': {name: read() for name, read in self.sources.items()}
+        }
+
+
+METRICS = Metrics(enabled=CONFIG.metrics_enabled)
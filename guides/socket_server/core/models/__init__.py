@@ -1,4 +1,16 @@
-from core.models.message import Message
+from core.models.answer import CachedAnswer
+from core.models.message import ContentScheme, Message
+from core.models.room import LOBBY_ROOM_ID, LOBBY_ROOM_NAME, Room
+from core.models.search import SearchEntry
 from core.models.user import User
 
-__all__ = ['Message', 'User']
+__all__ = [
+    'CachedAnswer',
+    'ContentScheme',
+    'LOBBY_ROOM_ID',
+    'LOBBY_ROOM_NAME',
+    'Message',
+    'Room',
+    'SearchEntry',
+    'User'
+]
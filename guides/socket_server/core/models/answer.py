@@ -0,0 +1,15 @@
+import time
+
+from sqlmodel import (
+    SQLModel,
+    Field
+)
+
+
+class CachedAnswer(SQLModel, table=True):
+    """Persisted entry of the Gemma answer cache, ``id`` is the hash of the normalized prompt and parameters."""
+    __tablename__ = 'cached_answers'
+    id: str = Field(primary_key=True, max_length=64)
+    answer: bytes = Field(default=b'')  # sealed with the storage key, like message content
+    generation_seconds: float = Field(default=0.0)
+    created_at: float = Field(default_factory=time.time, index=True)
@@ -1,14 +1,80 @@
+import os
+import threading
+import time
 import uuid
+from enum import StrEnum
 
+from sqlalchemy import Index
 from sqlmodel import (
     SQLModel,
     Field
 )
 
+from core.models.room import LOBBY_ROOM_ID
+
+_uuid_lock = threading.Lock()
+_last_timestamp = 0
+_counter = 0
+
+
+def ordered_uuid() -> uuid.UUID:
+    """
+    UUIDv7 layout: 48 bit millisecond timestamp, 12 bit counter, random tail.
+    Ids sort by creation time, which makes ``Message.id`` usable as a keyset pagination cursor.
+    """
+    global _last_timestamp, _counter
+    with _uuid_lock:
+        timestamp = time.time_ns() // 1_000_000
+        if timestamp <= _last_timestamp:
+            timestamp = _last_timestamp
+            _counter += 1
+            if _counter > 0xFFF:
+                timestamp += 1
+                _counter = 0
+        else:
+            _counter = 0
+        _last_timestamp = timestamp
+        counter = _counter
+    random_tail = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    return uuid.UUID(int=timestamp << 80 | 0x7 << 76 | counter << 64 | 0b10 << 62 | random_tail)
+
+
+def ordered_uuid_at(timestamp: float) -> uuid.UUID:
+    """An ``ordered_uuid`` of the millisecond of ``timestamp``, e.g. for a message stored before ids were ordered."""
+    random_tail = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    return uuid.UUID(int=round(timestamp * 1000) << 80 | 0x7 << 76 | 0b10 << 62 | random_tail)
+
+
+def newest_uuid_at(timestamp: float) -> uuid.UUID:
+    """Sorts after every ``ordered_uuid`` created up to ``timestamp``, and before every one created later."""
+    return uuid.UUID(int=int(timestamp * 1000) << 80 | (1 << 80) - 1)
+
+
+def uuid_timestamp(value: uuid.UUID) -> float | None:
+    """Creation time of an ``ordered_uuid`` in seconds, ``None`` for ids of other versions."""
+    if value.version != 7:
+        return None
+    return (value.int >> 80) / 1000
+
+
+class ContentScheme(StrEnum):
+    """How ``Message.content`` is protected at rest."""
+    RSA = 'rsa'  # ciphertext sent by a protocol 1 client, encrypted with the server public key
+    SEALED = 'sealed'  # ChaCha20-Poly1305 under the server storage key
+
 
 class Message(SQLModel, table=True):
     __tablename__ = 'messages'
-    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    __table_args__ = (
+        # a room's history is one range scan, in id order
+        Index('ix_messages_room_id_id', 'room_id', 'id'),
+        # so is a time range of a room, e.g. what compaction moves to the archive
+        Index('ix_messages_room_id_created_at', 'room_id', 'created_at')
+    )
+    id: uuid.UUID = Field(default_factory=ordered_uuid, primary_key=True)
+    room_id: uuid.UUID = Field(default=LOBBY_ROOM_ID, foreign_key='rooms.id')
     user_id: uuid.UUID = Field(foreign_key='users.id', index=True)
     user_name: str = Field(foreign_key='users.name', index=True)
     content: bytes = Field(default=b'')
+    content_scheme: ContentScheme = Field(default=ContentScheme.RSA)
+    created_at: float = Field(default_factory=time.time)
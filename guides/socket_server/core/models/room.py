@@ -0,0 +1,16 @@
+import uuid
+
+from sqlmodel import (
+    SQLModel,
+    Field
+)
+
+LOBBY_ROOM_NAME = 'lobby'
+# fixed, so messages stored before rooms existed can be moved into the lobby without a lookup
+LOBBY_ROOM_ID = uuid.UUID(int=0)
+
+
+class Room(SQLModel, table=True):
+    __tablename__ = 'rooms'
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    name: str = Field(max_length=32, unique=True, index=True)
@@ -0,0 +1,16 @@
+import uuid
+
+from sqlmodel import (
+    SQLModel,
+    Field
+)
+
+
+class SearchEntry(SQLModel, table=True):
+    """
+    A message in the full-text index, ``id`` is the message's rowid in the ``message_search`` FTS5 table.
+    Message ids are UUIDs and FTS5 rows are numbered, so this maps one to the other and makes indexing idempotent.
+    """
+    __tablename__ = 'message_search_entries'
+    id: int | None = Field(default=None, primary_key=True)
+    message_id: uuid.UUID = Field(foreign_key='messages.id', unique=True)
@@ -1,5 +1,7 @@
+import hashlib
 import uuid
 
+from rsa import PublicKey
 from sqlmodel import (
     SQLModel,
     Field
@@ -11,3 +13,9 @@ class User(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     name: str = Field(max_length=32)
     public_key: bytes = Field()
+    fingerprint: str = Field(max_length=32, index=True)
+
+    @staticmethod
+    def fingerprint_of(public_key: PublicKey) -> str:
+        """Short, indexable identity of a key: the first 16 bytes of SHA-256 over its DER encoding."""
+        return hashlib.sha256(public_key.save_pkcs1(format='DER')).hexdigest()[:32]
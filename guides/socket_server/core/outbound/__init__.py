@@ -0,0 +1,17 @@
+from core.outbound.queue import (
+    AsyncOutboundQueue,
+    OutboundMessage,
+    OutboundMetrics,
+    OutboundQueue,
+    OverflowPolicy,
+    SlowConsumerError
+)
+
+__all__ = [
+    'AsyncOutboundQueue',
+    'OutboundMessage',
+    'OutboundMetrics',
+    'OutboundQueue',
+    'OverflowPolicy',
+    'SlowConsumerError'
+]
@@ -0,0 +1,227 @@
+import asyncio
+import dataclasses
+import threading
+import uuid
+from collections import deque
+from collections.abc import Hashable
+from enum import StrEnum
+
+from socket_protocol import FrameType
+
+
+class OverflowPolicy(StrEnum):
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+    DISCONNECT = 'disconnect'
+
+
+class SlowConsumerError(Exception):
+    pass
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class OutboundMessage:
+    """
+    One pending write: a single message, or several chat messages coalesced into a batch
+    that framed clients receive as one HISTORY_BATCH frame.
+    """
+    content: bytes | tuple[bytes, ...]
+    frame_type: FrameType = FrameType.CHAT
+    # a message with a key replaces the pending message with the same key, e.g. a newer partial Gemma answer
+    key: Hashable = None
+    # server ids of the stored messages in ``content``, one per entry, empty for notices and partial answers
+    message_ids: tuple[uuid.UUID | None, ...] = ()
+
+    @property
+    def size(self) -> int:
+        if isinstance(self.content, bytes):
+            return 1
+        return len(self.content)
+
+    @property
+    def entries(self) -> tuple[bytes, ...]:
+        return (self.content,) if isinstance(self.content, bytes) else self.content
+
+    @property
+    def entry_ids(self) -> tuple[uuid.UUID | None, ...]:
+        return self.message_ids or (None,) * self.size
+
+
+@dataclasses.dataclass(slots=True)
+class OutboundMetrics:
+    """Counters shared by all outbound queues of a server."""
+    dropped: int = 0
+    coalesced: int = 0
+    evictions: int = 0
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock,
+        repr=False,
+        compare=False
+    )
+
+    def add(self, *, dropped: int = 0, coalesced: int = 0, evictions: int = 0) -> None:
+        with self._lock:
+            self.dropped += dropped
+            self.coalesced += coalesced
+            self.evictions += evictions
+
+    def report(self, queues: list['OutboundQueue | AsyncOutboundQueue']) -> str:
+        depths = [len(queue) for queue in queues]
+        return (
+            f'clients={len(depths)} '
+            f'queued={sum(depths)} '
+            f'max_depth={max(depths, default=0)} '
+            f'high_water={max((queue.high_water for queue in queues), default=0)} '
+            f'dropped={self.dropped} '
+            f'coalesced={self.coalesced} '
+            f'evictions={self.evictions}'
+        )
+
+
+class _OutboundBuffer:
+    """
+    Bounded FIFO of messages for one client, drained by that client's writer.
+    When ``max_size`` messages are pending, ``policy`` decides what happens to the next one:
+    the oldest pending message is dropped, pending chat messages are coalesced into one batch,
+    or ``SlowConsumerError`` is raised so the caller disconnects the client.
+    """
+    __slots__ = ('_messages', '_metrics', 'max_size', 'policy', 'high_water', 'closed')
+
+    def __init__(
+            self,
+            max_size: int,
+            policy: OverflowPolicy,
+            metrics: OutboundMetrics
+    ) -> None:
+        self._messages: deque[OutboundMessage] = deque()
+        self._metrics = metrics
+        self.max_size = max_size
+        self.policy = policy
+        self.high_water = 0
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def _put(self, message: OutboundMessage) -> None:
+        if self.closed:
+            return
+        if message.key is not None:
+            for index, pending in enumerate(self._messages):
+                if pending.key == message.key:
+                    self._messages[index] = message
+                    return
+        if len(self._messages) >= self.max_size:
+            self._make_room()
+        self._messages.append(message)
+        self.high_water = max(self.high_water, len(self._messages))
+
+    def _make_room(self) -> None:
+        match self.policy:
+            case OverflowPolicy.DISCONNECT:
+                raise SlowConsumerError(f'{len(self._messages)} messages pending')
+            case OverflowPolicy.COALESCE if self._coalesce():
+                return
+        self._messages.popleft()
+        self._metrics.add(dropped=1)
+
+    def _coalesce(self) -> bool:
+        """Merges every run of consecutive chat messages into one batch where it stands, replies keep their place."""
+        runs: list[list[OutboundMessage]] = []
+        for message in self._messages:
+            if message.frame_type == FrameType.CHAT and runs and runs[-1][-1].frame_type == FrameType.CHAT:
+                runs[-1].append(message)
+            else:
+                runs.append([message])
+        if len(runs) == len(self._messages):
+            return False
+        # chat never outgrows the queue itself, so a stuck client holds at most twice ``max_size`` messages
+        excess = max(
+            sum(message.size for message in self._messages if message.frame_type == FrameType.CHAT) - self.max_size,
+            0
+        )
+        dropped = excess
+        messages: deque[OutboundMessage] = deque()
+        for run in runs:
+            if run[0].frame_type != FrameType.CHAT or (len(run) == 1 and not excess):
+                messages.append(run[0])
+                continue
+            # the oldest chat entries go first
+            skipped = min(excess, sum(message.size for message in run))
+            excess -= skipped
+            batch = tuple(entry for message in run for entry in message.entries)[skipped:]
+            batch_ids = tuple(message_id for message in run for message_id in message.entry_ids)[skipped:]
+            if batch:
+                messages.append(OutboundMessage(content=batch, message_ids=batch_ids))
+        self._metrics.add(dropped=dropped, coalesced=len(self._messages) - len(runs))
+        self._messages = messages
+        return True
+
+    def _take(self) -> list[OutboundMessage]:
+        messages = list(self._messages)
+        self._messages.clear()
+        return messages
+
+
+class OutboundQueue(_OutboundBuffer):
+    """Thread-safe variant, drained by a writer thread blocked in ``get_all``."""
+    __slots__ = ('_condition',)
+
+    def __init__(
+            self,
+            max_size: int,
+            policy: OverflowPolicy,
+            metrics: OutboundMetrics
+    ) -> None:
+        super().__init__(max_size, policy, metrics)
+        self._condition = threading.Condition()
+
+    def put(self, message: OutboundMessage) -> None:
+        with self._condition:
+            self._put(message)
+            self._condition.notify()
+
+    def get_all(self) -> list[OutboundMessage]:
+        """Blocks until messages are pending and returns all of them, an empty list once closed."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._messages or self.closed)
+            if self.closed:
+                return []
+            return self._take()
+
+    def close(self) -> None:
+        with self._condition:
+            self.closed = True
+            self._messages.clear()
+            self._condition.notify()
+
+
+class AsyncOutboundQueue(_OutboundBuffer):
+    """Event loop variant, only used from the loop thread."""
+    __slots__ = ('_ready',)
+
+    def __init__(
+            self,
+            max_size: int,
+            policy: OverflowPolicy,
+            metrics: OutboundMetrics
+    ) -> None:
+        super().__init__(max_size, policy, metrics)
+        self._ready = asyncio.Event()
+
+    def put(self, message: OutboundMessage) -> None:
+        self._put(message)
+        self._ready.set()
+
+    async def get_all(self) -> list[OutboundMessage]:
+        while not self._messages and not self.closed:
+            self._ready.clear()
+            await self._ready.wait()
+        if self.closed:
+            return []
+        return self._take()
+
+    def close(self) -> None:
+        self.closed = True
+        self._messages.clear()
+        self._ready.set()
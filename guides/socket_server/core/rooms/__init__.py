@@ -0,0 +1,4 @@
+from core.rooms.commands import RoomAction, RoomCommand
+from core.rooms.members import RoomMembers
+
+__all__ = ['RoomAction', 'RoomCommand', 'RoomMembers']
@@ -0,0 +1,32 @@
+import dataclasses
+from enum import StrEnum
+from typing import Self
+
+from core.models import LOBBY_ROOM_NAME
+
+COMMAND_PREFIX = b'/'
+
+
+class RoomAction(StrEnum):
+    JOIN = 'join'
+    LEAVE = 'leave'
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class RoomCommand:
+    """``/join <room>`` moves the client to a room, ``/leave`` back to the lobby."""
+    action: RoomAction
+    room_name: str = LOBBY_ROOM_NAME
+
+    @classmethod
+    def parse(cls, message: bytes) -> Self | None:
+        """Anything that is not a well-formed command is an ordinary chat message."""
+        if not message.startswith(COMMAND_PREFIX):
+            return None
+        command, _, argument = message[len(COMMAND_PREFIX):].decode(errors='replace').strip().partition(' ')
+        match command.lower(), argument.strip():
+            case RoomAction.JOIN, room_name if room_name:
+                return cls(action=RoomAction.JOIN, room_name=room_name)
+            case RoomAction.LEAVE, _:
+                return cls(action=RoomAction.LEAVE)
+        return None
@@ -0,0 +1,47 @@
+import threading
+import uuid
+from collections import defaultdict
+
+
+class RoomMembers:
+    """
+    Which connections are in which room, so a message is only fanned out to its room's members.
+    Every connection is in exactly one room, ``join`` moves it from the previous one.
+    """
+    __slots__ = ('_members', '_rooms', '_lock')
+
+    def __init__(self) -> None:
+        self._members: defaultdict[uuid.UUID, set[int]] = defaultdict(set)
+        self._rooms: dict[int, uuid.UUID] = {}
+        self._lock = threading.Lock()
+
+    def join(self, room_id: uuid.UUID, connection_id: int) -> None:
+        with self._lock:
+            self._remove(connection_id)
+            self._members[room_id].add(connection_id)
+            self._rooms[connection_id] = room_id
+
+    def leave(self, connection_id: int) -> None:
+        with self._lock:
+            self._remove(connection_id)
+
+    def _remove(self, connection_id: int) -> None:
+        room_id = self._rooms.pop(connection_id, None)
+        if room_id is None:
+            return
+        members = self._members[room_id]
+        members.discard(connection_id)
+        if not members:
+            del self._members[room_id]
+
+    def members(self, room_id: uuid.UUID) -> list[int]:
+        with self._lock:
+            return list(self._members.get(room_id, ()))
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            'rooms': len(self._members),
+            'members': len(self._rooms),
+            'largest_room': max(map(len, self._members.values()), default=0)
+        }
@@ -0,0 +1,69 @@
+import dataclasses
+import re
+import time
+import uuid
+from typing import Self
+
+from config import CONFIG
+from core.handlers import MessageHandler
+from core.metrics import METRICS, Timing
+from core.rooms.commands import COMMAND_PREFIX
+
+_PAGE_OPTION = re.compile(r'\s+--page\s+([1-9][0-9]*)$')
+_RETENTION_UNITS = (('days', 86400), ('hours', 3600), ('minutes', 60), ('seconds', 1))
+
+
+def _retention_note() -> list[str]:
+    """Compaction takes messages out of the index, the last line of an answer says how far back it reaches."""
+    if (retention := CONFIG.message_retention) is None:
+        return []
+    unit, seconds = next(
+        ((unit, seconds) for unit, seconds in _RETENTION_UNITS if retention >= seconds),
+        _RETENTION_UNITS[-1]
+    )
+    return [f'* only the last {retention / seconds:.3g} {unit} are searched, older messages are archived']
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class SearchCommand:
+    """``/search <words or "phrases"> [--page <n>]`` finds messages of the client's room, best match first."""
+    query: str
+    page: int = 1
+
+    @classmethod
+    def parse(cls, message: bytes) -> Self | None:
+        """Anything that is not a well-formed command is an ordinary chat message."""
+        if not message.startswith(COMMAND_PREFIX):
+            return None
+        command, _, argument = message[len(COMMAND_PREFIX):].decode(errors='replace').strip().partition(' ')
+        if command.lower() != 'search':
+            return None
+        page = 1
+        if (option := _PAGE_OPTION.search(argument)) is not None:
+            argument, page = argument[:option.start()], int(option.group(1))
+        if not (query := argument.strip()):
+            return None
+        return cls(query=query, page=page)
+
+    def answer(self, room_id: uuid.UUID) -> bytes:
+        """The notice the client gets, a line per message of the requested page."""
+        with METRICS.time(Timing.SEARCH):
+            found = MessageHandler.search(room_id=room_id, query=self.query, page=self.page)
+            if found is None:
+                return b'* search is not available on this server'
+            result, messages = found
+            if not result.total:
+                return '\n'.join([f'* {self.query}: nothing found', *_retention_note()]).encode()
+            if not messages:
+                return f'* {self.query}: {result.total} found, there is no page {result.page}'.encode()
+            lines = [f'* {self.query}: {result.total} found, page {result.page} of {result.pages}']
+            lines += [
+                f'* {time.strftime("%Y-%m-%d %H:%M", time.localtime(message.created_at))} '
+                f'{MessageHandler.signed_content(message).decode()}'
+                for message in messages
+            ]
+        if result.page < result.pages:
+            lines.append(f'* /search {self.query} --page {result.page + 1} for more')
+        else:
+            lines += _retention_note()
+        return '\n'.join(lines).encode()
@@ -0,0 +1,189 @@
+import dataclasses
+import functools
+import hashlib
+import hmac
+import logging
+import re
+import uuid
+from collections.abc import Sequence
+from typing import Self
+
+from sqlalchemy import delete, insert, text
+from sqlmodel import Session, func, select
+
+from config import CONFIG
+from core.crypto.storage import open_content
+from core.models import Message, SearchEntry
+from session import engine
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r'\w+')
+# words and "quoted phrases" of a query
+_QUERY_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+_INSERT = text('INSERT INTO message_search (rowid, body) VALUES (:rowid, :body)')
+# a contentless table forgets a row given the same values it was indexed with
+_DELETE = text("INSERT INTO message_search (message_search, rowid, body) VALUES ('delete', :rowid, :body)")
+_COUNT = text('SELECT count(*) FROM message_search WHERE message_search MATCH :match')
+# ranking has to visit every match anyway, so counting them comes with the page
+_SEARCH = text(
+    'SELECT message_search_entries.message_id, ranked.total'
+    ' FROM (SELECT rowid, rank, count(*) OVER () AS total FROM message_search WHERE message_search MATCH :match'
+    ' ORDER BY rank LIMIT :limit OFFSET :offset) AS ranked'
+    ' JOIN message_search_entries ON message_search_entries.id = ranked.rowid'
+    ' ORDER BY ranked.rank'
+)
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class SearchPage:
+    # best match first
+    message_ids: list[uuid.UUID]
+    total: int
+    page: int
+    page_size: int
+
+    @property
+    def pages(self) -> int:
+        return max(-(-self.total // self.page_size), 1)
+
+
+class MessageSearch:
+    """
+    Full-text index of stored messages in an SQLite FTS5 table, written in the transaction that stores them.
+    Content is encrypted at rest, so the index does not hold it either: every word is replaced by its keyed hash,
+    HMAC-SHA256 under a key derived from the storage key, and queries hash their words the same way.
+    Without the key the index tells which messages of a room share words, not which words.
+    The room goes into the hash as well, so a search only reads the postings of its own room,
+    however many messages the other rooms hold.
+    Words match whole and case-insensitively, "quoted phrases" in order, results are ranked by bm25.
+    Only the messages table is indexed: a message is removed from the index in the transaction deleting it,
+    compaction included, so with a ``message_retention`` archived messages are not found.
+    """
+    __slots__ = ('_key', '_blind', 'page_size')
+
+    def __init__(self, key: bytes, page_size: int, word_cache_size: int) -> None:
+        self._key = key
+        # chat repeats the same few thousand words, most hashes are looked up rather than computed
+        self._blind = functools.lru_cache(maxsize=word_cache_size)(self._blind_word)
+        self.page_size = page_size
+
+    @classmethod
+    def from_config(cls) -> Self:
+        return cls(
+            key=hmac.new(CONFIG.storage_key, b'message search', hashlib.sha256).digest(),
+            page_size=CONFIG.search_page_size,
+            word_cache_size=CONFIG.search_word_cache_size
+        )
+
+    def _blind_word(self, room_id: uuid.UUID, word: str) -> str:
+        return hmac.new(self._key, room_id.bytes + word.encode(), hashlib.sha256).hexdigest()[:16]
+
+    def _blind_text(self, room_id: uuid.UUID, plaintext: str) -> str:
+        return ' '.join(self._blind(room_id, word) for word in _WORD.findall(plaintext.casefold()))
+
+    def _document(self, message: Message) -> dict[str, str]:
+        # a message being stored comes with its plaintext, see ``keep_plaintext``, only rows read back are decrypted
+        return {'body': self._blind_text(message.room_id, open_content(message).decode(errors='replace'))}
+
+    def index_missing(self, chunk_size: int = 1000) -> int:
+        """
+        Indexes the stored messages the index misses, e.g. those stored before search existed,
+        in chunks of one transaction each. Counting both tables tells whether there are any.
+        """
+        with Session(engine) as session:
+            messages = session.exec(select(func.count()).select_from(Message)).one()
+            entries = session.exec(select(func.count()).select_from(SearchEntry)).one()
+        if messages == entries:
+            return 0
+        indexed = 0
+        after = None
+        while True:
+            with Session(engine) as session:
+                statement = (
+                    select(Message)
+                    .outerjoin(SearchEntry, SearchEntry.message_id == Message.id)
+                    .where(SearchEntry.id.is_(None))
+                    .order_by(Message.id)
+                    .limit(chunk_size)
+                )
+                if after is not None:
+                    statement = statement.where(Message.id > after)
+                missing = session.exec(statement=statement).all()
+                indexed += self.index(session, missing)
+                session.commit()
+            if len(missing) < chunk_size:
+                return indexed
+            after = missing[-1].id
+
+    def index(self, session: Session, messages: Sequence[Message]) -> int:
+        """Adds ``messages`` in ``session``'s transaction, skipping those indexed before, e.g. upserted again."""
+        indexed = self._entries(session, messages)
+        if not (messages := [message for message in messages if message.id not in indexed]):
+            return 0
+        session.execute(insert(SearchEntry.__table__), [{'message_id': message.id} for message in messages])
+        entries = self._entries(session, messages)
+        session.execute(_INSERT, [{'rowid': entries[message.id]} | self._document(message) for message in messages])
+        return len(messages)
+
+    def unindex(self, session: Session, messages: Sequence[Message]) -> None:
+        """Removes ``messages`` in ``session``'s transaction, e.g. before they are deleted."""
+        entries = self._entries(session, messages)
+        documents = [
+            {'rowid': entries[message.id]} | self._document(message)
+            for message in messages
+            if message.id in entries
+        ]
+        if documents:
+            session.execute(_DELETE, documents)
+            session.execute(delete(SearchEntry).where(SearchEntry.id.in_(list(entries.values()))))
+
+    @staticmethod
+    def _entries(session: Session, messages: Sequence[Message]) -> dict[uuid.UUID, int]:
+        """Message id to FTS5 rowid of those of ``messages`` that are indexed."""
+        return dict(session.execute(
+            select(SearchEntry.message_id, SearchEntry.id)
+            .where(SearchEntry.message_id.in_([message.id for message in messages]))
+        ).all())
+
+    def _match(self, room_id: uuid.UUID, query: str) -> str | None:
+        """The FTS5 expression of ``query`` within ``room_id``, ``None`` if it has no words."""
+        phrases = [
+            f'"{blinded}"'
+            for phrase, word in _QUERY_TERM.findall(query)
+            if (blinded := self._blind_text(room_id, phrase or word))
+        ]
+        return ' AND '.join(phrases) if phrases else None
+
+    def search(self, room_id: uuid.UUID, query: str, page: int = 1) -> SearchPage:
+        """One page of the messages of ``room_id`` matching every word and phrase of ``query``."""
+        if (match := self._match(room_id, query)) is None:
+            return SearchPage(message_ids=[], total=0, page=page, page_size=self.page_size)
+        with Session(engine) as session:
+            rows = session.execute(
+                _SEARCH,
+                {'match': match, 'limit': self.page_size, 'offset': (page - 1) * self.page_size}
+            ).all()
+            # past the last page there is no row to carry the count
+            total = rows[0].total if rows else session.execute(_COUNT, {'match': match}).scalar_one()
+        return SearchPage(
+            message_ids=[uuid.UUID(row.message_id) for row in rows],
+            total=total,
+            page=page,
+            page_size=self.page_size
+        )
+
+
+@functools.cache
+def message_search() -> MessageSearch | None:
+    """``None`` when search is turned off or the database is not SQLite, FTS5 is part of SQLite."""
+    if not CONFIG.search_enabled or engine.dialect.name != 'sqlite':
+        return None
+    return MessageSearch.from_config()
+
+
+def build_search_index() -> None:
+    """Run at startup, so messages stored while search was off can be found as well."""
+    if (search := message_search()) is not None and (indexed := search.index_missing()):
+        logger.info(f'{indexed} stored messages added to the search index')
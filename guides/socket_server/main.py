@@ -1,47 +1,41 @@
 import logging
+import signal
 import socket
 import dataclasses
+import functools
+import time
+import uuid
 
-import rsa
-
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
-from threading import Thread
+from threading import BoundedSemaphore, Thread
 from typing import Self
 
-from rsa import PublicKey
+from socket_protocol import FrameType
 
 from config import CONFIG
-from core.auth.context import AuthContext
-from core.gemma.service import GemmaService
-from core.handlers import UserHandler, MessageHandler
-from core.models import User, Message
+from core.aio.server import AsyncServer
+from core.archive.compaction import Compactor
+from core.auth.context import PROTOCOL_ERRORS, AuthContext, HistoryCursor, SignedMessage, read_handshake
+from core.auth.handshake import HandshakeMetrics, HandshakePhase
+from core.broker import Broker, BrokerMessage, create_broker
+from core.cache import RecentMessagesCache, read_history, warm_from_database
+from core.gemma.answers import store_answer
+from core.gemma.scheduler import InferenceScheduler, QuestionRejectedError
+from core.handlers import MessageHandler, RoomHandler, UserHandler, WriteBehindError
+from core.metrics import METRICS, Timing, start_metrics_endpoint
+from core.models import LOBBY_ROOM_NAME
+from core.outbound import OutboundMessage, OutboundMetrics, OutboundQueue, OverflowPolicy, SlowConsumerError
+from core.rooms import RoomCommand, RoomMembers
+from core.search.commands import SearchCommand
+from core.search.index import build_search_index
 
 logger = logging.getLogger(__name__)
 log_handler = logging.StreamHandler()
-logger.addHandler(log_handler)
-logger.setLevel(logging.INFO)
-
-logger.info('Gemma loading...Wait')
-gemma = GemmaService()
-
-
-@dataclasses.dataclass(slots=True)
-class SignedMessage:
-    auth_context: AuthContext
-    content: bytes
-
-    @classmethod
-    def validate(cls, message: bytes) -> tuple[PublicKey, str]:
-        assert message.startswith(CONFIG.sign_message_prefix)
-        logger.info(f"Received handshake request: {message}")
-        _, public_key, user_name = message.split(b':')
-
-        logger.info(f"Received public key: {public_key}")
-        logger.info(f"Received user name: {user_name}")
-        return (
-            rsa.PublicKey.load_pkcs1(public_key.replace(b'\\n', b'\n')),
-            user_name.decode('utf-8')
-        )
+for _logger in (logger, logging.getLogger('core')):
+    _logger.addHandler(log_handler)
+    _logger.setLevel(logging.INFO)
 
 
 @dataclasses.dataclass(slots=True)
@@ -49,33 +43,77 @@ class ClientThread:
     context: AuthContext
     _thread: Thread | None = None
 
-    def listen(self, message_queue: Queue):
-        with self.context.socket as _socket:
-            while True:
-                try:
-                    data = _socket.recv(CONFIG.buffer_size)
-                    if not data:
+    def listen(
+            self,
+            message_queue: Queue,
+            recent_messages: RecentMessagesCache,
+            on_disconnect: Callable[[AuthContext], None]
+    ):
+        with self.context.socket:
+            try:
+                for data in self.context.receive():
+                    decrypted_message = self.context.decrypt(data)
+                    if (command := RoomCommand.parse(decrypted_message)) is not None:
+                        self.enter_room(command, message_queue)
                         continue
-                    message = MessageHandler.upsert_instance(
-                        instance=Message(
-                            user_id=self.context.user.id,
-                            content=data,
-                            user_name=self.context.user.name
-                        )
+                    if (search := SearchCommand.parse(decrypted_message)) is not None:
+                        self.context.outbound.put(OutboundMessage(content=search.answer(self.context.room_id)))
+                        continue
+                    # decoded before it is stored, a message that is not UTF-8 is stored the way it is shown
+                    text = decrypted_message.decode(errors='replace')
+                    message = MessageHandler.store_message(
+                        user=self.context.user,
+                        content=text.encode(),
+                        room_id=self.context.room_id
                     )
-                    decrypted_message = rsa.decrypt(message.content, CONFIG.server_keys[1])
-                    signed_message = f'{self.context.user.name}: {decrypted_message.decode()}'
+                    signed_message = f'{self.context.user.name}: {text}'.encode()
+                    recent_messages.append(message.id, signed_message, self.context.room_id)
                     message_queue.put(
                         SignedMessage(
                             auth_context=self.context,
-                            content=signed_message.encode()
+                            content=signed_message,
+                            message_id=message.id,
+                            room_id=self.context.room_id
                         )
                     )
-                except ConnectionResetError:
-                    break
+            except (ConnectionResetError, OSError):
+                pass
+            except PROTOCOL_ERRORS as e:
+                logger.warning(msg=f'Disconnecting {self.context.user.name} after a protocol error: {e!r}')
+            finally:
+                on_disconnect(self.context)
+
+    def enter_room(self, command: RoomCommand, message_queue: Queue) -> None:
+        """
+        Messages after the command are stored in the new room right away,
+        the message thread moves the membership and sends the room's history.
+        """
+        try:
+            room = RoomHandler.get_or_create(name=command.room_name)
+        except ValueError as e:
+            self.context.outbound.put(OutboundMessage(content=f'* {e}'.encode()))
+            return
+        self.context.room_id = room.id
+        message_queue.put(
+            SignedMessage(
+                auth_context=self.context,
+                content=f'* you are in #{room.name}'.encode(),
+                room_id=room.id,
+                command=command
+            )
+        )
 
-    def start(self, message_queue: Queue) -> None:
-        self._thread = Thread(target=self.listen, args=(message_queue,), daemon=True)
+    def start(
+            self,
+            message_queue: Queue,
+            recent_messages: RecentMessagesCache,
+            on_disconnect: Callable[[AuthContext], None]
+    ) -> None:
+        self._thread = Thread(
+            target=self.listen,
+            args=(message_queue, recent_messages, on_disconnect),
+            daemon=True
+        )
         self._thread.start()
 
     def join(self):
@@ -83,47 +121,97 @@ class ClientThread:
             self._thread.join()
 
 
+@dataclasses.dataclass(slots=True)
+class ClientWriter:
+    """Drains the client's outbound queue, so a slow socket only ever blocks its own thread."""
+    context: AuthContext
+    _thread: Thread | None = None
+
+    def write(self, on_disconnect: Callable[[AuthContext], None]) -> None:
+        """Whatever ends the writer unregisters the client, a client nothing is written to only fills its queue."""
+        try:
+            while messages := self.context.outbound.get_all():
+                # empty when every message already came with the history sync
+                if buffers := self.context.encode_outbound(messages):
+                    self.context.write(buffers)
+        except OSError:
+            pass
+        except Exception as e:
+            logger.error(msg=f'Writer for {self.context.user.name} failed: {e}', exc_info=True)
+        finally:
+            on_disconnect(self.context)
+
+    def start(self, on_disconnect: Callable[[AuthContext], None]) -> None:
+        self._thread = Thread(
+            target=self.write,
+            args=(on_disconnect,),
+            daemon=True
+        )
+        self._thread.start()
+
+
 @dataclasses.dataclass(slots=True)
 class ClientContext:
     client_thread: ClientThread
+    client_writer: ClientWriter
     auth_context: AuthContext
 
     def __str__(self) -> str:
         return (
             f'CONTEXT: '
             f'{self.client_thread.context.user.name} '
-            f'{self.client_thread.context.user.public_key}'
+            f'{self.client_thread.context.user.fingerprint}'
         )
 
     @classmethod
-    def from_socket(cls, _socket: socket.socket) -> Self:
-        conn, _ = _socket.accept()
-        client_public_key, user_name = SignedMessage.validate(
-            message=conn.recv(CONFIG.buffer_size)
-        )
-        server_public_key = CONFIG.server_keys[0]
-        conn.send(CONFIG.sign_message_prefix + server_public_key.save_pkcs1())
-        client_public_key = client_public_key.save_pkcs1()
-        users = UserHandler.read_instances(
-            filters=(User.public_key == client_public_key,)
-        )
-        if users:
-            user = users[0]
-        else:
-            user = UserHandler.upsert_instance(
-                instance=User(
-                    public_key=client_public_key,
-                    name=user_name
-                )
+    def from_connection(
+            cls,
+            conn: socket.socket,
+            outbound_metrics: OutboundMetrics,
+            handshake_metrics: HandshakeMetrics
+    ) -> Self:
+        """Runs on a handshake worker, every phase that waits for the client has its own timeout."""
+        with handshake_metrics.phase(HandshakePhase.READ):
+            handshake, decoder = read_handshake(conn, timeout=CONFIG.handshake_read_timeout)
+        with handshake_metrics.phase(HandshakePhase.AUTH):
+            client_public_key, user_name, options = SignedMessage.validate(
+                message=handshake
             )
+            room = RoomHandler.get_or_create(name=options.get('room', LOBBY_ROOM_NAME))
+            answer, cipher, compressor = SignedMessage.answer(
+                client_public_key,
+                options,
+                framed=decoder is not None
+            )
+            user = UserHandler.get_or_create(
+                public_key=client_public_key,
+                name=user_name
+            )
+        with handshake_metrics.phase(HandshakePhase.ANSWER):
+            conn.settimeout(CONFIG.handshake_answer_timeout)
+            conn.sendall(answer)
         auth_context = AuthContext(
             user=user,
-            socket=conn
+            socket=conn,
+            public_key=client_public_key,
+            cipher=cipher,
+            decoder=decoder,
+            history_cursor=HistoryCursor.from_options(options),
+            compressor=compressor,
+            room_id=room.id,
+            outbound=OutboundQueue(
+                max_size=CONFIG.outbound_queue_size,
+                policy=OverflowPolicy(CONFIG.outbound_overflow_policy),
+                metrics=outbound_metrics
+            )
         )
         return cls(
             client_thread=ClientThread(
                 context=auth_context
             ),
+            client_writer=ClientWriter(
+                context=auth_context
+            ),
             auth_context=auth_context
         )
 
@@ -131,90 +219,306 @@ class ClientContext:
 @dataclasses.dataclass(slots=True)
 class Server:
     message_queue = Queue()
-    gemma_queue = Queue()
-    client_contexts: list[ClientContext] = dataclasses.field(default_factory=list)
+    recent_messages = RecentMessagesCache(
+        max_size=CONFIG.recent_messages_cache_size,
+        max_bytes=CONFIG.recent_messages_cache_bytes
+    )
+    client_contexts: dict[int, ClientContext] = dataclasses.field(default_factory=dict)
+    outbound_metrics: OutboundMetrics = dataclasses.field(default_factory=OutboundMetrics)
+    scheduler: InferenceScheduler = dataclasses.field(
+        default_factory=InferenceScheduler.from_config
+    )
+    sync_executor: ThreadPoolExecutor = dataclasses.field(
+        default_factory=lambda: ThreadPoolExecutor(
+            max_workers=CONFIG.sync_workers,
+            thread_name_prefix='history-sync'
+        )
+    )
+    handshake_executor: ThreadPoolExecutor = dataclasses.field(
+        default_factory=lambda: ThreadPoolExecutor(
+            max_workers=CONFIG.handshake_workers,
+            thread_name_prefix='handshake'
+        )
+    )
+    handshake_slots: BoundedSemaphore = dataclasses.field(
+        default_factory=lambda: BoundedSemaphore(CONFIG.max_pending_handshakes)
+    )
+    handshake_metrics: HandshakeMetrics = dataclasses.field(default_factory=HandshakeMetrics)
+    broker: Broker = dataclasses.field(default_factory=create_broker)
+    rooms: RoomMembers = dataclasses.field(default_factory=RoomMembers)
+    compactor: Compactor = dataclasses.field(default_factory=Compactor.from_config)
 
     def sync_messages_for_current_context(
             self,
             context: ClientContext
     ) -> None:
-        for message in MessageHandler.read_instances():
-            decrypted_content = rsa.decrypt(message.content, CONFIG.server_keys[1])
-            secured_signed_message = SignedMessage(
-                auth_context=context.auth_context,
-                content=f'{message.user_name}: {decrypted_content.decode()}'.encode()
+        auth_context = context.auth_context
+        # bounds every send, a client that stops reading its history is dropped
+        auth_context.socket.settimeout(CONFIG.history_sync_timeout)
+        for history in read_history(
+                self.recent_messages,
+                room_id=auth_context.room_id,
+                since=auth_context.history_cursor.since,
+                limit=auth_context.history_cursor.limit,
+                chunk_size=CONFIG.history_chunk_size
+        ):
+            auth_context.write(auth_context.encode_history(history))
+        auth_context.socket.settimeout(None)
+
+    def sync_and_listen(self, context: ClientContext) -> None:
+        """Runs on ``sync_executor``, so a large history never blocks the accept loop."""
+        try:
+            with self.handshake_metrics.phase(HandshakePhase.SYNC), METRICS.time(Timing.HISTORY_SYNC):
+                self.sync_messages_for_current_context(context=context)
+            logger.info(
+                msg=f'Messages for {context.auth_context.user.name} synced, '
+                    f'recent messages cache: {self.recent_messages.stats}'
             )
-            self.send_message_to_context(
-                message=secured_signed_message.content,
-                auth_context=context.auth_context
+        except Exception as e:
+            reason = self.handshake_metrics.fail(e)
+            logger.warning(
+                msg=f'History sync for {context.auth_context.user.name} failed ({reason}): {e}, '
+                    f'handshakes: {self.handshake_metrics.report()}'
             )
+            self.disconnect(context.auth_context)
+            context.auth_context.socket.close()
+            return
+        # live messages queued during the sync are written after the history, in order
+        context.client_writer.start(on_disconnect=self.disconnect)
+        context.client_thread.start(
+            message_queue=self.message_queue,
+            recent_messages=self.recent_messages,
+            on_disconnect=self.disconnect
+        )
+
+    def handshake(self, conn: socket.socket, address: tuple, started: float) -> None:
+        """Runs on ``handshake_executor``, a client that never finishes its handshake only holds one worker."""
+        try:
+            client_context = ClientContext.from_connection(
+                conn,
+                outbound_metrics=self.outbound_metrics,
+                handshake_metrics=self.handshake_metrics
+            )
+        except Exception as e:
+            reason = self.handshake_metrics.fail(e)
+            logger.warning(
+                msg=f'Handshake from {address[0]} failed ({reason}): {e}, '
+                    f'handshakes: {self.handshake_metrics.report()}'
+            )
+            conn.close()
+            return
+        finally:
+            self.handshake_slots.release()
+        self.client_contexts[client_context.auth_context.connection_id] = client_context
+        self.rooms.join(client_context.auth_context.room_id, client_context.auth_context.connection_id)
+        self.handshake_metrics.complete(started)
+        logger.info(msg=f'New client context: {client_context}, handshakes: {self.handshake_metrics.report()}')
+        self.sync_executor.submit(self.sync_and_listen, client_context)
+
+    def accept(self, _socket: socket.socket) -> None:
+        conn, address = _socket.accept()
+        started = time.perf_counter()
+        if not self.handshake_slots.acquire(blocking=False):
+            self.handshake_metrics.reject()
+            logger.warning(msg=f'Too many pending handshakes, closing connection from {address[0]}')
+            conn.close()
+            return
+        self.handshake_executor.submit(self.handshake, conn, address, started)
+
+    def disconnect(self, auth_context: AuthContext) -> None:
+        client_context = self.client_contexts.pop(auth_context.connection_id, None)
+        if client_context is None:
+            return
+        self.rooms.leave(auth_context.connection_id)
+        auth_context.outbound.close()
+        try:
+            # wakes the listener thread if it is still blocked in recv
+            auth_context.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        logger.info(
+            msg=f'Client {auth_context.user.name} disconnected, '
+                f'outbound queues: {self.outbound_metrics.report(self._outbound_queues())}'
+        )
+
+    def _outbound_queues(self) -> list[OutboundQueue]:
+        return [client_context.auth_context.outbound for client_context in list(self.client_contexts.values())]
 
-    @staticmethod
     def send_message_to_context(
-            message: bytes,
+            self,
+            message: OutboundMessage,
             auth_context: AuthContext
     ) -> None:
-        public_key = rsa.PublicKey.load_pkcs1(
-            keyfile=auth_context.user.public_key
-        )
-        encrypted = rsa.encrypt(message, pub_key=public_key)
-        auth_context.socket.send(encrypted)
+        try:
+            with METRICS.time(Timing.OUTBOUND_ENQUEUE):
+                auth_context.outbound.put(message)
+        except SlowConsumerError as e:
+            logger.warning(msg=f'Evicting slow client {auth_context.user.name}: {e}')
+            self.outbound_metrics.add(evictions=1)
+            self.disconnect(auth_context)
 
     def handle_messages(self) -> None:
         while True:
             message: SignedMessage = self.message_queue.get()
-            if b'Gemma' in message.content:
-                self.gemma_queue.put(message)
-            contexts_to_clear = []
-            for client_context in self.client_contexts:
-                try:
-                    self.send_message_to_context(
-                        message=message.content,
-                        auth_context=client_context.auth_context
-                    )
-                except OSError:
-                    contexts_to_clear.append(client_context)
-            for client_context in contexts_to_clear:
-                self.client_contexts.remove(client_context)
+            if message.command is not None:
+                self.move_to_room(message)
+                self.message_queue.task_done()
+                continue
+            if message.auth_context is not None:
+                if b'Gemma' in message.content and self.scheduler.enabled:
+                    self.ask_gemma(message)
+                self.broker.publish(
+                    BrokerMessage(id=message.message_id, content=message.content, room_id=message.room_id)
+                )
+            outbound_message = OutboundMessage(content=message.content, message_ids=(message.message_id,))
+            for connection_id in self.rooms.members(message.room_id):
+                if connection_id == message.skip:
+                    continue
+                if (client_context := self.client_contexts.get(connection_id)) is not None:
+                    self.send_message_to_context(outbound_message, auth_context=client_context.auth_context)
             self.message_queue.task_done()
 
-    def handle_gemma_questions(self) -> None:
-        while True:
-            question_to_gemma: SignedMessage = self.gemma_queue.get()
-            gemma_answer = gemma.get_answer(
-                message=question_to_gemma.content.decode()
-            )
+    def move_to_room(self, message: SignedMessage) -> None:
+        """
+        Runs on the message thread, so no message of the room is fanned out between the history and the membership.
+        The history comes from the recent messages cache or the ``(room_id, id)`` index.
+        """
+        auth_context = message.auth_context
+        if auth_context.connection_id not in self.client_contexts:
+            return
+        history = read_history(
+            self.recent_messages,
+            room_id=message.room_id,
+            since=None,
+            limit=CONFIG.room_history_limit,
+            chunk_size=CONFIG.history_chunk_size
+        )
+        self.send_message_to_context(OutboundMessage(content=message.content), auth_context=auth_context)
+        for chunk in history:
             self.send_message_to_context(
-                f'Gemma: {gemma_answer}'.encode(),
-                auth_context=question_to_gemma.auth_context
+                OutboundMessage(
+                    content=tuple(message.content for message in chunk),
+                    message_ids=tuple(message.id for message in chunk)
+                ),
+                auth_context=auth_context
+            )
+        self.rooms.join(message.room_id, auth_context.connection_id)
+        logger.info(msg=f'{auth_context.user.name} moved to room {message.room_id}, rooms: {self.rooms.stats}')
+
+    def receive_remote(self, message: BrokerMessage) -> None:
+        """Runs on the broker thread for messages stored by another instance."""
+        self.recent_messages.append(message.id, message.content, message.room_id)
+        if message.broadcast:
+            self.message_queue.put(
+                SignedMessage(
+                    auth_context=None,
+                    content=message.content,
+                    message_id=message.id,
+                    room_id=message.room_id
+                )
+            )
+
+    def ask_gemma(self, question: SignedMessage) -> None:
+        auth_context = question.auth_context
+        stream = uuid.uuid4()
+        try:
+            self.scheduler.submit(
+                # without the author prefix, so the same question from anyone shares one cached answer
+                question.content.decode().removeprefix(f'{auth_context.user.name}: '),
+                on_answer=functools.partial(self.send_gemma_answer, auth_context, stream, question.room_id),
+                on_partial=(
+                    functools.partial(self.send_gemma_reply, auth_context, stream, FrameType.AI_PARTIAL)
+                    if CONFIG.gemma_streaming and auth_context.decoder is not None else None
+                ),
+                owner=auth_context.connection_id,
+                conversation=auth_context.user.id
+            )
+        except QuestionRejectedError as e:
+            logger.warning(msg=f'Gemma question from {auth_context.user.name} rejected: {e}')
+            self.send_gemma_reply(auth_context, stream, FrameType.AI_REPLY, e.reply)
+
+    def send_gemma_answer(
+            self,
+            auth_context: AuthContext,
+            stream: uuid.UUID,
+            room_id: uuid.UUID,
+            answer: str
+    ) -> None:
+        """
+        Runs on the scheduler thread, the final answer is stored once and replaces any partial still queued.
+        It is stored in the room's history, so the room sees it live as well, the asker only as its reply.
+        """
+        message_id, signed_answer = store_answer(answer, self.recent_messages, room_id)
+        self.broker.publish(BrokerMessage(id=message_id, content=signed_answer, room_id=room_id))
+        self.send_gemma_reply(auth_context, stream, FrameType.AI_REPLY, answer, message_id)
+        self.message_queue.put(
+            SignedMessage(
+                auth_context=None,
+                content=signed_answer,
+                message_id=message_id,
+                room_id=room_id,
+                skip=auth_context.connection_id
             )
+        )
+
+    def send_gemma_reply(
+            self,
+            auth_context: AuthContext,
+            stream: uuid.UUID,
+            frame_type: FrameType,
+            text: str,
+            message_id: uuid.UUID | None = None
+    ) -> None:
+        if auth_context.connection_id not in self.client_contexts:
+            return
+        self.send_message_to_context(
+            OutboundMessage(
+                content=f'Gemma: {text}'.encode(),
+                frame_type=frame_type,
+                key=stream,
+                message_ids=(message_id,)
+            ),
+            auth_context=auth_context
+        )
 
     def serve(self) -> None:
+        build_search_index()
+        warm_from_database(self.recent_messages)
+        logger.info(msg=f'Recent messages cache warmed: {len(self.recent_messages)} messages')
+        start_metrics_endpoint(self)
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as _socket:
             _socket.bind((CONFIG.host, CONFIG.port))
             logger.info(f'BIND on {CONFIG.host}:{CONFIG.port}')
             logger.info(msg='Waiting for connections..')
-            _socket.listen()
+            _socket.listen(CONFIG.accept_backlog)
             message_thread = Thread(target=self.handle_messages, daemon=True)
             message_thread.start()
-            gemma_thread = Thread(target=self.handle_gemma_questions, daemon=True)
-            gemma_thread.start()
+            self.scheduler.start()
+            self.compactor.start()
+            self.broker.start(on_message=self.receive_remote, on_gap=self.recent_messages.invalidate)
             while True:
                 try:
-                    client_context = ClientContext.from_socket(_socket=_socket)
-                    self.client_contexts.append(client_context)
-                    logger.info(msg=f'New client context: {client_context}')
-                    self.sync_messages_for_current_context(context=client_context)
-                    logger.info(msg='Messages for current context synced')
-                    client_context.client_thread.start(message_queue=self.message_queue)
+                    self.accept(_socket)
                 except Exception as e:
                     logger.error(str(e), exc_info=True)
                 except KeyboardInterrupt:
-                    message_thread.join()
-                    for client_context in self.client_contexts:
+                    self.handshake_executor.shutdown(wait=False, cancel_futures=True)
+                    for client_context in list(self.client_contexts.values()):
+                        self.disconnect(client_context.auth_context)
                         client_context.client_thread.join()
+                    self.broker.close()
+                    try:
+                        MessageHandler.flush()
+                    except WriteBehindError as e:
+                        logger.error(f'Messages lost on shutdown: {e}')
                     exit()
 
 
 if __name__ == "__main__":
-    Server().serve()
+    # stop on SIGTERM the same way as on Ctrl+C, so write-behind messages get flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    match CONFIG.server_mode:
+        case 'asyncio':
+            AsyncServer().run()
+        case _:
+            Server().serve()
@@ -1,8 +1,142 @@
+import multiprocessing
+import time
+
 from core.models import *  # noqa
-from sqlalchemy import create_engine
+from core.models.message import ordered_uuid_at, uuid_timestamp
+from rsa import PublicKey
+from sqlalchemy import bindparam, create_engine, event, func, inspect, select, text, update
 from sqlmodel import (
     SQLModel
 )
 
-engine = create_engine("sqlite:///database.db")
-SQLModel.metadata.create_all(engine)
+from config import CONFIG
+
+engine = create_engine(
+    CONFIG.database_url,
+    pool_size=CONFIG.database_pool_size,
+    max_overflow=CONFIG.database_max_overflow,
+    pool_pre_ping=True
+)
+
+
+def _configure_sqlite(dbapi_connection, _connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA synchronous={CONFIG.database_synchronous}')
+    cursor.execute(f'PRAGMA busy_timeout={CONFIG.database_busy_timeout_ms}')
+    cursor.close()
+
+
+if engine.dialect.name == 'sqlite':
+    event.listen(engine, 'connect', _configure_sqlite)
+
+
+def _add_missing_columns() -> None:
+    """
+    ``create_all`` only creates missing tables, so columns added to a model later are added here.
+    Existing rows get the column's default, and indexes over the new columns are created.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                if column.default is not None and column.default.is_scalar:
+                    connection.execute(update(table).where(column.is_(None)).values({column.name: column.default.arg}))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def _order_legacy_messages() -> None:
+    """
+    Messages stored before ids were ordered have random ones, which sort anywhere among the ordered ids
+    history is paged by. They get ordered ids from just before the oldest ordered one, a millisecond apart
+    in the order SQLite stored them, with a ``created_at`` to match. Their search index entries follow.
+    Ordered ids came before any database but SQLite was supported.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    table = Message.__table__
+    # the version nibble of the 32 hex digits an id is stored as
+    legacy = func.substr(table.c.id, 13, 1) != '7'
+    with engine.begin() as connection:
+        message_ids = connection.execute(
+            select(table.c.id).where(legacy).order_by(text('messages.rowid'))
+        ).scalars().all()
+        if not message_ids:
+            return
+        oldest = connection.execute(select(func.min(table.c.id)).where(~legacy)).scalar()
+        end = uuid_timestamp(oldest) if oldest is not None else time.time()
+        ordered = {
+            message_id: ordered_uuid_at(end - (len(message_ids) - index) / 1000)
+            for index, message_id in enumerate(message_ids)
+        }
+        connection.execute(
+            update(table).where(table.c.id == bindparam('old_id')).values(
+                id=bindparam('new_id'),
+                created_at=bindparam('timestamp')
+            ),
+            [
+                {'old_id': old_id, 'new_id': new_id, 'timestamp': uuid_timestamp(new_id)}
+                for old_id, new_id in ordered.items()
+            ]
+        )
+        entries = SearchEntry.__table__
+        connection.execute(
+            update(entries).where(entries.c.message_id == bindparam('old_id')).values(message_id=bindparam('new_id')),
+            [{'old_id': old_id, 'new_id': new_id} for old_id, new_id in ordered.items()]
+        )
+
+
+def _backfill_message_timestamps() -> None:
+    """Messages stored before ``created_at`` existed are dated by their id, or by the upgrade for non-ordered ids."""
+    table = Message.__table__
+    upgraded_at = time.time()
+    with engine.begin() as connection:
+        message_ids = connection.execute(select(table.c.id).where(table.c.created_at.is_(None))).scalars().all()
+        if message_ids:
+            connection.execute(
+                update(table).where(table.c.id == bindparam('message_id')).values(created_at=bindparam('timestamp')),
+                [
+                    {'message_id': message_id, 'timestamp': uuid_timestamp(message_id) or upgraded_at}
+                    for message_id in message_ids
+                ]
+            )
+
+
+def _backfill_user_fingerprints() -> None:
+    """Users stored before ``fingerprint`` existed get it from their key, or ``get_or_create`` would not find them."""
+    table = User.__table__
+    with engine.begin() as connection:
+        users = connection.execute(select(table.c.id, table.c.public_key).where(table.c.fingerprint.is_(None))).all()
+        if users:
+            connection.execute(
+                update(table).where(table.c.id == bindparam('user_id')).values(fingerprint=bindparam('fingerprint')),
+                [
+                    {'user_id': user_id, 'fingerprint': User.fingerprint_of(PublicKey.load_pkcs1(public_key))}
+                    for user_id, public_key in users
+                ]
+            )
+
+
+def _create_search_table() -> None:
+    """The FTS5 table behind ``/search``, which ``create_all`` cannot create. Contentless, it keeps no documents."""
+    if engine.dialect.name != 'sqlite' or inspect(engine).has_table('message_search'):
+        return
+    with engine.begin() as connection:
+        connection.execute(text("CREATE VIRTUAL TABLE message_search USING fts5(body, content='')"))
+
+
+# spawned processes, e.g. the crypto pool workers, import the server's entry module and with it this one,
+# only the server process itself migrates the database
+if multiprocessing.parent_process() is None:
+    SQLModel.metadata.create_all(engine)
+    _add_missing_columns()
+    _order_legacy_messages()
+    _backfill_message_timestamps()
+    _backfill_user_fingerprints()
+    _create_search_table()
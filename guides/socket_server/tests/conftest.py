@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# before ``config`` is imported: the database, keys and archive of a test run live in a directory of their own
+_data = tempfile.mkdtemp(prefix='socket-server-tests-')
+os.environ.setdefault('SOCKET_SERVER_DATABASE_URL', f'sqlite:///{_data}/database.db')
+os.environ.setdefault('SOCKET_SERVER_RSA_KEYS_PATH', f'{_data}/rsa')
+os.environ.setdefault('SOCKET_SERVER_RSA_KEY_LENGTH', '1024')
+os.environ.setdefault('SOCKET_SERVER_ARCHIVE_PATH', f'{_data}/archive')
+os.environ.setdefault('SOCKET_SERVER_CRYPTO_WORKERS', '0')
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from config import CONFIG
+from core.cache import AnswerCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """``time.time``, moved forward by hand."""
+    now = [time.time()]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+def test_normalized_prompts_share_a_key():
+    assert AnswerCache.key('What is  Python?', model='m') == AnswerCache.key('what is python', model='m')
+    assert AnswerCache.key('what is python', model='m') != AnswerCache.key('what is python', model='n')
+
+
+def test_evicts_the_least_recently_used_entry():
+    cache = AnswerCache(max_size=2, max_bytes=1024, ttl=60)
+    cache.put('a', 'first', generation_seconds=1.0)
+    cache.put('b', 'second', generation_seconds=1.0)
+    assert cache.get('a') == 'first'
+    cache.put('c', 'third', generation_seconds=1.0)
+
+    assert cache.lookup('b') is None
+    assert cache.lookup('a') == 'first'
+    assert cache.lookup('c') == 'third'
+
+
+def test_stays_within_max_bytes():
+    cache = AnswerCache(max_size=10, max_bytes=10, ttl=60)
+    cache.put('a', 'x' * 6, generation_seconds=1.0)
+    cache.put('b', 'y' * 6, generation_seconds=1.0)
+
+    assert len(cache) == 1
+    assert cache.lookup('a') is None
+    assert cache.lookup('b') == 'y' * 6
+
+
+def test_expires_entries_after_ttl(clock):
+    cache = AnswerCache(max_size=10, max_bytes=1024, ttl=60)
+    cache.put('a', 'answer', generation_seconds=1.0)
+    clock[0] += 61
+
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_counts_hits_misses_and_saved_seconds():
+    cache = AnswerCache(max_size=10, max_bytes=1024, ttl=60)
+    cache.put('a', 'answer', generation_seconds=0.5)
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+
+    assert cache.stats | {'size': None} == {
+        'size': None,
+        'hits': 2,
+        'misses': 1,
+        'hit_rate': 0.667,
+        'saved_seconds': 1.0
+    }
+
+
+def test_persisted_answers_survive_the_memory_cache_and_expire(clock, monkeypatch):
+    monkeypatch.setattr(CONFIG, 'persistence_mode', 'write_through')
+    cache = AnswerCache(max_size=10, max_bytes=1024, ttl=60, persist=True)
+    key = AnswerCache.key('persisted question')
+    cache.put(key, 'first', generation_seconds=1.0)
+    cache.put(key, 'second', generation_seconds=1.0)
+
+    assert AnswerCache(max_size=10, max_bytes=1024, ttl=60, persist=True).get(key) == 'second'
+
+    clock[0] += 61
+    cache.delete_expired()
+    assert AnswerCache(max_size=10, max_bytes=1024, ttl=3600, persist=True).get(key) is None
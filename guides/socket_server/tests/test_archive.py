@@ -0,0 +1,66 @@
+import uuid
+
+import pytest
+
+from core.archive.segments import MessageArchive
+from core.crypto.storage import seal_content
+from core.handlers import MessageHandler
+from core.models import ContentScheme, Message
+from core.models.message import ordered_uuid
+
+
+def _messages(room_id: uuid.UUID, contents: list[bytes]) -> list[Message]:
+    return [
+        Message(
+            id=ordered_uuid(),
+            room_id=room_id,
+            user_id=uuid.uuid4(),
+            user_name='tester',
+            content=seal_content(content),
+            content_scheme=ContentScheme.SEALED
+        )
+        for content in contents
+    ]
+
+
+def _history(archive: MessageArchive, room_id: uuid.UUID, **options) -> list[bytes]:
+    return [
+        MessageHandler.signed_content(message)
+        for chunk in archive.iter_history(room_id, chunk_size=2, **options)
+        for message in chunk
+    ]
+
+
+@pytest.fixture
+def archive(tmp_path) -> MessageArchive:
+    return MessageArchive(tmp_path)
+
+
+def test_reads_back_every_segment_in_order(archive):
+    room_id = uuid.uuid4()
+    archive.append(room_id, _messages(room_id, [b'0', b'1', b'2']))
+    archive.append(room_id, _messages(room_id, [b'3', b'4']))
+
+    assert [segment.count for segment in archive.segments(room_id)] == [3, 2]
+    assert _history(archive, room_id) == [f'tester: {index}'.encode() for index in range(5)]
+    assert _history(archive, uuid.uuid4()) == []
+
+
+def test_since_and_limit_cut_across_segments(archive):
+    room_id = uuid.uuid4()
+    first = _messages(room_id, [b'0', b'1', b'2'])
+    archive.append(room_id, first)
+    archive.append(room_id, _messages(room_id, [b'3', b'4']))
+
+    assert _history(archive, room_id, since=first[1].id) == [b'tester: 2', b'tester: 3', b'tester: 4']
+    assert _history(archive, room_id, limit=3) == [b'tester: 2', b'tester: 3', b'tester: 4']
+    assert _history(archive, room_id, limit=1) == [b'tester: 4']
+
+
+def test_read_messages_carry_their_plaintext_instead_of_a_sealed_copy(archive):
+    room_id = uuid.uuid4()
+    segment = archive.append(room_id, _messages(room_id, [b'hello']))
+
+    message, = archive.read(room_id, segment)
+    assert message.content == b''
+    assert MessageHandler.signed_content(message) == b'tester: hello'
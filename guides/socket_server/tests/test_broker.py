@@ -0,0 +1,112 @@
+import socket
+import threading
+import time
+import uuid
+
+import pytest
+
+from benchmarks.multi_instance import check_fan_out
+from core.broker import BrokerMessage, IPCBroker
+from core.models.message import ordered_uuid
+
+
+def _free_ports(count: int) -> list[int]:
+    sockets = [socket.socket() for _ in range(count)]
+    for _socket in sockets:
+        _socket.bind(('127.0.0.1', 0))
+    ports = [_socket.getsockname()[1] for _socket in sockets]
+    for _socket in sockets:
+        _socket.close()
+    return ports
+
+
+def _wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class _Receiver:
+    def __init__(self) -> None:
+        self.messages: list[BrokerMessage] = []
+        self.gaps: list[uuid.UUID] = []
+        self._lock = threading.Lock()
+
+    def on_message(self, message: BrokerMessage) -> None:
+        with self._lock:
+            self.messages.append(message)
+
+    def on_gap(self, until: uuid.UUID) -> None:
+        with self._lock:
+            self.gaps.append(until)
+
+
+@pytest.fixture
+def brokers():
+    """A hub instance and a peer, both connected."""
+    port, = _free_ports(1)
+    created = [
+        IPCBroker(('127.0.0.1', port), b'k' * 32, reconnect_interval=0.05, outbox_size=2, dedup_size=64)
+        for _ in range(2)
+    ]
+    receivers = [_Receiver() for _ in created]
+    created[0].start(receivers[0].on_message, receivers[0].on_gap)
+    assert _wait_for(lambda: created[0].hub and created[0].stats['connected'])
+    created[1].start(receivers[1].on_message, receivers[1].on_gap)
+    assert _wait_for(lambda: all(broker.stats['connected'] for broker in created))
+    # their threads are daemons, closing the connections under them only adds noise
+    return created, receivers
+
+
+def test_message_reaches_the_other_instance_once(brokers):
+    (hub, peer), (hub_receiver, peer_receiver) = brokers
+    message = BrokerMessage(id=ordered_uuid(), content=b'alice: hi')
+    hub.publish(message)
+    # a resend after a failed send carries the same id
+    hub.publish(message)
+    assert _wait_for(lambda: peer.duplicates == 1)
+    assert peer_receiver.messages == [message]
+    assert hub_receiver.messages == []
+
+
+def test_only_a_reconnection_reports_a_gap(brokers):
+    (_, peer), (hub_receiver, peer_receiver) = brokers
+    assert hub_receiver.gaps == peer_receiver.gaps == []
+    with peer._condition:
+        # closing alone does not wake the receiver blocked on the socket
+        with socket.fromfd(peer._connection.fileno(), socket.AF_INET, socket.SOCK_STREAM) as duplicate:
+            duplicate.shutdown(socket.SHUT_RDWR)
+    assert _wait_for(lambda: len(peer_receiver.gaps) == 1)
+    assert hub_receiver.gaps == []
+
+
+def test_full_outbox_reaches_the_peers_as_a_gap(brokers):
+    (hub, peer), (_, peer_receiver) = brokers
+    gaps = len(peer_receiver.gaps)
+    # held back as if disconnected, so the outbox of two overflows
+    with hub._condition:
+        connection, hub._connection = hub._connection, None
+    message_ids = [ordered_uuid() for _ in range(4)]
+    for message_id in message_ids:
+        hub.publish(BrokerMessage(id=message_id, content=b'bob: spam'))
+    # the sender may hold one more, the newest are dropped either way
+    assert hub.dropped >= 1
+    with hub._condition:
+        hub._connection = connection
+        hub._condition.notify_all()
+    assert _wait_for(lambda: len(peer_receiver.gaps) > gaps)
+    assert _wait_for(lambda: len(peer_receiver.messages) == len(message_ids) - hub.dropped)
+    dropped = set(message_ids) - {message.id for message in peer_receiver.messages}
+    assert max(dropped) <= peer_receiver.gaps[-1]
+
+
+def test_two_server_instances_fan_out_every_message_once():
+    port, broker_port = _free_ports(2)
+    # the instances listen on consecutive ports
+    while broker_port == port + 1:
+        broker_port, = _free_ports(1)
+    result = check_fan_out(instances=2, messages=10, port=port, broker_port=broker_port, timeout=60.0)
+    assert result['ok'], result
@@ -0,0 +1,68 @@
+import pytest
+import rsa
+from socket_protocol import parse_options, unwrap_key
+
+from config import CONFIG
+from core.auth.context import SignedMessage
+from core.compression import SharedCompressor, negotiate_compressor, shared_compressor
+
+
+@pytest.mark.parametrize(
+    ('options', 'codec'),
+    [
+        ({'proto': '2', 'compress': 'zlib'}, 'zlib'),
+        ({'proto': '2', 'compress': 'brotli,zlib'}, 'zlib'),
+        ({'proto': '2', 'compress': 'brotli'}, None),
+        ({'proto': '2'}, None),
+        # protocol 1 payloads are RSA blocks, they are never compressed
+        ({'proto': '1', 'compress': 'zlib'}, None)
+    ]
+)
+def test_negotiates_the_first_offered_codec_the_server_accepts(options, codec):
+    compressor = negotiate_compressor(options)
+    assert (compressor.codec.name if compressor is not None else None) == codec
+
+
+def test_no_codec_is_negotiated_with_compression_off(monkeypatch):
+    monkeypatch.setattr(CONFIG, 'compression_codecs', [])
+    assert negotiate_compressor({'proto': '2', 'compress': 'zlib'}) is None
+
+
+def test_handshake_answer_names_the_codec_and_returns_its_compressor():
+    private_key = rsa.newkeys(512)[1]
+    public_key = rsa.PublicKey(private_key.n, private_key.e)
+
+    answer, cipher, compressor = SignedMessage.answer(public_key, {'proto': '2', 'compress': 'zlib'})
+    _, _, *options = answer.split(b':')
+    answer_options = parse_options(options)
+    assert answer_options['compress'] == 'zlib'
+    assert compressor is shared_compressor('zlib')
+    assert len(unwrap_key(answer_options['key'].encode(), private_key)) == 32
+    assert cipher is not None
+
+    _, cipher, compressor = SignedMessage.answer(public_key, {'proto': '1'})
+    assert cipher is None and compressor is None
+
+
+def test_a_payload_fanned_out_twice_is_compressed_once():
+    compressor = SharedCompressor(shared_compressor('zlib').codec, threshold=16, cache_size=2, cache_bytes=1024)
+    payload = b'alice: ' + b'ha' * 100
+
+    packed = compressor.pack(payload)
+    assert compressor.pack(payload) is packed
+    assert compressor.unpack(packed) == payload
+    assert (compressor.compressed, compressor.hits) == (1, 1)
+    # payloads under the threshold are neither compressed nor cached
+    compressor.pack(b'short')
+    assert compressor.compressed == 1
+
+
+def test_the_cache_keeps_only_the_newest_payloads():
+    compressor = SharedCompressor(shared_compressor('zlib').codec, threshold=0, cache_size=2, cache_bytes=1024)
+    for payload in (b'a' * 64, b'b' * 64, b'c' * 64):
+        compressor.pack(payload)
+
+    compressor.pack(b'a' * 64)
+    assert compressor.hits == 0
+    compressor.pack(b'c' * 64)
+    assert compressor.hits == 1
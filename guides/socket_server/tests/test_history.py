@@ -0,0 +1,68 @@
+import uuid
+
+from sqlmodel import Session
+
+import session
+from core.auth.context import HistoryCursor
+from core.crypto.storage import seal_content
+from core.handlers import MessageHandler
+from core.models import ContentScheme, Message
+from core.models.message import ordered_uuid, uuid_timestamp
+
+
+def _store(room_id: uuid.UUID, contents: list[bytes], make_id=ordered_uuid) -> None:
+    with Session(session.engine) as db:
+        for content in contents:
+            db.add(Message(
+                id=make_id(),
+                room_id=room_id,
+                user_id=uuid.uuid4(),
+                user_name='tester',
+                content=seal_content(content),
+                content_scheme=ContentScheme.SEALED
+            ))
+            # one row per commit keeps SQLite's rowid order the order of ``contents``
+            db.commit()
+
+
+def _history(room_id: uuid.UUID, **options) -> list[bytes]:
+    return [
+        MessageHandler.signed_content(message)
+        for chunk in MessageHandler.iter_history(room_id=room_id, chunk_size=2, **options)
+        for message in chunk
+    ]
+
+
+def test_pages_in_id_order_and_keeps_the_newest_of_a_limit():
+    room_id = uuid.uuid4()
+    _store(room_id, [f'{index}'.encode() for index in range(5)])
+
+    assert _history(room_id) == [f'tester: {index}'.encode() for index in range(5)]
+    assert _history(room_id, limit=2) == [b'tester: 3', b'tester: 4']
+
+
+def test_legacy_messages_get_ordered_ids_before_every_newer_message():
+    room_id = uuid.uuid4()
+    _store(room_id, [b'old 1', b'old 2', b'old 3'], make_id=uuid.uuid4)
+    _store(room_id, [b'new'])
+
+    session._order_legacy_messages()
+
+    messages = [message for chunk in MessageHandler.iter_history(room_id=room_id) for message in chunk]
+    assert [MessageHandler.signed_content(message) for message in messages] == [
+        b'tester: old 1', b'tester: old 2', b'tester: old 3', b'tester: new'
+    ]
+    assert all(message.id.version == 7 for message in messages)
+    assert all(message.created_at == uuid_timestamp(message.id) for message in messages[:3])
+    assert _history(room_id, since=messages[1].id) == [b'tester: old 3', b'tester: new']
+
+
+def test_a_cursor_from_before_ordered_ids_asks_for_a_full_sync():
+    assert HistoryCursor.from_options({'since': uuid.uuid4().hex}).since is None
+    since = ordered_uuid()
+    assert HistoryCursor.from_options({'since': str(since)}).since == since
+
+
+def test_a_limit_below_one_is_clamped():
+    assert HistoryCursor.from_options({'limit': '0'}).limit == 1
+    assert HistoryCursor.from_options({'limit': '-5'}).limit == 1
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from socket_protocol import FrameType
+
+from core.outbound.queue import (
+    AsyncOutboundQueue,
+    OutboundMessage,
+    OutboundMetrics,
+    OutboundQueue,
+    OverflowPolicy,
+    SlowConsumerError
+)
+
+
+def _chat(*contents: bytes) -> list[OutboundMessage]:
+    return [OutboundMessage(content=content) for content in contents]
+
+
+def test_drop_oldest_keeps_the_newest_messages():
+    metrics = OutboundMetrics()
+    queue = OutboundQueue(max_size=2, policy=OverflowPolicy.DROP_OLDEST, metrics=metrics)
+    for message in _chat(b'1', b'2', b'3'):
+        queue.put(message)
+
+    assert [message.content for message in queue.get_all()] == [b'2', b'3']
+    assert metrics.dropped == 1
+    assert queue.high_water == 2
+
+
+def test_coalesce_batches_chat_around_replies_and_drops_only_the_excess():
+    metrics = OutboundMetrics()
+    queue = OutboundQueue(max_size=3, policy=OverflowPolicy.COALESCE, metrics=metrics)
+    queue.put(OutboundMessage(content=b'a'))
+    queue.put(OutboundMessage(content=b'b'))
+    queue.put(OutboundMessage(content=b'Gemma: hi', frame_type=FrameType.AI_REPLY))
+    queue.put(OutboundMessage(content=b'c'))
+
+    assert [message.content for message in queue.get_all()] == [(b'a', b'b'), b'Gemma: hi', b'c']
+    assert metrics.coalesced == 1
+    assert metrics.dropped == 0
+
+    for message in _chat(b'1', b'2', b'3', b'4', b'5', b'6'):
+        queue.put(message)
+    # chat beyond ``max_size`` entries loses its oldest entries
+    assert [message.entries for message in queue.get_all()] == [(b'3', b'4', b'5'), (b'6',)]
+    assert metrics.dropped == 2
+
+
+def test_a_keyed_message_replaces_the_pending_one_in_place():
+    queue = OutboundQueue(max_size=2, policy=OverflowPolicy.DISCONNECT, metrics=OutboundMetrics())
+    queue.put(OutboundMessage(content=b'Gemma: he', frame_type=FrameType.AI_PARTIAL, key=1))
+    queue.put(OutboundMessage(content=b'chat'))
+    queue.put(OutboundMessage(content=b'Gemma: hello', frame_type=FrameType.AI_PARTIAL, key=1))
+
+    assert [message.content for message in queue.get_all()] == [b'Gemma: hello', b'chat']
+
+
+def test_disconnect_raises_once_the_queue_is_full():
+    queue = OutboundQueue(max_size=2, policy=OverflowPolicy.DISCONNECT, metrics=OutboundMetrics())
+    for message in _chat(b'1', b'2'):
+        queue.put(message)
+
+    with pytest.raises(SlowConsumerError):
+        queue.put(OutboundMessage(content=b'3'))
+
+
+def test_closing_wakes_the_async_writer_with_nothing():
+    async def drain() -> tuple[list[OutboundMessage], list[OutboundMessage]]:
+        queue = AsyncOutboundQueue(max_size=2, policy=OverflowPolicy.DROP_OLDEST, metrics=OutboundMetrics())
+        queue.put(OutboundMessage(content=b'1'))
+        first = await queue.get_all()
+        waiting = asyncio.create_task(queue.get_all())
+        await asyncio.sleep(0)
+        queue.close()
+        return first, await waiting
+
+    first, after_close = asyncio.run(drain())
+    assert [message.content for message in first] == [b'1']
+    assert after_close == []
@@ -0,0 +1,49 @@
+import uuid
+
+import pytest
+
+from core.handlers import RoomHandler
+from core.models import LOBBY_ROOM_ID, LOBBY_ROOM_NAME
+from core.rooms import RoomAction, RoomCommand, RoomMembers
+
+
+@pytest.mark.parametrize(
+    ('message', 'command'),
+    [
+        (b'/join study', RoomCommand(action=RoomAction.JOIN, room_name='study')),
+        (b'/JOIN   #Study  ', RoomCommand(action=RoomAction.JOIN, room_name='#Study')),
+        (b'/leave', RoomCommand(action=RoomAction.LEAVE, room_name=LOBBY_ROOM_NAME)),
+        (b'/join', None),
+        (b'/shrug', None),
+        (b'join study', None)
+    ]
+)
+def test_parses_only_well_formed_commands(message, command):
+    assert RoomCommand.parse(message) == command
+
+
+def test_a_connection_is_in_one_room_at_a_time():
+    members = RoomMembers()
+    study, games = uuid.uuid4(), uuid.uuid4()
+    members.join(study, 1)
+    members.join(study, 2)
+    members.join(games, 1)
+
+    assert members.members(study) == [2]
+    assert members.members(games) == [1]
+    assert members.stats == {'rooms': 2, 'members': 2, 'largest_room': 1}
+
+    members.leave(1)
+    members.leave(2)
+    assert members.members(games) == []
+    assert members.stats == {'rooms': 0, 'members': 0, 'largest_room': 0}
+
+
+def test_room_names_are_normalized_and_created_once():
+    room = RoomHandler.get_or_create(name='#Study-Group')
+
+    assert room.name == 'study-group'
+    assert RoomHandler.get_or_create(name='study-group').id == room.id
+    assert RoomHandler.get_or_create(name=LOBBY_ROOM_NAME).id == LOBBY_ROOM_ID
+    with pytest.raises(ValueError):
+        RoomHandler.get_or_create(name='no spaces allowed')
@@ -0,0 +1,125 @@
+import threading
+
+import pytest
+
+from config import CONFIG
+from core.cache import AnswerCache
+from core.gemma.backend import EchoBackend
+from core.gemma.scheduler import InferenceScheduler, QuestionRejectedError, SchedulerFullError
+
+
+class _Answers:
+    def __init__(self) -> None:
+        self.answers: list[str] = []
+        self._condition = threading.Condition()
+
+    def on_answer(self, answer: str) -> None:
+        with self._condition:
+            self.answers.append(answer)
+            self._condition.notify_all()
+
+    def wait_for(self, count: int, timeout: float = 5.0) -> list[str]:
+        with self._condition:
+            assert self._condition.wait_for(lambda: len(self.answers) >= count, timeout), self.answers
+            return sorted(self.answers)
+
+
+class _RecordingBackend(EchoBackend):
+    """Records the token budgets of every batch, holds each one until ``release`` is set."""
+
+    def __init__(self) -> None:
+        self.batches: list[list[int]] = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_answers(self, messages, max_new_tokens, on_partial=None, conversations=None):
+        self.batches.append(list(max_new_tokens))
+        self.release.wait(5)
+        return super().get_answers(messages, max_new_tokens, on_partial, conversations)
+
+
+class _FailingBackend(EchoBackend):
+    def get_answers(self, messages, max_new_tokens, on_partial=None, conversations=None):
+        raise RuntimeError('out of memory')
+
+
+def _scheduler(backend=EchoBackend, **options) -> InferenceScheduler:
+    return InferenceScheduler(
+        backend,
+        **{
+            'max_batch_size': 8,
+            'max_wait': 0.05,
+            'max_new_tokens': 16,
+            'queue_limit': 8,
+            'owner_limit': 2
+        } | options
+    )
+
+
+@pytest.fixture
+def ready():
+    """Starts a scheduler and waits until its backend is loaded."""
+    def start(scheduler: InferenceScheduler) -> InferenceScheduler:
+        scheduler.start()
+        for _ in range(100):
+            if str(scheduler.state) == 'ready':
+                return scheduler
+            threading.Event().wait(0.01)
+        raise AssertionError(f'scheduler is {scheduler.state}')
+    return start
+
+
+def test_answers_the_same_question_asked_twice_in_one_batch(ready, monkeypatch):
+    monkeypatch.setattr(CONFIG, 'persistence_mode', 'write_through')
+    scheduler = ready(_scheduler(answer_cache=AnswerCache(max_size=8, max_bytes=1024, ttl=60, persist=True)))
+    answers = _Answers()
+    scheduler.submit('asked in one batch twice', answers.on_answer, owner=1)
+    scheduler.submit('asked in one batch twice', answers.on_answer, owner=2)
+
+    assert answers.wait_for(2) == ['asked in one batch twice'] * 2
+    # the scheduler thread survived, later questions are still answered
+    scheduler.submit('and one more', answers.on_answer, owner=3)
+    assert 'and one more' in answers.wait_for(3)
+
+
+def test_batches_only_questions_sharing_a_token_budget(ready):
+    backend = _RecordingBackend()
+    scheduler = ready(_scheduler(lambda: backend, max_wait=0.3, owner_limit=8))
+    answers = _Answers()
+    for tokens in (4, 8, 4, 4):
+        scheduler.submit(f'question of {tokens} tokens', answers.on_answer, max_new_tokens=tokens)
+
+    assert len(answers.wait_for(4)) == 4
+    assert backend.batches == [[4, 4, 4], [8]]
+
+
+def test_refuses_questions_beyond_the_queue_and_owner_limits(ready):
+    backend = _RecordingBackend()
+    backend.release.clear()
+    scheduler = ready(_scheduler(lambda: backend, max_wait=0.0, queue_limit=3, owner_limit=2))
+    answers = _Answers()
+    scheduler.submit('generating', answers.on_answer)
+    for _ in range(100):
+        if backend.batches:
+            break
+        threading.Event().wait(0.01)
+
+    scheduler.submit('first', answers.on_answer, owner=1)
+    scheduler.submit('second', answers.on_answer, owner=1)
+    with pytest.raises(SchedulerFullError):
+        scheduler.submit('third', answers.on_answer, owner=1)
+    scheduler.submit('another client', answers.on_answer, owner=2)
+    with pytest.raises(SchedulerFullError):
+        scheduler.submit('queue is full', answers.on_answer, owner=3)
+
+    backend.release.set()
+    assert len(answers.wait_for(4)) == 4
+
+
+def test_a_failed_batch_tells_every_asker(ready):
+    scheduler = ready(_scheduler(_FailingBackend, max_wait=0.2))
+    answers = _Answers()
+    scheduler.submit('first', answers.on_answer, owner=1)
+    scheduler.submit('second', answers.on_answer, owner=2)
+
+    assert answers.wait_for(2) == [QuestionRejectedError.reply] * 2
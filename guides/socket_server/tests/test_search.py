@@ -0,0 +1,69 @@
+import uuid
+
+import pytest
+
+from config import CONFIG
+from core.handlers import MessageHandler
+from core.models import Message, User
+from core.search.commands import SearchCommand
+
+
+def _store(room_id: uuid.UUID, *contents: str) -> list[Message]:
+    user = User(name='tester', public_key=b'', fingerprint='')
+    messages = [
+        MessageHandler.store_message(user=user, content=content.encode(), room_id=room_id)
+        for content in contents
+    ]
+    MessageHandler.flush()
+    return messages
+
+
+def _found(room_id: uuid.UUID, query: str, page: int = 1) -> list[bytes]:
+    _, messages = MessageHandler.search(room_id=room_id, query=query, page=page)
+    return sorted(MessageHandler.signed_content(message) for message in messages)
+
+
+def test_finds_whole_words_and_phrases_within_the_room_only():
+    room_id, other_room_id = uuid.uuid4(), uuid.uuid4()
+    _store(room_id, 'Linear algebra tonight', 'algebra is fun', 'tonight we sleep')
+    _store(other_room_id, 'algebra elsewhere')
+
+    assert _found(room_id, 'ALGEBRA') == [b'tester: Linear algebra tonight', b'tester: algebra is fun']
+    assert _found(room_id, 'algebra tonight') == [b'tester: Linear algebra tonight']
+    assert _found(room_id, '"tonight algebra"') == []
+    assert _found(room_id, 'alg') == []
+    assert _found(other_room_id, 'algebra') == [b'tester: algebra elsewhere']
+
+
+def test_deleted_messages_leave_the_index():
+    room_id = uuid.uuid4()
+    first, _ = _store(room_id, 'exam on friday', 'exam on monday')
+
+    MessageHandler.delete_messages([first])
+    assert _found(room_id, 'exam') == [b'tester: exam on monday']
+    page, _ = MessageHandler.search(room_id=room_id, query='friday')
+    assert page.total == 0
+
+
+def test_pages_through_many_matches():
+    room_id = uuid.uuid4()
+    _store(room_id, *[f'note {index}' for index in range(CONFIG.search_page_size + 1)])
+
+    first, _ = MessageHandler.search(room_id=room_id, query='note')
+    assert (first.total, first.pages) == (CONFIG.search_page_size + 1, 2)
+    assert len(first.message_ids) == CONFIG.search_page_size
+    assert len(_found(room_id, 'note', page=2)) == 1
+    assert b'there is no page 3' in SearchCommand(query='note', page=3).answer(room_id)
+
+
+@pytest.mark.parametrize(
+    ('message', 'command'),
+    [
+        (b'/search exam', SearchCommand(query='exam')),
+        (b'/search "linear algebra" --page 2', SearchCommand(query='"linear algebra"', page=2)),
+        (b'/search', None),
+        (b'/join exam', None)
+    ]
+)
+def test_parses_search_commands(message, command):
+    assert SearchCommand.parse(message) == command
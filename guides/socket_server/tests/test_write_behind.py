@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from core.handlers.writer import WriteBehindError, WriteBehindQueue
+
+
+class _Database:
+    """Commits groups of rows, failing the next ``failures`` commits and every commit with a ``poison`` row."""
+
+    def __init__(self, failures: int = 0, poison: object = None) -> None:
+        self.rows: list[object] = []
+        self.attempts: list[float] = []
+        self.failures = failures
+        self.poison = poison
+        self._lock = threading.Lock()
+
+    def flush(self, rows) -> None:
+        with self._lock:
+            self.attempts.append(time.monotonic())
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError('database is locked')
+            if self.poison in rows:
+                raise RuntimeError('constraint failed')
+            self.rows.extend(rows)
+
+
+def _queue(database: _Database, **options) -> WriteBehindQueue:
+    return WriteBehindQueue(
+        flush=database.flush,
+        **{'batch_size': 4, 'flush_interval': 0.02, 'max_attempts': 4} | options
+    )
+
+
+def test_groups_rows_and_flushes_them_in_order():
+    database = _Database()
+    queue = _queue(database, batch_size=100, flush_interval=10)
+    for row in range(10):
+        queue.put(row)
+    queue.flush()
+
+    assert database.rows == list(range(10))
+    assert len(database.attempts) == 1
+    queue.close()
+
+
+def test_backs_off_between_retries_of_a_failed_group():
+    database = _Database(failures=2)
+    queue = _queue(database)
+    for row in range(20):
+        queue.put(row)
+    queue.close()
+
+    assert database.rows == list(range(20))
+    first, second, third = database.attempts[:3]
+    assert second - first >= 0.04
+    assert third - second >= 0.08
+
+
+def test_drops_only_the_row_the_database_always_rejects():
+    database = _Database(poison=2)
+    queue = _queue(database, flush_interval=0.001)
+    for row in range(4):
+        queue.put(row)
+    queue.close()
+
+    assert database.rows == [0, 1, 3]
+    assert queue.dropped == 1
+
+
+def test_flush_reports_rows_still_waiting_for_a_retry():
+    database = _Database(failures=1)
+    queue = _queue(database, batch_size=100, flush_interval=0.2)
+    queue.put(1)
+    with pytest.raises(WriteBehindError):
+        queue.flush()
+    queue.close()
+
+    assert database.rows == [1]